@@ -6,30 +6,46 @@ the received data to generate a PDF and send emails to specified recipients.
 
 Functions:
 - post_method: Endpoint for handling form submissions.
+- email_stats: Endpoint reporting the email queue, mail transport, rate limit and outbox
+  statistics.
 
 Private Functions:
-- send_emails: Sends emails with the generated PDF attached.
-- validate_signature: Validates the base64 encoded signature image.
-- validate_input: Validates all input data.
+- send_emails: Sends emails with the generated PDF attached, or stores them in the
+  outbox to be sent in the background.
+- validate_signature: Decodes and validates the base64 encoded signature image.
+- validate_input: Validates all input data and returns the decoded signature.
+- serves_requests: Returns whether this process serves the requests, rather than being
+  a render worker or the reloader watching the files.
+- start_up: Warms up the renderer and starts the outbox and render pool.
 """
 
 import os
 import logging
 import secrets
 import re
-import base64
-import io
 import time
-import threading
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
 from datetime import datetime
 import pytz
 from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
+from werkzeug.serving import is_running_from_reloader
 from dotenv import find_dotenv, load_dotenv
-from PIL import Image
 from src.pdf_gen import GeneratePDF
 from src.send_email import SendEmail
+from src.http_transport import HTTPTransport, HTTP_API_URL, HTTP_POOL_SIZE
+from src.mail_executor import MailExecutor, MailQueueFull, MAIL_QUEUE_DEPTH, MAIL_QUEUE_TIMEOUT
+from src.relays import parse_relays
+from src.rate_limit import MailRateLimiter, RELAY_BURST, SENDER_BURST
+from src.mail_retry import (DeadLetterSpool, DIRECT_ATTEMPTS, DIRECT_BASE_DELAY,
+                            DIRECT_MAX_DELAY, MAX_ATTEMPTS, RetryPolicy)
+from src.outbox import Outbox
+from src.fonts.fonts import FONT_REGISTRY, PROFILE_EMBEDDED
+from src.form_templates import TEMPLATE_REGISTRY
+from src.email_templates import EMAIL_TEMPLATES
+from src.output_profiles import DEFAULT_OUTPUT_PROFILE, OUTPUT_PROFILES
+from src.render_pool import RenderPool
+from src.signature import Signature
 
 load_dotenv(find_dotenv(".env"))
 load_dotenv(find_dotenv(".env.local"))
@@ -47,10 +63,109 @@ server = os.getenv("SMTP_HOST")
 port = os.getenv("SMTP_PORT")
 user = os.getenv("SMTP_USER")
 pswd = os.getenv("SMTP_PSWD")
-smtp_server = SendEmail(server, port, user, pswd)
+# Connections to the mail server are kept open between submissions
+smtp_pool_size = int(os.getenv("SMTP_POOL_SIZE", "2"))
+smtp_idle_timeout = float(os.getenv("SMTP_POOL_IDLE_TIMEOUT", "60"))
+smtp_starttls = os.getenv("SMTP_STARTTLS", "true").lower() != "false"
+# Optionally spread the emails over several relays, written as host[:port][*weight]
+# and separated by commas, failing over between them when one is slow or down
+smtp_relays_spec = os.getenv("SMTP_RELAYS")
+smtp_relays = parse_relays(smtp_relays_spec, port or 587) if smtp_relays_spec else None
+# Emails a second allowed to the relay and from the sender account, bursts beyond
+# that wait for their turn instead of being throttled by the relay. 0 is unlimited
+relay_rate = float(os.getenv("MAIL_RELAY_RATE", "0"))
+sender_rate = float(os.getenv("MAIL_SENDER_RATE", "0"))
+rate_limiter = MailRateLimiter(
+    relay_rate or None,
+    int(os.getenv("MAIL_RELAY_BURST", str(RELAY_BURST))),
+    sender_rate or None,
+    int(os.getenv("MAIL_SENDER_BURST", str(SENDER_BURST))),
+) if relay_rate or sender_rate else None
+# "http" sends the emails through a Resend-style HTTP API instead of SMTP, over
+# keep-alive connections and without an SMTP handshake per session
+mail_transport = HTTPTransport(
+    os.getenv("RESEND_API_KEY"),
+    os.getenv("MAIL_API_URL", HTTP_API_URL),
+    int(os.getenv("MAIL_API_POOL_SIZE", str(HTTP_POOL_SIZE))),
+    rate_limiter=rate_limiter,
+) if os.getenv("MAIL_TRANSPORT", "smtp").lower() == "http" else None
+smtp_server = SendEmail(server, port, user, pswd, smtp_pool_size, smtp_idle_timeout,
+                        smtp_starttls, mail_transport, rate_limiter, smtp_relays)
+
+# Optionally store the emails in an outbox and send them in the background, so a
+# submission does not wait for the mail server. Failed emails are sent again with
+# backoff, and kept in a dead-letter folder once they run out of attempts
+outbox_path = os.getenv("EMAIL_OUTBOX_PATH")
+dead_letter_path = os.getenv("EMAIL_DEAD_LETTER_PATH")
+outbox = Outbox(
+    outbox_path,
+    smtp_server,
+    int(os.getenv("EMAIL_OUTBOX_WORKERS", "2")),
+    retry_policy=RetryPolicy(int(os.getenv("EMAIL_MAX_ATTEMPTS", str(MAX_ATTEMPTS)))),
+    dead_letters=DeadLetterSpool(dead_letter_path) if dead_letter_path else None,
+) if outbox_path else None
+
+# Without an outbox, emails failing with a temporary error are sent again a few times
+# within the request, so the patient does not have to submit the form again
+direct_retry_policy = RetryPolicy(
+    int(os.getenv("EMAIL_DIRECT_ATTEMPTS", str(DIRECT_ATTEMPTS))),
+    DIRECT_BASE_DELAY,
+    DIRECT_MAX_DELAY,
+)
+
+# Emails are sent on a fixed number of threads shared by all requests, so a burst of
+# submissions cannot open more SMTP sessions than the pool holds. Once the queue is
+# full a submission waits for room for a while, and then fails
+mail_executor = MailExecutor(
+    int(os.getenv("EMAIL_WORKERS", str(smtp_pool_size))),
+    int(os.getenv("EMAIL_QUEUE_DEPTH", str(MAIL_QUEUE_DEPTH))),
+    float(os.getenv("EMAIL_QUEUE_TIMEOUT", str(MAIL_QUEUE_TIMEOUT))),
+)
+
+# "core" prints in the PDF core fonts, which is faster but plainer than the embedded fonts
+render_profile = os.getenv("PDF_RENDER_PROFILE", PROFILE_EMBEDDED)
+# "fast" spends less CPU on compression and "small" makes smaller attachments,
+# a submission can also ask for one with "outputProfile"
+output_profile = os.getenv("PDF_OUTPUT_PROFILE", DEFAULT_OUTPUT_PROFILE)
+
+# Optionally render PDFs in worker processes instead of on the request thread
+render_workers = int(os.getenv("PDF_RENDER_WORKERS", "0"))
+render_jobs_per_worker = int(os.getenv("PDF_RENDER_JOBS_PER_WORKER", "0")) or None
+render_pool = RenderPool(render_workers, render_jobs_per_worker, profile=render_profile,
+                         output_profile=output_profile) if render_workers > 0 else None
+
+def _serves_requests() -> bool:
+    """Returns whether this process is the one serving the requests"""
+    if __name__ == "__mp_main__":
+        # A render worker, spawned processes import the script they were started from
+        return False
+    if __name__ == "__main__":
+        # app.run below watches the files in this process and serves in a child process
+        return is_running_from_reloader()
+    # Imported by gunicorn, flask run or the tests
+    return True
+
+def _start_up() -> None:
+    """Warms up the renderer and starts the outbox and render pool"""
+    # Parse the fonts, form and email templates once at startup rather than on the first
+    # submission
+    FONT_REGISTRY.warm_up()
+    TEMPLATE_REGISTRY.load_all()
+    EMAIL_TEMPLATES.load_all()
+    GeneratePDF(render_profile, output_profile).warm_up()
+
+    if outbox is not None:
+        outbox.start()
+    # Started with the app, also under gunicorn or flask run, so the first submissions
+    # do not wait for the workers to warm up
+    if render_pool is not None:
+        render_pool.start()
+
+if _serves_requests():
+    _start_up()
 
 # Function to set up email to be sent to clinic and patient
-def _send_emails(recipient_email, pdf_base64, patient_name, patient_email, submit_datetime):
+def _send_emails(recipient_email, pdf_content, patient_name, patient_email, submit_datetime):
     """Sends emails with the generated PDF attached."""
 
     start = time.time()
@@ -58,49 +173,44 @@ def _send_emails(recipient_email, pdf_base64, patient_name, patient_email, submi
     reg_name: str = re.sub(r"[^a-zA-Z' -]", "", patient_name).replace(" ", "_")
     token: str = reg_name + "_" + secrets.token_hex(4)
 
-    t1 = threading.Thread(
-        target=smtp_server.send_email_to_clinic,
-        args=(
-            recipient_email,
-            f"{token}.pdf",
-            pdf_base64,
-            patient_name,
-            patient_email,
-            submit_datetime
-        )
-    )
-    t2 = threading.Thread(
-        target=smtp_server.send_email_to_patient,
-        args=(patient_email, patient_name)
-    )
-
-    t1.start()
-    t2.start()
-
-    t1.join()
-    t2.join()
+    if outbox is not None:
+        submission: str = outbox.enqueue_submission(recipient_email, f"{token}.pdf", pdf_content,
+                                                    patient_name, patient_email, submit_datetime)
+        logging.info("Emails of submission %s stored in the outbox. Elapsed time: %.2f sec",
+                     submission, time.time() - start)
+        return
+
+    # The emails wait for the rate limiter here, so a burst of submissions waiting for
+    # its turn does not fill the mail executor. Both emails are then sent over a single
+    # SMTP session, on a mail executor thread, and sent again after a temporary error
+    paced: float = smtp_server.pace(2)
+    try:
+        results = mail_executor.run(smtp_server.send_submission, recipient_email,
+                                    f"{token}.pdf", pdf_content, patient_name, patient_email,
+                                    submit_datetime, retry_policy=direct_retry_policy)
+    except MailQueueFull:
+        # The submission is turned away, so the next ones get its turn
+        smtp_server.refund(2)
+        raise
 
     end = time.time()
-    logging.info("Emails sent successfully. Total elapsed time: %.2f sec", end - start)
-
-def validate_signature(signature_base64: str) -> None:
-    """Validates the base64 encoded signature image."""
+    executor_stats: Dict[str, float] = mail_executor.stats()
+    logging.info("Emails sent successfully. Total elapsed time: %.2f sec, "
+                 "connection reuse ratio: %.2f, email queue depth: %d, "
+                 "average queue wait: %.3f sec, throttled for: %.3f sec",
+                 end - start, smtp_server.transport.stats()["reuse_ratio"],
+                 executor_stats["queued"], executor_stats["wait_avg"],
+                 paced + sum(result.waited for result in results))
+
+def validate_signature(signature_base64: str) -> Signature:
+    """Decodes and validates the base64 encoded signature image."""
     try:
-        # Decode the base64 string
-        signature_base64: str = signature_base64.split("base64,")[1]
-        signature_data = base64.b64decode(signature_base64)
-        
-        # Open the image
-        image = Image.open(io.BytesIO(signature_data))
-        # Validate image format
-        if image.format != 'PNG':
-            raise ValueError("Signature image must be in PNG format")
+        return Signature.from_data_uri(signature_base64)
+    except ValueError as e:
+        raise ValueError("Invalid drawSignature: " + str(e)) from e
 
-    except Exception as e:
-        raise ValueError("Invalid signature image: " + str(e))    
-
-def validate_input(data: Dict[str, Any]) -> None:
-    """Validates the input data."""
+def validate_input(data: Dict[str, Any]) -> Signature:
+    """Validates the input data and returns the decoded signature."""
     if not isinstance(data.get("name"), str) or not data["name"].strip():
         raise ValueError("Invalid name")
 
@@ -108,36 +218,38 @@ def validate_input(data: Dict[str, Any]) -> None:
     if not isinstance(data.get("email"), str) or not re.match(email_pattern, data["email"]):
         raise ValueError("Invalid email")
 
-    base64_png_pattern = r"^data:image/png(?:;charset=utf-8)?;base64,[A-Za-z0-9+/=]+$"
     if not isinstance(data.get("drawSignature"), str) or not data["drawSignature"].strip():
         raise ValueError("Invalid drawSignature")
-    
-    if not re.match(base64_png_pattern, data["drawSignature"]):
-        raise ValueError("Invalid drawSignature: Not a valid Base64 PNG data URI.")
 
-    # Validate base64 signature image
-    validate_signature(data["drawSignature"])
+    # Decode the signature image once, it is handed to the renderer as is
+    signature: Signature = validate_signature(data["drawSignature"])
 
-    if data.get("formType") not in ["adult", "child"]:
-        raise ValueError("Invalid formType")
+    try:
+        template = TEMPLATE_REGISTRY.get(data.get("formType"))
+    except FileNotFoundError as e:
+        raise ValueError("Invalid formType") from e
 
     consent = data.get("consent")
     if not isinstance(consent, dict):
         raise ValueError("Invalid consent data")
     
-    if data["formType"] == "child":
-        required_consent_keys = {"researchConsent", "studentConsent"}
-        if "contactConsent" in consent:
-            del consent["contactConsent"]
-    elif data["formType"] == "adult":
-        required_consent_keys = {"researchConsent", "contactConsent", "studentConsent"}
+    # Consent fields that only belong to other forms are dropped
+    required_consent_keys = set(template.consent_keys)
+    for key in TEMPLATE_REGISTRY.consent_keys():
+        if key not in required_consent_keys and key in consent:
+            del consent[key]
 
     if required_consent_keys != set(consent.keys()):
         raise ValueError("Missing or extra consent fields")
 
     for key in required_consent_keys:
         if not isinstance(consent[key], bool):
-            raise ValueError(f"Invalid value for {key}")    
+            raise ValueError(f"Invalid value for {key}")
+
+    if "outputProfile" in data and data["outputProfile"] not in OUTPUT_PROFILES:
+        raise ValueError("Invalid outputProfile")
+
+    return signature
 
 @app.route("/post", methods=["POST"])
 def post_method() -> Response:
@@ -156,41 +268,33 @@ def post_method() -> Response:
         received_data: Dict[str, Any] = request.json
 
 
-        validate_input(received_data)
+        signature: Signature = validate_input(received_data)
 
         current_au_time: datetime = datetime.now(pytz.timezone("Australia/Sydney"))
 
-        draw_signature: str = received_data.get("drawSignature")
         form_type: str = received_data.get("formType")
-        generator: GeneratePDF = GeneratePDF()
 
-        # Determine consent flags based on consent field
+        # Determine consent flags in the order of the form's consent sections
         consent: Dict[str, bool] = received_data.get("consent")
-
-        if form_type == "adult":
-            consent_flags: List[bool] = [
-                consent["researchConsent"],
-                consent["contactConsent"],
-                consent["studentConsent"],
-            ]
-        elif form_type == "child":
-            consent_flags: List[bool] = [consent["researchConsent"], consent["studentConsent"]]
-        else:
-            raise FileNotFoundError(f"Form type is not available: {form_type}")
+        consent_keys: Tuple[str, ...] = TEMPLATE_REGISTRY.get(form_type).consent_keys
+        consent_flags: List[bool] = [consent[key] for key in consent_keys]
 
         # Generate PDF with dynamic data
-        pdf_base64: str = generator.generate_pdf(
+        generator = render_pool if render_pool is not None \
+            else GeneratePDF(render_profile, output_profile)
+        pdf_content: bytes = generator.generate_pdf_bytes(
             received_data["name"],
             form_type,
             consent_flags,
-            draw_signature,
-            current_au_time
+            signature,
+            current_au_time,
+            received_data.get("outputProfile")
         )
 
         patient_name: str = received_data.get("name")
         patient_email: str = received_data.get("email")
 
-        _send_emails(os.getenv("RECIPIENT_EMAIL"), pdf_base64,
+        _send_emails(os.getenv("RECIPIENT_EMAIL"), pdf_content,
                     patient_name, patient_email, current_au_time)
 
         response_data: Dict[str, Any] = {
@@ -200,9 +304,31 @@ def post_method() -> Response:
 
         return jsonify(response_data), 200
 
+    except MailQueueFull as e:
+        logging.error(e)
+        return jsonify({"error": str(e)}), 503
+
     except Exception as e:
         logging.error(e)
         return jsonify({"error": str(e)}), 500
 
+@app.route("/email/stats", methods=["GET"])
+def email_stats() -> Response:
+    """
+    Endpoint reporting the depth of the email queue, how long emails waited in it,
+    the connection reuse of the mail transport and, if there are ones, how long emails
+    waited for the rate limiter and the state of the outbox.
+    """
+    stats: Dict[str, Any] = {
+        "queue": mail_executor.stats(),
+        "transport": smtp_server.transport.stats(),
+    }
+    if rate_limiter is not None:
+        stats["rate_limit"] = rate_limiter.stats()
+    if outbox is not None:
+        stats["outbox"] = outbox.stats()
+    return jsonify(stats), 200
+
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=3030, threaded=True)
+    app.run(debug=True, host="0.0.0.0", port=int(os.getenv("BACKEND_PORT", "3030")),
+            threaded=True)
@@ -0,0 +1,67 @@
+"""Module to compare the render time and size of the PDF render profiles
+
+Renders the same submissions with the embedded and core render profiles after
+warming up, and prints the mean and median render time and the PDF size of each.
+
+Usage: python benchmarks/render_profiles.py [--iterations N]
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import time
+from datetime import datetime
+
+# Set up the project path, the form text and fonts are loaded relative to it
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_PATH = os.path.abspath(os.path.join(SCRIPT_DIR, ".."))
+sys.path.append(BACKEND_PATH)
+os.chdir(BACKEND_PATH)
+
+# pylint: disable=wrong-import-position
+from src.fonts.fonts import FONT_REGISTRY, PROFILE_CORE, PROFILE_EMBEDDED
+from src.form_templates import TEMPLATE_REGISTRY
+from src.pdf_gen import GeneratePDF
+from src.signature import Signature
+
+SIGNATURE = Signature.from_data_uri(
+    "data:image/png;base64,"
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1Pe"
+    "AAAADElEQVQI12P4//8/AAX+Av7czFnnAAAAAElFTkSuQmCC"
+)
+
+CASES = [
+    ("adult, Latin name", "adult", [True, True, False], "Zoë O'Brien"),
+    ("child, Latin name", "child", [True, False], "Ana María Núñez"),
+    ("adult, Cyrillic name", "adult", [True, True, False], "Евгения Петрова"),
+]
+
+def _benchmark(profile: str, form_type: str, flags, name: str, iterations: int):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        pdf = GeneratePDF(profile).generate_pdf_bytes(name, form_type, flags, SIGNATURE,
+                                                      datetime.now())
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.mean(timings), statistics.median(timings), len(pdf)
+
+def main() -> None:
+    """Runs the benchmark and prints a side by side table"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    FONT_REGISTRY.warm_up()
+    TEMPLATE_REGISTRY.load_all()
+    GeneratePDF(PROFILE_CORE).warm_up()
+
+    print(f"{'case':<24}{'profile':<10}{'mean ms':>10}{'median ms':>11}{'size KB':>10}")
+    for label, form_type, flags, name in CASES:
+        for profile in (PROFILE_EMBEDDED, PROFILE_CORE):
+            mean, median, size = _benchmark(profile, form_type, flags, name, args.iterations)
+            print(f"{label:<24}{profile:<10}{mean:>10.1f}{median:>11.1f}{size / 1024:>10.1f}")
+
+if __name__ == "__main__":
+    main()
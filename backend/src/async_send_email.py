@@ -0,0 +1,365 @@
+"""Module for sending emails with asyncio.
+
+SendEmail blocks a thread for every message it sends, for the whole of the SMTP
+conversation. This module provides an asyncio counterpart with the same interface,
+whose SMTP sessions are non-blocking streams, so a single event loop can keep
+hundreds of deliveries in flight. Sessions are upgraded with STARTTLS and a verified
+certificate, authenticated, and kept open between messages. Every read and write is
+bounded by a timeout, and the number of open sessions is capped, with further
+deliveries waiting for a free one. The emails are built and serialized as SendEmail
+builds them, and the data of a message is streamed the same way. Which email is
+sent next, when a lost session is replaced and which errors fail an email are
+decided by the same _Delivery as SendEmail, so the two only differ in their I/O.
+
+Classes:
+- AsyncSendEmail: Sends the emails to the clinic or patient from an event loop.
+
+Constants:
+- ASYNC_MAX_CONNECTIONS: The default number of SMTP sessions open at once.
+- CONNECT_TIMEOUT: The default number of seconds to connect and start TLS.
+- COMMAND_TIMEOUT: The default number of seconds to wait for a reply or to send data.
+
+Exception Handling:
+- The smtplib exceptions are raised, as SendEmail raises them, so callers and the
+  retry policy treat both alike. Timeouts raise TimeoutError.
+"""
+import asyncio
+import base64
+import logging
+import socket
+import smtplib
+import ssl
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from .rate_limit import MailRateLimiter
+from .send_email import (DeliveryResult, EmailBuilder, OutgoingEmail, _DataWriter, _Delivery,
+                         pipelined_refusal)
+from .smtp_pool import SMTP_IDLE_TIMEOUT
+
+ASYNC_MAX_CONNECTIONS = 10
+CONNECT_TIMEOUT = 10.0
+COMMAND_TIMEOUT = 30.0
+
+class _AsyncSMTP:
+    """An open SMTP session over asyncio streams."""
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 command_timeout: float):
+        self.reader = reader
+        self.writer = writer
+        self.command_timeout = command_timeout
+        self.esmtp_features: Dict[str, str] = {}
+        self.reused = False
+        self.last_used = time.monotonic()
+
+    async def getreply(self) -> Tuple[int, bytes]:
+        """Reads a reply, which may span several lines"""
+        code, lines = 0, []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.command_timeout)
+            if not line:
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            try:
+                code = int(line[:3])
+            except ValueError as e:
+                raise smtplib.SMTPServerDisconnected(f"Invalid reply: {line!r}") from e
+            lines.append(line[4:].strip(b" \t\r\n"))
+            if line[3:4] != b"-":
+                return code, b"\n".join(lines)
+
+    async def send(self, data: bytes) -> None:
+        """Writes data and waits until the server has taken it"""
+        self.writer.write(data)
+        await self.drain()
+
+    async def drain(self) -> None:
+        """Waits until the data written so far has mostly been taken by the server"""
+        await asyncio.wait_for(self.writer.drain(), self.command_timeout)
+
+    async def docmd(self, command: str) -> Tuple[int, bytes]:
+        """Sends a command and returns its reply"""
+        await self.send(f"{command}\r\n".encode("ascii"))
+        return await self.getreply()
+
+    async def ehlo(self, local_hostname: str) -> None:
+        """Greets the server and records the extensions it supports"""
+        code, reply = await self.docmd(f"EHLO {local_hostname}")
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, reply)
+
+        self.esmtp_features = {}
+        for line in reply.decode("ascii", "replace").split("\n")[1:]:
+            feature, _, params = line.partition(" ")
+            self.esmtp_features[feature.lower()] = params.strip()
+
+    async def login(self, user: str, pswd: str) -> None:
+        """Authenticates with AUTH PLAIN, or with AUTH LOGIN if PLAIN is not offered"""
+        if "auth" not in self.esmtp_features:
+            raise smtplib.SMTPNotSupportedError("SMTP AUTH extension not supported by server.")
+
+        mechanisms = self.esmtp_features["auth"].upper().split()
+        if "PLAIN" in mechanisms:
+            code, reply = await self.docmd(f"AUTH PLAIN {_b64(f'{chr(0)}{user}{chr(0)}{pswd}')}")
+        elif "LOGIN" in mechanisms:
+            code, reply = await self.docmd(f"AUTH LOGIN {_b64(user)}")
+            if code == 334:
+                code, reply = await self.docmd(_b64(pswd))
+        else:
+            raise smtplib.SMTPNotSupportedError("No suitable authentication method found.")
+
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, reply)
+
+    async def rset(self) -> None:
+        """Ends a failed transaction"""
+        await self.docmd("RSET")
+
+    async def close(self) -> None:
+        """Says goodbye and closes the session, whatever state it is in"""
+        try:
+            await self.docmd("QUIT")
+        except (smtplib.SMTPException, OSError, UnicodeError):
+            pass
+        self.abort()
+
+    def abort(self) -> None:
+        """Closes the session without a goodbye"""
+        self.writer.close()
+
+class AsyncSendEmail(EmailBuilder):
+    """
+    Handles the sending of emails to the clinic or patient from an event loop.
+
+    At most max_connections SMTP sessions are open at once, idle ones are reused for
+    idle_timeout seconds. The sessions belong to the event loop that opened them, so
+    an instance is used from one event loop. A rate_limiter may be shared with SendEmail
+    so both send at the rate the relay allows.
+    """
+    def __init__(self, server: str, port: int, user: str, pswd: str,
+                 max_connections: int = ASYNC_MAX_CONNECTIONS,
+                 idle_timeout: float = SMTP_IDLE_TIMEOUT, starttls: bool = True,
+                 tls_context: Optional[ssl.SSLContext] = None,
+                 connect_timeout: float = CONNECT_TIMEOUT,
+                 command_timeout: float = COMMAND_TIMEOUT,
+                 rate_limiter: Optional[MailRateLimiter] = None):
+        super().__init__(user)
+        self.server = server
+        self.port = port
+        self.pswd = pswd
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.starttls = starttls
+        self.tls_context = tls_context or ssl.create_default_context()
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self.rate_limiter = rate_limiter
+        self.relay = f"{server}:{port}"
+        self.created = 0
+        self.reused = 0
+        # Looked up once, as it may need DNS, which would block the event loop
+        self._local_hostname = socket.getfqdn()
+        self._slots = asyncio.Semaphore(max_connections)
+        self._idle: List[_AsyncSMTP] = []
+
+    async def send_email_to_clinic(self, email_to: str, attach_name: str, pdf_base64: str,
+                                   patient_name: str, patient_email: str,
+                                   submit_datetime: datetime) -> None:
+        """
+        Sends an email to the clinic with the base64-encoded consent form attached as a PDF,
+        see SendEmail.send_email_to_clinic.
+        """
+        await self.send_pdf_to_clinic(email_to, attach_name, base64.b64decode(pdf_base64),
+                                      patient_name, patient_email, submit_datetime)
+
+    async def send_pdf_to_clinic(self, email_to: str, attach_name: str, pdf_content: bytes,
+                                 patient_name: str, patient_email: str,
+                                 submit_datetime: datetime) -> None:
+        """Sends an email to the clinic with the consent form attached as a PDF"""
+        start = time.time()
+        await self._send_email(self.clinic_email(email_to, attach_name, pdf_content,
+                                                 patient_name, patient_email, submit_datetime))
+        logging.info("Email successfully sent to the clinic. Elapsed time: %.2f sec",
+                     time.time() - start)
+
+    async def send_email_to_patient(self, email_to: str, patient_name: str) -> None:
+        """Sends a confirmation email to the patient after they submit the consent form"""
+        start = time.time()
+        await self._send_email(self.patient_email(email_to, patient_name))
+        logging.info("Email successfully sent to the patient. Elapsed time: %.2f sec",
+                     time.time() - start)
+
+    async def send_submission(self, email_to: str, attach_name: str, pdf_content: bytes,
+                              patient_name: str, patient_email: str,
+                              submit_datetime: datetime) -> List[DeliveryResult]:
+        """
+        Sends the clinic and patient emails of a submission over a single SMTP session,
+        and raises the first error once both have been tried.
+        """
+        results = await self.send_emails([
+            self.clinic_email(email_to, attach_name, pdf_content, patient_name,
+                              patient_email, submit_datetime),
+            self.patient_email(patient_email, patient_name),
+        ])
+        for result in results:
+            if result.error is not None:
+                raise result.error
+        return results
+
+    async def send_emails(self, emails: List[OutgoingEmail]) -> List[DeliveryResult]:
+        """
+        Sends emails one after the other over a single SMTP session, and returns how long
+        each took and the error it failed with, if any, see SMTPTransport.send_emails.
+        """
+        delivery = _Delivery(emails, self.relay, self.user, self.rate_limiter)
+        while delivery.pending:
+            # Reserved without blocking, and waited for on the event loop before a
+            # session is taken
+            delay = delivery.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                session = await self._acquire()
+            except (smtplib.SMTPException, OSError) as e:
+                delivery.unreachable(e)
+                break
+
+            lost: Optional[BaseException] = None
+            try:
+                while delivery.ready:
+                    start = time.perf_counter()
+                    try:
+                        await self._send_transaction(session, delivery.email)
+                        error = None
+                    except (smtplib.SMTPException, OSError) as e:
+                        if _Delivery.is_session_lost(e):
+                            lost = e
+                            break
+                        error = e
+                    delivery.done(time.perf_counter() - start, error)
+            except BaseException:
+                self._release(session, discard=True)
+                raise
+
+            self._release(session, discard=lost is not None)
+            if lost is not None and not delivery.lost(lost, session.reused):
+                break
+
+        return delivery.results
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the number of sessions opened, reused and idle, and the reuse ratio"""
+        checkouts = self.created + self.reused
+        return {"created": self.created, "reused": self.reused, "idle": len(self._idle),
+                "reuse_ratio": self.reused / checkouts if checkouts else 0.0}
+
+    async def close(self) -> None:
+        """Closes the idle sessions"""
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(session.close() for session in idle))
+
+    async def _send_email(self, email: OutgoingEmail) -> None:
+        result = (await self.send_emails([email]))[0]
+        if result.error is not None:
+            raise result.error
+
+    async def _send_transaction(self, session: _AsyncSMTP, email: OutgoingEmail) -> None:
+        """Sends one email as a mail transaction, pipelined if the server supports it"""
+        commands = (f"MAIL FROM:{smtplib.quoteaddr(self.user)}",
+                    f"RCPT TO:{smtplib.quoteaddr(email.email_to)}", "DATA")
+        if "pipelining" in session.esmtp_features:
+            await session.send("".join(f"{command}\r\n" for command in commands).encode("ascii"))
+            replies = [await session.getreply() for _ in commands]
+        else:
+            replies = []
+            for command in commands:
+                replies.append(await session.docmd(command))
+                if replies[-1][0] >= 400:
+                    break
+            # Commands that were not sent after a refusal
+            replies += [(0, b"")] * (3 - len(replies))
+
+        error = pipelined_refusal(self.user, email.email_to, *replies)
+        if error is not None:
+            if replies[2][0] == 354:
+                # The server took the DATA command although the transaction failed, end it empty
+                await session.send(b".\r\n")
+                await session.getreply()
+            await session.rset()
+            raise error
+
+        # Written to the stream as it is serialized, waiting whenever the server falls behind
+        writer = _DataWriter(session.writer.write)
+        for chunk in self._message_chunks(email):
+            writer.write(chunk)
+            await session.drain()
+        writer.close()
+        await session.drain()
+
+        code, reply = await session.getreply()
+        if code != 250:
+            await session.rset()
+            raise smtplib.SMTPDataError(code, reply)
+
+    async def _acquire(self) -> _AsyncSMTP:
+        """Returns an idle session that still answers, or opens a new one"""
+        await self._slots.acquire()
+        try:
+            while self._idle:
+                session = self._idle.pop()
+                if time.monotonic() - session.last_used > self.idle_timeout:
+                    await session.close()
+                    continue
+                try:
+                    if (await session.docmd("NOOP"))[0] == 250:
+                        session.reused = True
+                        self.reused += 1
+                        return session
+                except (smtplib.SMTPException, OSError):
+                    pass
+                session.abort()
+
+            session = await self._connect()
+            self.created += 1
+            return session
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, session: _AsyncSMTP, discard: bool = False) -> None:
+        if discard:
+            session.abort()
+        else:
+            session.last_used = time.monotonic()
+            self._idle.append(session)
+        self._slots.release()
+
+    async def _connect(self) -> _AsyncSMTP:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.server, self.port),
+                                                self.connect_timeout)
+        session = _AsyncSMTP(reader, writer, self.command_timeout)
+        try:
+            code, reply = await session.getreply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, reply)
+            await session.ehlo(self._local_hostname)
+
+            if self.starttls:
+                if "starttls" not in session.esmtp_features:
+                    raise smtplib.SMTPNotSupportedError(
+                        "STARTTLS extension not supported by server.")
+                code, reply = await session.docmd("STARTTLS")
+                if code != 220:
+                    raise smtplib.SMTPResponseException(code, reply)
+                await asyncio.wait_for(
+                    writer.start_tls(self.tls_context, server_hostname=self.server),
+                    self.connect_timeout)
+                await session.ehlo(self._local_hostname)
+
+            await session.login(self.user, self.pswd)
+        except BaseException:
+            session.abort()
+            raise
+        return session
+
+def _b64(text: str) -> str:
+    return base64.b64encode(text.encode("utf-8")).decode("ascii")
@@ -4,6 +4,10 @@ This module defines the structure and behavior of a PDF document generation syst
 using the FPDF library. It includes classes for creating and formatting various 
 sections of a document such as titles, subtitles, body text, and consent sections.
 
+The document classes are a front end to a compiler: each one emits its drawing 
+operations into a DisplayListBuilder, which drops redundant font switches and 
+produces a flat, immutable DisplayList that can be cached and replayed onto any pdf.
+
 Classes:
 - Document: Manages the overall document structure, including the title and sections.
 - Title: Handles the title of the document.
@@ -14,6 +18,12 @@ Classes:
 - ConsentBody: Manages the body for consent sections, with options for accepted or not accepted.
 - Subtitle: Handles the subtitle of sections.
 - Body: Handles the body content of sections.
+- SetFont, Cell, MultiCell: The drawing operations stored in a display list.
+- DisplayList: Flat, immutable list of drawing operations.
+- DisplayListBuilder: Collects drawing operations and removes redundant font switches.
+
+Functions:
+- compile_document: Compiles a form document dict into a display list.
 
 Dependencies:
 - FPDF: The library used for PDF generation.
@@ -21,11 +31,99 @@ Dependencies:
 - typing: Used for type hinting.
 - abc: Provides the abstract base class functionality.
 """
-from typing import List, Dict, Any
+from typing import List, Dict, Any, NamedTuple, Optional, Tuple, Union
 from abc import ABC, abstractmethod
 from fpdf import FPDF
 from .fonts.fonts import Fonts
 
+class SetFont(NamedTuple):
+    """Switches to the font of a role in the font config (title, subtitle, body, body_bold)"""
+    role: str
+
+    def replay(self, pdf: FPDF, fonts: Fonts) -> None:
+        """Sets the font on the pdf"""
+        getattr(fonts, f"set_to_{self.role}")(pdf)
+
+class Cell(NamedTuple):
+    """Prints a single line cell"""
+    w: float
+    h: float
+    text: str
+    ln: Union[bool, int]
+    align: str = "L"
+
+    def replay(self, pdf: FPDF) -> None:
+        """Prints the cell to the pdf"""
+        pdf.cell(self.w, self.h, text = self.text, ln = self.ln, align = self.align)
+
+class MultiCell(NamedTuple):
+    """Prints a wrapped block of text"""
+    w: float
+    h: float
+    text: str
+
+    def replay(self, pdf: FPDF) -> None:
+        """Prints the text block to the pdf"""
+        pdf.multi_cell(self.w, self.h, text = self.text)
+
+DrawOp = Union[SetFont, Cell, MultiCell]
+
+class DisplayList:
+    """Flat, immutable list of drawing operations that can be replayed onto any pdf."""
+    def __init__(self, ops: Tuple[DrawOp, ...]):
+        self.ops = ops
+
+    def __len__(self) -> int:
+        return len(self.ops)
+
+    def replay(self, pdf: FPDF, fonts: Fonts) -> None:
+        """Replays every drawing operation onto the pdf"""
+        for op in self.ops:
+            # Only font switches need the fonts of the pdf
+            if isinstance(op, SetFont):
+                op.replay(pdf, fonts)
+            else:
+                op.replay(pdf)
+
+class DisplayListBuilder:
+    """Collects drawing operations and removes redundant font switches."""
+    def __init__(self):
+        self.ops: List[DrawOp] = []
+        self.font_role: Optional[str] = None
+
+    def set_font(self, role: str) -> None:
+        """Switches font, unless the font is already current"""
+        if role != self.font_role:
+            self.ops.append(SetFont(role))
+            self.font_role = role
+
+    def cell(self, w: float, h: float, text: str, ln: Union[bool, int],
+             align: str = "L") -> None:
+        """Adds a single line cell"""
+        self.ops.append(Cell(w, h, text, ln, align))
+
+    def space(self, h: float) -> None:
+        """Adds an empty line of the given height"""
+        self.cell(0, h, "", True)
+
+    def multi_cell(self, w: float, h: float, text: str) -> None:
+        """Adds a wrapped block of text"""
+        self.ops.append(MultiCell(w, h, text))
+
+    def build(self) -> DisplayList:
+        """Returns the operations collected so far as a display list"""
+        return DisplayList(tuple(self.ops))
+
+def _compile(element: Any) -> DisplayList:
+    builder = DisplayListBuilder()
+    element.compile(builder)
+    return builder.build()
+
+def compile_document(consent_flags: List[bool], doc: dict) -> DisplayList:
+    """Compiles a form document dict into a display list"""
+    # The tree is only compiled here, so it is not bound to a pdf or fonts
+    return _compile(Document(None, None, consent_flags, doc))
+
 class Document:
     """Manages the overall document structure, including the title and sections."""
     def __init__(self, pdf: FPDF, fonts: Fonts, consent_flags: List[bool], doc: dict):
@@ -34,10 +132,14 @@ class Document:
         self.title = Title(pdf, fonts, doc["title"])
         self.sections = Sections(pdf, fonts, consent_flags, doc["sections"])
 
+    def compile(self, builder: DisplayListBuilder) -> None:
+        """Compiles the document into drawing operations"""
+        self.title.compile(builder)
+        self.sections.compile(builder)
+
     def print(self) -> None:
         """Prints the document to the pdf"""
-        self.title.print()
-        self.sections.print()
+        _compile(self).replay(self.pdf, self.fonts)
 
 class Title:
     """Handles the title of the document."""
@@ -46,12 +148,15 @@ class Title:
         self.fonts = fonts
         self.title = title
 
+    def compile(self, builder: DisplayListBuilder) -> None:
+        """Compiles the title into drawing operations"""
+        builder.set_font("title")
+        builder.cell(200, 14, self.title, True, "C")
+        builder.space(5)
+
     def print(self) -> None:
         """Prints the title to the pdf"""
-        self.fonts.set_to_title(self.pdf)
-        self.pdf.cell(200, 14, text = self.title, ln = True, align = "C")
-        # Space
-        self.pdf.cell(0, 5, text = "", ln = True)
+        _compile(self).replay(self.pdf, self.fonts)
 
 class Section(ABC):
     """Abstract base class for different types of sections in the document."""
@@ -60,9 +165,13 @@ class Section(ABC):
         pass
 
     @abstractmethod
-    def print(self) -> None:
+    def compile(self, builder: DisplayListBuilder) -> None:
         pass
 
+    def print(self) -> None:
+        """Prints the section to the pdf"""
+        _compile(self).replay(self.pdf, self.fonts)
+
 class InfoSection(Section):
     """Concrete implementation of Section for informational content."""
     def __init__(self, pdf: FPDF, fonts: Fonts, info: Dict[str, Any]):
@@ -71,12 +180,11 @@ class InfoSection(Section):
         self.subtitle = Subtitle(pdf, fonts, info["subtitle"])
         self.body = Body(pdf, fonts, info["body"])
 
-    def print(self) -> None:
-        """Prints the info section to the pdf"""
-        self.subtitle.print()
-        self.body.print()
-        # Space
-        self.pdf.cell(0, 6, text = "", ln = True)
+    def compile(self, builder: DisplayListBuilder) -> None:
+        """Compiles the info section into drawing operations"""
+        self.subtitle.compile(builder)
+        self.body.compile(builder)
+        builder.space(6)
 
 class ConsentSection(Section):
     """Concrete implementation of Section for consent information."""
@@ -90,17 +198,15 @@ class ConsentSection(Section):
         else:
             self.footnote = Body(pdf, fonts, info["footnote"])
 
-    def print(self) -> None:
-        """Prints the consent section to the pdf"""
-        self.subtitle.print()
-        self.body.print()
-        # Space
-        self.pdf.cell(0, 3, text = "", ln = True)
+    def compile(self, builder: DisplayListBuilder) -> None:
+        """Compiles the consent section into drawing operations"""
+        self.subtitle.compile(builder)
+        self.body.compile(builder)
+        builder.space(3)
         if self.footnote is not None:
-            self.footnote.print()
+            self.footnote.compile(builder)
 
-        # Space
-        self.pdf.cell(0, 6, text = "", ln = True)
+        builder.space(6)
 
 class Sections:
     """Manages a collection of sections in the document."""
@@ -110,10 +216,14 @@ class Sections:
         self.fonts = fonts
         self.sections = self._convert_to_sections(consent_flags, sections)
 
+    def compile(self, builder: DisplayListBuilder) -> None:
+        """Compiles the sections into drawing operations"""
+        for section in self.sections:
+            section.compile(builder)
+
     def print(self) -> None:
         """Prints the sections to the pdf"""
-        for section in self.sections:
-            section.print()
+        _compile(self).replay(self.pdf, self.fonts)
 
     def _convert_to_sections(self, consent_flags: List[bool],
                              sections: List[Dict[str, Any]]) -> List[Section]:
@@ -139,28 +249,26 @@ class ConsentBody:
         self.accepted = accepted
         self.body = body
 
-    def print(self) -> None:
-        """Prints the consent body to the pdf"""
+    def compile(self, builder: DisplayListBuilder) -> None:
+        """Compiles the consent body into drawing operations"""
         if self.accepted:
-            self.fonts.set_to_body_bold(self.pdf)
-            self.pdf.cell(24, 5, text = "[X] I CONSENT", ln = 0, align = "L")
-            self.fonts.set_to_body(self.pdf)
-            self.pdf.cell(0, 5, text = f"{self.body}", ln = True, align = "L")
-
-            self.fonts.set_to_body_bold(self.pdf)
-            self.pdf.cell(38, 5, text = "[   ] I DO NOT CONSENT", ln = 0, align = "L")
-            self.fonts.set_to_body(self.pdf)
-            self.pdf.cell(0, 5, text = f"{self.body}", ln = True, align = "L")
+            consent, no_consent = "[X] I CONSENT", "[   ] I DO NOT CONSENT"
         else:
-            self.fonts.set_to_body_bold(self.pdf)
-            self.pdf.cell(24, 5, text = "[   ] I CONSENT", ln = 0, align = "L")
-            self.fonts.set_to_body(self.pdf)
-            self.pdf.cell(0, 5, text = f"{self.body}", ln = True, align = "L")
+            consent, no_consent = "[   ] I CONSENT", "[X] I DO NOT CONSENT"
 
-            self.fonts.set_to_body_bold(self.pdf)
-            self.pdf.cell(38, 5, text = "[X] I DO NOT CONSENT", ln = 0, align = "L")
-            self.fonts.set_to_body(self.pdf)
-            self.pdf.cell(0, 5, text = f"{self.body}", ln = True, align = "L")
+        builder.set_font("body_bold")
+        builder.cell(24, 5, consent, 0)
+        builder.set_font("body")
+        builder.cell(0, 5, f"{self.body}", True)
+
+        builder.set_font("body_bold")
+        builder.cell(38, 5, no_consent, 0)
+        builder.set_font("body")
+        builder.cell(0, 5, f"{self.body}", True)
+
+    def print(self) -> None:
+        """Prints the consent body to the pdf"""
+        _compile(self).replay(self.pdf, self.fonts)
 
 class Subtitle:
     """Handles the subtitle of sections."""
@@ -169,12 +277,15 @@ class Subtitle:
         self.fonts = fonts
         self.subtitle = subtitle
 
+    def compile(self, builder: DisplayListBuilder) -> None:
+        """Compiles the subtitle into drawing operations"""
+        builder.set_font("subtitle")
+        builder.cell(0, 5, self.subtitle, True)
+        builder.space(2)
+
     def print(self) -> None:
         """Prints the subtitle to the pdf"""
-        self.fonts.set_to_subtitle(self.pdf)
-        self.pdf.cell(0, 5, text = self.subtitle, ln = True, align = "L")
-        # Space
-        self.pdf.cell(0, 2, text = "", ln = True)
+        _compile(self).replay(self.pdf, self.fonts)
 
 class Body:
     """Handles the body content of sections."""
@@ -183,7 +294,11 @@ class Body:
         self.fonts = fonts
         self.body = body
 
+    def compile(self, builder: DisplayListBuilder) -> None:
+        """Compiles the body into drawing operations"""
+        builder.set_font("body")
+        builder.multi_cell(0, 5, self.body)
+
     def print(self) -> None:
         """Prints the body to the pdf"""
-        self.fonts.set_to_body(self.pdf)
-        self.pdf.multi_cell(0, 5, text = self.body)
+        _compile(self).replay(self.pdf, self.fonts)
@@ -0,0 +1,202 @@
+"""Module for rendering the email templates.
+
+The clinic and patient emails are HTML templates in the email text folder, with
+{{ name }} slots for the details of a submission. This module loads each template
+once, minifies it, derives a matching plain text version, and splits both into their
+static text and slots, so rendering an email only escapes the values and joins the
+pieces. Dates are formatted without strftime, so the emails do not depend on the
+locale of the server.
+
+Classes:
+- RenderedEmail: The HTML and plain text bodies of a rendered email.
+- EmailTemplate: A compiled email template.
+- EmailTemplateRegistry: Loads, compiles and caches the email templates.
+
+Functions:
+- format_date: Formats a date like "July 01, 2024".
+- format_time: Formats a time like " 9:30 AM".
+
+Constants:
+- EMAIL_TEXT_FOLDER: Directory containing the email templates.
+- EMAIL_TEMPLATES: The registry shared by the whole process.
+
+Exception Handling:
+- FileNotFoundError is raised when an email has no template.
+- ValueError is raised when a template is rendered without a value for one of its slots.
+"""
+import html
+import logging
+import os
+import re
+import threading
+from datetime import datetime
+from html.parser import HTMLParser
+from typing import Dict, List, NamedTuple, Tuple
+
+EMAIL_TEXT_FOLDER = "src/email_text"
+
+SLOT_PATTERN = re.compile(r"\{\{\s*([A-Za-z_]\w*)\s*\}\}")
+STYLE_PATTERN = re.compile(r'style="([^"]*)"')
+
+MONTHS = ("January", "February", "March", "April", "May", "June", "July", "August",
+          "September", "October", "November", "December")
+
+# Elements that start a new line in the plain text version
+BLOCK_TAGS = {"br", "div", "h1", "h2", "h3", "h4", "h5", "h6", "li", "p", "tr", "ul", "ol"}
+# Elements whose content is not part of the plain text version
+HIDDEN_TAGS = {"head", "script", "style", "title"}
+
+def format_date(value: datetime) -> str:
+    """Formats a date like "July 01, 2024", the same as strftime("%B %d, %Y") in English"""
+    return f"{MONTHS[value.month - 1]} {value.day:02d}, {value.year}"
+
+def format_time(value: datetime) -> str:
+    """Formats a time like " 9:30 AM", the same as strftime("%l:%M %p") in English"""
+    hour = value.hour % 12 or 12
+    return f"{hour:2d}:{value.minute:02d} {'AM' if value.hour < 12 else 'PM'}"
+
+class RenderedEmail(NamedTuple):
+    """The HTML and plain text bodies of a rendered email."""
+    html: str
+    text: str
+
+class _Compiled(NamedTuple):
+    """The static text of a template around its slots, which there is one fewer of."""
+    parts: Tuple[str, ...]
+    slots: Tuple[str, ...]
+
+class EmailTemplate:
+    """
+    A compiled email template.
+
+    Values are HTML escaped in the HTML body and inserted as they are in the plain
+    text body.
+    """
+    def __init__(self, name: str, source: str):
+        self.name = name
+        minified = _minify(source)
+        self._html = _compile(minified)
+        self._text = _compile(_to_text(minified))
+        # The names of the values the template needs
+        self.slots: Tuple[str, ...] = tuple(dict.fromkeys(self._html.slots + self._text.slots))
+
+    def render(self, **values: str) -> RenderedEmail:
+        """Fills the slots of the template with the given values"""
+        try:
+            escaped = {slot: html.escape(str(values[slot])) for slot in self.slots}
+        except KeyError:
+            missing = [slot for slot in self.slots if slot not in values]
+            raise ValueError(f"Missing values for email template {self.name}: "
+                             f"{', '.join(missing)}") from None
+
+        return RenderedEmail(_join(self._html, escaped), _join(self._text, values))
+
+class EmailTemplateRegistry:
+    """Loads, compiles and caches the email templates in a folder."""
+    def __init__(self, folder: str = EMAIL_TEXT_FOLDER):
+        self.folder = folder
+        self._templates: Dict[str, EmailTemplate] = {}
+        self._lock = threading.Lock()
+
+    def load_all(self) -> None:
+        """Loads and compiles every template in the folder"""
+        for file_name in sorted(os.listdir(self.folder)):
+            name, ext = os.path.splitext(file_name)
+            if ext == ".html":
+                self.get(name)
+
+        logging.info("Loaded email templates: %s", ", ".join(sorted(self._templates)))
+
+    def get(self, name: str) -> EmailTemplate:
+        """Returns a compiled template, loading it the first time it is used"""
+        template = self._templates.get(name)
+        if template is not None:
+            return template
+
+        with self._lock:
+            template = self._templates.get(name)
+            if template is None:
+                path = os.path.join(self.folder, f"{os.path.basename(name)}.html")
+                try:
+                    with open(path, "r", encoding="utf-8") as file:
+                        template = EmailTemplate(name, file.read())
+                except FileNotFoundError:
+                    raise FileNotFoundError(f"Email template is not available: {name}") from None
+                self._templates[name] = template
+            return template
+
+    def render(self, name: str, **values: str) -> RenderedEmail:
+        """Renders a template, see EmailTemplate.render"""
+        return self.get(name).render(**values)
+
+EMAIL_TEMPLATES = EmailTemplateRegistry()
+
+def _minify(source: str) -> str:
+    """
+    Drops indentation, blank lines, comments and the spaces in tags and style
+    attributes. Line breaks are kept, as mail servers may reject lines longer than
+    998 characters.
+    """
+    def compact_style(match: re.Match) -> str:
+        declarations = [declaration.split(":", 1) for declaration in match.group(1).split(";")
+                        if declaration.strip()]
+        style = ";".join(f"{prop.strip()}:{' '.join(value.split())}"
+                         for prop, value in declarations)
+        return f'style="{style}"'
+
+    source = re.sub(r"<!--.*?-->", "", source, flags=re.S)
+    # Tags split over several lines are joined
+    source = re.sub(r"<[^<>]+>",
+                    lambda match: re.sub(r"\s+", " ", match.group(0)).replace(" >", ">"),
+                    source)
+    source = STYLE_PATTERN.sub(compact_style, source)
+    lines = (line.strip() for line in source.splitlines())
+    return "\n".join(line for line in lines if line)
+
+class _TextExtractor(HTMLParser):
+    """Collects the visible text of an HTML document, a line per block element."""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks: List[str] = []
+        self._hidden = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in HIDDEN_TAGS:
+            self._hidden += 1
+        elif tag in BLOCK_TAGS:
+            self.chunks.append("\n")
+            if tag == "li":
+                self.chunks.append("- ")
+
+    def handle_endtag(self, tag):
+        if tag in HIDDEN_TAGS:
+            self._hidden -= 1
+        elif tag in BLOCK_TAGS and tag != "li":
+            # List items follow each other without a blank line
+            self.chunks.append("\n")
+
+    def handle_data(self, data):
+        if not self._hidden:
+            self.chunks.append(re.sub(r"\s+", " ", data))
+
+def _to_text(source: str) -> str:
+    """Returns a plain text version of an HTML template, keeping its slots"""
+    extractor = _TextExtractor()
+    extractor.feed(source)
+    extractor.close()
+
+    lines = [" ".join(line.split()) for line in "".join(extractor.chunks).split("\n")]
+    text = "\n".join(lines)
+    # At most one blank line between paragraphs
+    return re.sub(r"\n{3,}", "\n\n", text).strip() + "\n"
+
+def _compile(source: str) -> _Compiled:
+    pieces = SLOT_PATTERN.split(source)
+    return _Compiled(tuple(pieces[0::2]), tuple(pieces[1::2]))
+
+def _join(compiled: _Compiled, values: Dict[str, str]) -> str:
+    chunks = [compiled.parts[0]]
+    for slot, part in zip(compiled.slots, compiled.parts[1:]):
+        chunks.append(values[slot])
+        chunks.append(part)
+    return "".join(chunks)
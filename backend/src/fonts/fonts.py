@@ -2,9 +2,20 @@
 This module provides functionality for loading and applying custom fonts to an FPDF object.
 
 Classes:
+- FontRegistry:
+    Process-wide cache of parsed TrueType fonts. Each font file is parsed once and
+    a lightweight per-document copy is attached to every new FPDF object. Fonts can
+    also be subset ahead of time to the characters the forms use, so documents that
+    only use those characters are subset from a much smaller font when output.
 - Fonts:
     Loads font configurations from a JSON file and
-    provides methods to set these fonts for an FPDF object.
+    provides methods to set these fonts for an FPDF object. With the core render
+    profile the roles are mapped to the built-in PDF core fonts instead, which are
+    neither loaded, subset nor embedded. Text in a script the fonts do not cover is
+    printed in a fallback font for that script, loaded only when it is first needed.
+
+Functions:
+- detect_scripts: Returns the scripts of the characters in a text.
 
 Constants:
 - TITLE_SIZE (int): The font size for titles.
@@ -12,15 +23,36 @@ Constants:
 - BODY_SIZE (int): The font size for body text.
 - FONTS_FOLDER (str): The folder path where the font files are stored.
 - FONTS_FILE (str): The JSON file name containing font configurations.
+- FALLBACK_FOLDER (str): The folder path where the fallback font files are installed,
+  set with the FALLBACK_FONTS_FOLDER environment variable.
+- LATIN_CHARACTERS (str): The Latin characters kept in the ahead of time subsets,
+  for names and dates.
+- PROFILE_EMBEDDED (str): The render profile using the embedded TrueType fonts.
+- PROFILE_CORE (str): The lightweight render profile using the PDF core fonts.
+- RENDER_PROFILES (tuple): Every render profile.
+- CORE_FONTS_ENCODING (str): The encoding of text printed in the PDF core fonts.
+- FONT_REGISTRY (FontRegistry): The registry shared by every Fonts object in the process.
+- FALLBACK_REGISTRY (FontRegistry): The registry of fallback fonts, which is never warmed up.
 
 Exception Handling:
 - The module handles FileNotFoundError and json.JSONDecodeError 
   when loading the font configuration file.
-- RuntimeError is handled when setting a font that is not found.
+- RuntimeError and FileNotFoundError are handled when setting a font that is not found.
+- A fallback font that is not installed is logged once and the text is printed without it.
 """
+import copy
 import json
 import logging
+import os
+import threading
+import unicodedata
+from collections import defaultdict
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, FrozenSet, Iterable, List, Optional
+from fontTools import subset as ftsubset, ttLib
 from fpdf import FPDF
+from fpdf.fonts import SubsetMap, TTFFont
 
 TITLE_SIZE = 16
 SUBTITLE_SIZE = 14
@@ -28,11 +60,220 @@ BODY_SIZE = 10
 
 FONTS_FOLDER = "src/fonts"
 FONTS_FILE = "font_config.json"
+# The Docker image installs the Noto and Droid Sans Fallback fonts here, see the Dockerfile
+FALLBACK_FOLDER = os.getenv("FALLBACK_FONTS_FOLDER", "src/fonts/fallback")
+
+# Basic Latin, Latin-1 Supplement and Latin Extended-A and B
+LATIN_CHARACTERS = "".join(chr(code) for code in range(0x20, 0x250))
+
+PROFILE_EMBEDDED = "embedded"
+PROFILE_CORE = "core"
+RENDER_PROFILES = (PROFILE_EMBEDDED, PROFILE_CORE)
+
+# fpdf2 writes core fonts with WinAnsiEncoding
+CORE_FONTS_ENCODING = "windows-1252"
+
+# Scripts and fallback fonts already reported missing, so each is logged once
+_REPORTED_MISSING = set()
+
+class FontRegistry:
+    """
+    Process-wide cache of parsed TrueType fonts.
+
+    Parsing a TTF (cmap, metrics and descriptor tables) is the largest fixed cost of
+    rendering a consent form. The registry parses each font once and keeps the result
+    as a template. Attaching a font to an FPDF object copies the template and gives the
+    copy its own glyph subset and a lazily loaded font file, since fpdf2 subsets and
+    closes the font file of each document when it is output.
+    """
+    def __init__(self, fonts_folder: str = FONTS_FOLDER):
+        self.fonts_folder = fonts_folder
+        self.hits: Dict[str, int] = defaultdict(int)
+        self.misses: Dict[str, int] = defaultdict(int)
+        self._templates: Dict[str, TTFFont] = {}
+        self._font_bytes: Dict[str, bytes] = {}
+        self._subset_bytes: Dict[str, bytes] = {}
+        self._subset_glyphs: Dict[str, FrozenSet[str]] = {}
+        self.subset_hits = 0
+        self.subset_misses = 0
+        self._lock = threading.Lock()
+
+    def warm_up(self, font_names: Optional[Iterable[str]] = None) -> None:
+        """Parses the given fonts, or every TTF in the fonts folder, ahead of time"""
+        if font_names is None:
+            font_names = self._font_names()
+
+        for font_name in font_names:
+            with self._lock:
+                if font_name not in self._templates:
+                    self._parse(font_name)
+
+        logging.info("Font registry warmed up with %d fonts", len(self._templates))
+
+    def attach(self, pdf: FPDF, font_name: str) -> None:
+        """Makes a parsed font available to set_font on the given FPDF object"""
+        fontkey = font_name.lower()
+        if fontkey in pdf.fonts:
+            return
+
+        template = self._get_template(font_name)
+        font = copy.copy(template)
+        font.i = len(pdf.fonts) + 1
+        font.ttfont = self.open_font_file(font_name)
+        font.desc = copy.copy(template.desc)
+        font.missing_glyphs = []
+
+        # Same reserved characters as fpdf2's TTFFont constructor
+        reserved = "\x00 \r\n"
+        if pdf.str_alias_nb_pages:
+            reserved += "0123456789" + pdf.str_alias_nb_pages
+        font.subset = SubsetMap(font, [ord(char) for char in reserved])
+
+        pdf.fonts[fontkey] = font
+
+    def open_font_file(self, font_name: str) -> ttLib.TTFont:
+        """Returns a new lazily loaded font file for one document to subset"""
+        font_bytes = self._font_bytes.get(font_name)
+        if font_bytes is None:
+            self._get_template(font_name)
+            font_bytes = self._font_bytes[font_name]
+        return ttLib.TTFont(BytesIO(font_bytes), recalcTimestamp=False, fontNumber=0, lazy=True)
+
+    def build_subsets(self, characters: str, font_names: Optional[Iterable[str]] = None) -> None:
+        """Subsets the given fonts, or every TTF in the fonts folder, to the given characters"""
+        # The reserved characters of fpdf2's TTFFont constructor are in every document
+        unicodes = sorted({ord(char) for char in characters + "\x00 \r\n0123456789"})
+
+        if font_names is None:
+            font_names = self._font_names()
+
+        with self._lock:
+            for font_name in font_names:
+                if font_name not in self._templates:
+                    self._parse(font_name)
+                font_file = ttLib.TTFont(BytesIO(self._font_bytes[font_name]),
+                                         recalcTimestamp=False, fontNumber=0)
+                # Glyph names are kept, fpdf2 subsets the font again by glyph name
+                options = self._subset_options()
+                options.glyph_names = True
+                subsetter = ftsubset.Subsetter(options)
+                subsetter.populate(unicodes=unicodes)
+                subsetter.subset(font_file)
+
+                output = BytesIO()
+                font_file.save(output)
+                self._subset_bytes[font_name] = output.getvalue()
+                self._subset_glyphs[font_name] = frozenset(font_file.getGlyphOrder())
+                font_file.close()
+
+                logging.info("Subset %s to %d glyphs", font_name,
+                             len(self._subset_glyphs[font_name]))
+
+    def use_subsets(self, pdf: FPDF) -> None:
+        """
+        Swaps the font files of a document for the ahead of time subsets before it is output.
+
+        A font keeps its full font file if the document uses a glyph the subset does not have.
+        """
+        for font in pdf.fonts.values():
+            if font.type != "TTF":
+                continue
+
+            font_name = Path(font.ttffile).stem
+            glyphs = self._subset_glyphs.get(font_name)
+            if glyphs is None:
+                continue
+
+            if glyphs.issuperset(font.subset.get_all_glyph_names()):
+                font.ttfont = ttLib.TTFont(BytesIO(self._subset_bytes[font_name]),
+                                           recalcTimestamp=False, fontNumber=0, lazy=True)
+                self.subset_hits += 1
+            else:
+                self.subset_misses += 1
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Returns the hit and miss counters for each font"""
+        font_names = sorted(set(self.hits) | set(self.misses))
+        return {name: {"hits": self.hits[name], "misses": self.misses[name]}
+                for name in font_names}
+
+    def clear(self) -> None:
+        """Drops every parsed font and resets the counters"""
+        with self._lock:
+            self._templates.clear()
+            self._font_bytes.clear()
+            self._subset_bytes.clear()
+            self._subset_glyphs.clear()
+            self.hits.clear()
+            self.misses.clear()
+            self.subset_hits = 0
+            self.subset_misses = 0
+
+    def _font_names(self) -> List[str]:
+        return [os.path.splitext(file)[0]
+                for file in sorted(os.listdir(self.fonts_folder))
+                if file.lower().endswith(".ttf")]
+
+    def _get_template(self, font_name: str) -> TTFFont:
+        with self._lock:
+            template = self._templates.get(font_name)
+            if template is None:
+                return self._parse(font_name)
+            self.hits[font_name] += 1
+            return template
+
+    @staticmethod
+    def _subset_options() -> ftsubset.Options:
+        """Returns the subsetting options fpdf2 uses when a document is output"""
+        options = ftsubset.Options(notdef_outline=True, recommended_glyphs=True)
+        options.drop_tables += ["FFTM", "GDEF", "GPOS", "GSUB", "MATH", "hdmx", "meta"]
+        return options
+
+    def _parse(self, font_name: str) -> TTFFont:
+        font_path = f"{self.fonts_folder}/{font_name}.ttf"
+        if not os.path.exists(font_path):
+            raise FileNotFoundError(f"TTF Font file not found: {font_path}")
+
+        with open(font_path, "rb") as file:
+            self._font_bytes[font_name] = file.read()
+
+        template = TTFFont(FPDF(), font_path, font_name.lower(), "")
+        # The template keeps only the parsed metrics, each document gets its own file
+        template.ttfont.close()
+        self._templates[font_name] = template
+        self.misses[font_name] += 1
+        return template
+
+FONT_REGISTRY = FontRegistry()
+FALLBACK_REGISTRY = FontRegistry(FALLBACK_FOLDER)
+
+def detect_scripts(text: str) -> List[str]:
+    """
+    Returns the scripts of the characters in a text, in order of first appearance.
+
+    The script of a character is the first word of its Unicode name, e.g. LATIN,
+    CYRILLIC, ARABIC, CJK or HANGUL.
+    """
+    scripts = []
+    for char in text:
+        name = unicodedata.name(char, "")
+        script = name.split(" ", 1)[0]
+        if script and script not in scripts:
+            scripts.append(script)
+    return scripts
 
 class Fonts:
     """Loads fonts from FONT_CONFIG json file into class"""
-    def __init__(self):
+    def __init__(self, registry: FontRegistry = FONT_REGISTRY, profile: str = PROFILE_EMBEDDED,
+                 fallback_registry: FontRegistry = FALLBACK_REGISTRY):
+        if profile not in RENDER_PROFILES:
+            raise ValueError(f"Unknown render profile: {profile}")
+
         self.added_fonts = set()
+        self.registry = registry
+        self.fallback_registry = fallback_registry
+        self.profile = profile
+        self.styles: Dict[str, str] = {}
         try:
             with open(f"{FONTS_FOLDER}/{FONTS_FILE}", "r", encoding="utf-8") as file:
                 font_dict = json.load(file)
@@ -40,33 +281,87 @@ class Fonts:
                 self.subtitle = font_dict["subtitle"]
                 self.body = font_dict["body"]
                 self.body_bold = font_dict["body_bold"]
-        except (FileNotFoundError, json.JSONDecodeError) as e:
+                self.fallback: Dict[str, str] = font_dict.get("fallback", {})
+                if profile == PROFILE_CORE:
+                    for role, core_font in font_dict["core"].items():
+                        setattr(self, role, core_font["family"])
+                        self.styles[role] = core_font["style"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError) as e:
             logging.error("Cannot read font config file: %s", e)
             raise
 
+    def can_encode(self, text: str) -> bool:
+        """Checks whether the fonts of the profile can print the given text"""
+        if self.profile != PROFILE_CORE:
+            return True
+        try:
+            text.encode(CORE_FONTS_ENCODING)
+        except UnicodeEncodeError:
+            return False
+        return True
+
+    def set_fallback_fonts(self, pdf: FPDF, text: str) -> List[str]:
+        """
+        Sets the fallback fonts for the characters of the text the current font does not have.
+
+        Fallback fonts are only attached to documents that need them, so text the current
+        font covers costs nothing extra. Returns the names of the fallback fonts set.
+        """
+        font = pdf.current_font
+        uncovered = "" if font is None or font.type != "TTF" else \
+            "".join(char for char in text if ord(char) not in font.glyph_ids)
+
+        font_names = []
+        for script in detect_scripts(uncovered):
+            font_name = self.fallback.get(script)
+            if font_name is None:
+                if script not in _REPORTED_MISSING:
+                    _REPORTED_MISSING.add(script)
+                    logging.warning("No fallback font for %s text", script)
+                continue
+            try:
+                self.fallback_registry.attach(pdf, font_name)
+            except (RuntimeError, FileNotFoundError) as e:
+                if font_name not in _REPORTED_MISSING:
+                    _REPORTED_MISSING.add(font_name)
+                    logging.warning("Fallback font %s for %s text is not available: %s",
+                                    font_name, script, e)
+                continue
+            if font_name not in font_names:
+                font_names.append(font_name)
+
+        pdf.set_fallback_fonts(font_names, exact_match=False)
+        return font_names
+
     def set_to_title(self, pdf: FPDF):
         """Sets current font to title font"""
-        self._set_to_font(pdf, TITLE_SIZE, self.title)
+        self._set_to_font(pdf, TITLE_SIZE, self.title, self.styles.get("title", ""))
 
     def set_to_subtitle(self, pdf: FPDF):
         """Sets current font to subtitle font"""
-        self._set_to_font(pdf, SUBTITLE_SIZE, self.subtitle)
+        self._set_to_font(pdf, SUBTITLE_SIZE, self.subtitle, self.styles.get("subtitle", ""))
 
     def set_to_body(self, pdf: FPDF):
         """Sets current font to body font"""
-        self._set_to_font(pdf, BODY_SIZE, self.body)
+        self._set_to_font(pdf, BODY_SIZE, self.body, self.styles.get("body", ""))
 
     def set_to_body_bold(self, pdf: FPDF):
         """Sets current font to body bold font"""
-        self._set_to_font(pdf, BODY_SIZE, self.body_bold)
+        self._set_to_font(pdf, BODY_SIZE, self.body_bold, self.styles.get("body_bold", ""))
+
+    def _set_to_font(self, pdf: FPDF, size: int, font_name: str, style: str = ""):
+        if self.profile == PROFILE_CORE:
+            # Core fonts are built into every PDF viewer and need no font file
+            pdf.core_fonts_encoding = CORE_FONTS_ENCODING
+            pdf.set_font(font_name, style, size=size)
+            return
 
-    def _set_to_font(self, pdf: FPDF, size: int, font_name: str):
         try:
             if font_name not in self.added_fonts:
-                pdf.add_font(font_name, "", f"{FONTS_FOLDER}/{font_name}.ttf", uni=True)
+                self.registry.attach(pdf, font_name)
                 self.added_fonts.add(font_name)
                 
             pdf.set_font(font_name, size=size)
-        except RuntimeError as e:
+        except (RuntimeError, FileNotFoundError) as e:
             logging.error("Font %s not found: %s", font_name, e)
             raise
@@ -0,0 +1,165 @@
+"""Module for loading the form templates.
+
+This module loads every form template in the form text folder once, validates its
+structure, and serves the parsed templates from memory. Each template is checked
+against the modification time of its file at most once per check interval, and a
+changed file is reloaded and swapped in atomically, so forms can be edited or added
+without restarting the server.
+
+Classes:
+- FormTemplate: A parsed and validated form template.
+- TemplateRegistry: Loads, validates and caches the form templates.
+
+Constants:
+- TEXT_FOLDER: Directory containing form text configuration files.
+- CHECK_INTERVAL: Minimum number of seconds between modification time checks of a file.
+- TEMPLATE_REGISTRY: The registry shared by the whole process.
+
+Exception Handling:
+- FileNotFoundError is raised when a form type has no template.
+- json.JSONDecodeError and ValueError are raised when a template cannot be parsed or
+  does not have the expected structure. A template that fails to reload is logged and
+  the last good version keeps being served.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+TEXT_FOLDER = "src/form_text"
+CHECK_INTERVAL = 1.0
+
+FORM_TYPE_PATTERN = r"^[A-Za-z0-9_-]+$"
+
+def _strings(value: Any) -> List[str]:
+    """Returns every string in a parsed JSON value"""
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, list):
+        return [string for item in value for string in _strings(item)]
+    return []
+
+class FormTemplate(NamedTuple):
+    """A parsed and validated form template."""
+    form_type: str
+    document: Dict[str, Any]
+    consent_keys: Tuple[str, ...]
+    version: int
+    characters: str = ""
+
+class TemplateRegistry:
+    """Loads, validates and caches the form templates in a folder."""
+    def __init__(self, folder: str = TEXT_FOLDER, check_interval: float = CHECK_INTERVAL):
+        self.folder = folder
+        self.check_interval = check_interval
+        self._templates: Dict[str, FormTemplate] = {}
+        self._checked: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def load_all(self) -> None:
+        """Loads and validates every template in the folder"""
+        for file_name in sorted(os.listdir(self.folder)):
+            form_type, ext = os.path.splitext(file_name)
+            if ext == ".json" and re.match(FORM_TYPE_PATTERN, form_type):
+                self.get(form_type)
+
+        logging.info("Loaded form templates: %s", ", ".join(self.form_types()))
+
+    def get(self, form_type: str) -> FormTemplate:
+        """Returns the template of a form type, reloading it if its file has changed"""
+        if not isinstance(form_type, str) or not re.match(FORM_TYPE_PATTERN, form_type):
+            raise FileNotFoundError(f"Form type is not available: {form_type}")
+
+        template = self._templates.get(form_type)
+        now = time.monotonic()
+        if template is not None and now - self._checked.get(form_type, 0) < self.check_interval:
+            return template
+
+        with self._lock:
+            template = self._templates.get(form_type)
+            self._checked[form_type] = now
+            try:
+                version = os.stat(self._path(form_type)).st_mtime_ns
+            except FileNotFoundError:
+                self._templates.pop(form_type, None)
+                raise FileNotFoundError(f"Form type is not available: {form_type}") from None
+
+            if template is None or template.version != version:
+                template = self._reload(form_type, version, template)
+
+            return template
+
+    def form_types(self) -> List[str]:
+        """Returns the form types that have a template"""
+        return sorted(self._templates)
+
+    def characters(self) -> str:
+        """Returns every character in the text of the loaded templates"""
+        characters = set()
+        for template in self._templates.values():
+            characters.update(template.characters)
+        return "".join(sorted(characters))
+
+    def consent_keys(self) -> List[str]:
+        """Returns the consent keys used by any template"""
+        return sorted({key for template in self._templates.values()
+                       for key in template.consent_keys})
+
+    def _path(self, form_type: str) -> str:
+        return f"{self.folder}/{form_type}.json"
+
+    def _reload(self, form_type: str, version: int,
+                current: Optional[FormTemplate]) -> FormTemplate:
+        try:
+            with open(self._path(form_type), "r", encoding="utf-8") as file:
+                form_dict = json.load(file)
+            consent_keys = self._validate(form_dict)
+            characters = "".join(sorted(set("".join(_strings(form_dict["document"])))))
+            template = FormTemplate(form_type, form_dict["document"], consent_keys,
+                                    version, characters)
+        except (FileNotFoundError, json.JSONDecodeError, ValueError) as e:
+            logging.error("Cannot read %s config file: %s", form_type, e)
+            if current is None:
+                raise
+            return current
+
+        self._templates[form_type] = template
+        if current is not None:
+            logging.info("Reloaded %s form template", form_type)
+
+        return template
+
+    @staticmethod
+    def _validate(form_dict: Any) -> Tuple[str, ...]:
+        """Checks the structure of a template and returns its consent keys in order"""
+        document = form_dict.get("document") if isinstance(form_dict, dict) else None
+        if not isinstance(document, dict) or not isinstance(document.get("title"), str):
+            raise ValueError("Template must have a document with a title")
+
+        sections = document.get("sections")
+        if not isinstance(sections, list):
+            raise ValueError("Template document must have a list of sections")
+
+        consent_keys = []
+        for section in sections:
+            if not isinstance(section, dict) or section.get("type") not in ("info", "consent"):
+                raise ValueError(f"Invalid section: {section}")
+            if not isinstance(section.get("subtitle"), str) or \
+                    not isinstance(section.get("body"), str):
+                raise ValueError(f"Section must have a subtitle and body: {section}")
+            if section["type"] == "consent":
+                if not isinstance(section.get("key"), str) or section["key"] in consent_keys:
+                    raise ValueError(f"Consent section must have a unique key: {section}")
+                if "footnote" not in section or \
+                        not isinstance(section["footnote"], (str, type(None))):
+                    raise ValueError(f"Consent section must have a footnote or null: {section}")
+                consent_keys.append(section["key"])
+
+        return tuple(consent_keys)
+
+TEMPLATE_REGISTRY = TemplateRegistry()
@@ -0,0 +1,182 @@
+"""Module for sending emails through an HTTP mail API.
+
+Every SMTP session starts with a TCP, TLS and AUTH handshake before the first
+message. This module provides a mail transport for SendEmail that posts the emails
+to a Resend-style HTTP API instead, over a pool of keep-alive HTTPS connections, so
+consecutive emails reuse a connection and skip the handshakes. Emails without an
+attachment are sent together in batch requests. The Resend client library opens a
+new connection for every request, so the API is called with a requests session.
+
+Classes:
+- HTTPTransport: Sends emails through a Resend-style HTTP API.
+- MailAPIError: An error reply from the mail API.
+
+Constants:
+- HTTP_API_URL: The default address of the mail API.
+- HTTP_POOL_SIZE: The default number of keep-alive connections to the mail API.
+- HTTP_TIMEOUT: The default seconds to connect to the API and to wait for its reply.
+- BATCH_SIZE: The largest number of emails sent in one batch request.
+
+Exception Handling:
+- MailAPIError is returned as the error of an email the API rejects, and
+  requests.RequestException when the API cannot be reached.
+"""
+import base64
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import requests
+from requests.adapters import HTTPAdapter
+from .rate_limit import MailRateLimiter
+from .send_email import DeliveryResult, MailTransport, OutgoingEmail
+
+HTTP_API_URL = "https://api.resend.com"
+HTTP_POOL_SIZE = 4
+HTTP_TIMEOUT = (5.0, 30.0)
+BATCH_SIZE = 100
+
+class MailAPIError(Exception):
+    """An error reply from the mail API."""
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"{status_code} {message}")
+        self.status_code = status_code
+        self.message = message
+
+    @property
+    def transient(self) -> bool:
+        """Whether the email may be accepted if it is sent again later"""
+        return self.status_code in (408, 429) or self.status_code >= 500
+
+class HTTPTransport(MailTransport):
+    """
+    Sends emails through a Resend-style HTTP API.
+
+    Emails with an attachment are posted one at a time, as batch requests do not take
+    attachments, and the others in batches of up to BATCH_SIZE. Failed requests are not
+    retried here, that is left to the outbox, except a request the API throttles, which
+    is sent once more after the rate_limiter has slowed down. The API limits requests
+    rather than emails, so a batch takes a single token from the rate limiter.
+    """
+    def __init__(self, api_key: str, api_url: str = HTTP_API_URL,
+                 pool_size: int = HTTP_POOL_SIZE, timeout: Tuple[float, float] = HTTP_TIMEOUT,
+                 rate_limiter: Optional[MailRateLimiter] = None):
+        self.api_url = api_url.rstrip("/")
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.requests = 0
+        self.batches = 0
+        self._lock = threading.Lock()
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self._session = requests.Session()
+        self._session.mount("http://", self._adapter)
+        self._session.mount("https://", self._adapter)
+        self._session.headers["Authorization"] = f"Bearer {api_key}"
+
+    def send_emails(self, sender: str,
+                    emails: List[OutgoingEmail]) -> List[DeliveryResult]:
+        """Sends emails through the API, see MailTransport.send_emails"""
+        results: List[Optional[DeliveryResult]] = [None] * len(emails)
+        batchable = [index for index, email in enumerate(emails) if email.pdf_content is None]
+        singles = [index for index, email in enumerate(emails) if email.pdf_content is not None]
+
+        for start in range(0, len(batchable), BATCH_SIZE):
+            indexes = batchable[start:start + BATCH_SIZE]
+            if len(indexes) == 1:
+                singles.append(indexes[0])
+                continue
+            payload = [_payload(sender, emails[index]) for index in indexes]
+            with self._lock:
+                self.batches += 1
+            elapsed, error, waited = self._send(sender, "/emails/batch", payload)
+            for index in indexes:
+                results[index] = DeliveryResult(emails[index].email_to, elapsed, error, waited)
+
+        for index in sorted(singles):
+            elapsed, error, waited = self._send(sender, "/emails",
+                                                _payload(sender, emails[index]))
+            results[index] = DeliveryResult(emails[index].email_to, elapsed, error, waited)
+
+        return results
+
+    def pace(self, sender: str, count: int) -> float:
+        """
+        Waits until count requests from sender may be posted, see MailTransport.pace.
+        The emails of a submission are posted one request each, as the clinic email
+        has an attachment and the patient email would be a batch of one.
+        """
+        if self.rate_limiter is None:
+            return 0.0
+        return self.rate_limiter.prepay(self.api_url, sender, count)
+
+    def refund(self, sender: str, count: int) -> None:
+        """Gives back the turn paced for count requests, see MailTransport.refund"""
+        if self.rate_limiter is not None:
+            self.rate_limiter.refund(self.api_url, sender, count)
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the number of requests, batches and connections, and the reuse ratio"""
+        connections = sum(self._adapter.poolmanager.pools[key].num_connections
+                          for key in self._adapter.poolmanager.pools.keys())
+        return {"requests": self.requests, "batches": self.batches, "created": connections,
+                "reuse_ratio": 1 - connections / self.requests if self.requests else 0.0}
+
+    def close(self) -> None:
+        """Closes the keep-alive connections"""
+        self._session.close()
+
+    def _send(self, sender: str, path: str,
+              payload: Any) -> Tuple[float, Optional[BaseException], float]:
+        """
+        Posts a request at the rate the rate limiter allows, and returns how long it took,
+        the error it failed with and how long it waited for the rate limiter
+        """
+        if self.rate_limiter is None:
+            return (*self._post(path, payload), 0.0)
+        waited = self.rate_limiter.acquire(self.api_url, sender)
+        elapsed, error = self._post(path, payload)
+        if error is not None and self.rate_limiter.backoff(self.api_url, sender, error):
+            logging.info("The mail API is throttling, slowing down: %s", error)
+            waited += self.rate_limiter.acquire(self.api_url, sender)
+            elapsed, error = self._post(path, payload)
+        return elapsed, error, waited
+
+    def _post(self, path: str, payload: Any) -> Tuple[float, Optional[BaseException]]:
+        """Posts a request and returns how long it took and the error it failed with"""
+        with self._lock:
+            self.requests += 1
+        start = time.perf_counter()
+        try:
+            response = self._session.post(self.api_url + path, json=payload,
+                                          timeout=self.timeout)
+        except requests.RequestException as e:
+            logging.error("Unable to reach the mail API: %s", e)
+            return time.perf_counter() - start, e
+
+        elapsed = time.perf_counter() - start
+        if response.status_code >= 300:
+            try:
+                message = response.json().get("message", response.reason)
+            except ValueError:
+                message = response.reason
+            error = MailAPIError(response.status_code, message)
+            logging.error("The mail API rejected the email: %s", error)
+            return elapsed, error
+        return elapsed, None
+
+def _payload(sender: str, email: OutgoingEmail) -> Dict[str, Any]:
+    """Returns the JSON body of an email for the mail API"""
+    payload: Dict[str, Any] = {
+        "from": sender,
+        "to": [email.email_to],
+        "subject": email.subject,
+        "html": email.body,
+    }
+    if email.text is not None:
+        payload["text"] = email.text
+    if email.pdf_content is not None:
+        payload["attachments"] = [{
+            "filename": email.attach_name,
+            "content": base64.b64encode(email.pdf_content).decode("ascii"),
+        }]
+    return payload
@@ -0,0 +1,123 @@
+"""Module for caching static images.
+
+fpdf2 reads, decodes and recompresses an image file every time it is placed in a new
+FPDF object. The logo, and any other static image in a form, is the same on every
+document, so this module loads each image once, keeps the compressed, PDF ready image
+data, and shares it with every document that places the image. An image can also be
+encoded with another filter, e.g. as a JPEG for small documents, and swapped into a
+document before it is output.
+
+Classes:
+- ImageRegistry: Process-wide cache of encoded static images with hit/miss counters.
+
+Constants:
+- IMAGE_REGISTRY: The registry shared by the whole process.
+
+Exception Handling:
+- FileNotFoundError is raised when an image file does not exist.
+"""
+import logging
+import os
+import threading
+from collections import defaultdict
+from typing import Any, Dict, Iterable, Tuple
+from fpdf import FPDF
+from fpdf.image_datastructures import ImageCache, RasterImageInfo
+from fpdf.image_parsing import get_img_info
+
+class ImageRegistry:
+    """
+    Process-wide cache of encoded static images.
+
+    Attaching an image to an FPDF object adds a copy of its image information to the
+    image cache of the document. The copy shares the encoded image data, and fpdf2
+    then places the image without reading the file.
+    """
+    def __init__(self):
+        self.hits: Dict[str, int] = defaultdict(int)
+        self.misses: Dict[str, int] = defaultdict(int)
+        self._images: Dict[Tuple[str, str], RasterImageInfo] = {}
+        self._lock = threading.Lock()
+
+    def warm_up(self, image_paths: Iterable[str]) -> None:
+        """Loads and encodes the given images ahead of time"""
+        for image_path in image_paths:
+            self._get_info(image_path)
+
+        logging.info("Image registry warmed up with %d images", len(self._images))
+
+    def image(self, pdf: FPDF, image_path: str, **kwargs: Any) -> RasterImageInfo:
+        """Places a static image on the given FPDF object, see FPDF.image"""
+        self.attach(pdf, image_path)
+        return pdf.image(image_path, **kwargs)
+
+    def attach(self, pdf: FPDF, image_path: str) -> None:
+        """Makes an encoded image available to FPDF.image on the given FPDF object"""
+        image_cache = pdf.image_cache
+        if image_path in image_cache.images or image_cache.image_filter != "AUTO":
+            return
+
+        info = RasterImageInfo(self._get_info(image_path))
+        info["i"] = len(image_cache.images) + 1
+        info["usages"] = 0
+        self._add_icc_profile(image_cache, info)
+        image_cache.images[image_path] = info
+
+    def use_filter(self, pdf: FPDF, image_filter: str) -> None:
+        """Swaps the static images of a document for ones encoded with the given filter"""
+        if image_filter == "AUTO":
+            return
+
+        images = pdf.image_cache.images
+        for image_path, placed in list(images.items()):
+            if (image_path, "AUTO") not in self._images:
+                continue
+
+            info = RasterImageInfo(self._get_info(image_path, image_filter))
+            info["i"] = placed["i"]
+            info["usages"] = placed["usages"]
+            self._add_icc_profile(pdf.image_cache, info)
+            images[image_path] = info
+
+    @staticmethod
+    def _add_icc_profile(image_cache: ImageCache, info: RasterImageInfo) -> None:
+        # Same ICC profile handling as fpdf2's preload_image
+        iccp = info.get("iccp")
+        info["iccp"] = None
+        info["iccp_i"] = None
+        if iccp:
+            if iccp not in image_cache.icc_profiles:
+                image_cache.icc_profiles[iccp] = len(image_cache.icc_profiles)
+            info["iccp_i"] = image_cache.icc_profiles[iccp]
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Returns the hit and miss counters for each image"""
+        image_paths = sorted(set(self.hits) | set(self.misses))
+        return {path: {"hits": self.hits[path], "misses": self.misses[path]}
+                for path in image_paths}
+
+    def clear(self) -> None:
+        """Drops every encoded image and resets the counters"""
+        with self._lock:
+            self._images.clear()
+            self.hits.clear()
+            self.misses.clear()
+
+    def _get_info(self, image_path: str, image_filter: str = "AUTO") -> RasterImageInfo:
+        with self._lock:
+            info = self._images.get((image_path, image_filter))
+            if info is None:
+                return self._load(image_path, image_filter)
+            self.hits[image_path] += 1
+            return info
+
+    def _load(self, image_path: str, image_filter: str) -> RasterImageInfo:
+        if not os.path.exists(image_path):
+            raise FileNotFoundError(f"Image file not found: {image_path}")
+
+        info = get_img_info(image_path, image_filter=image_filter)
+        self._images[(image_path, image_filter)] = info
+        self.misses[image_path] += 1
+        return info
+
+IMAGE_REGISTRY = ImageRegistry()
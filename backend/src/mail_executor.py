@@ -0,0 +1,117 @@
+"""Module for running email work on a bounded pool of threads.
+
+Sending emails on the request threads lets a burst of submissions open as many SMTP
+sessions at once as there are requests, which trips the connection limits of the
+mail provider. This module provides a single executor for the email work of the
+whole process, with a fixed number of worker threads and a bounded queue in front of
+them. Once the queue is full, callers wait for room for a short while and are then
+turned away, so a burst slows down or fails fast instead of piling up. The depth of
+the queue and how long jobs waited in it are recorded, to size the executor.
+
+Classes:
+- MailExecutor: Bounded pool of threads that runs email work.
+
+Constants:
+- MAIL_WORKERS: The default number of worker threads, one per pooled SMTP connection.
+- MAIL_QUEUE_DEPTH: The default number of jobs that may wait for a worker.
+- MAIL_QUEUE_TIMEOUT: The default number of seconds a caller waits for room in a full queue.
+
+Exception Handling:
+- MailQueueFull is raised when a job does not get into the queue in time.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Optional
+from .smtp_pool import SMTP_POOL_SIZE
+
+MAIL_WORKERS = SMTP_POOL_SIZE
+MAIL_QUEUE_DEPTH = 32
+MAIL_QUEUE_TIMEOUT = 5.0
+
+# Number of recent jobs the wait times are reported over
+_WAIT_SAMPLES = 1000
+
+class MailQueueFull(RuntimeError):
+    """Raised when the mail executor has no room for another job."""
+
+class MailExecutor:
+    """
+    Bounded pool of threads that runs email work.
+
+    At most workers jobs run at once and max_queue more wait for a worker. A caller
+    finding the queue full waits up to queue_timeout seconds for room, then gets a
+    MailQueueFull error.
+    """
+    def __init__(self, workers: int = MAIL_WORKERS, max_queue: int = MAIL_QUEUE_DEPTH,
+                 queue_timeout: float = MAIL_QUEUE_TIMEOUT):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self._waits: Deque[float] = deque(maxlen=_WAIT_SAMPLES)
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="mail")
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._lock = threading.Lock()
+
+    def submit(self, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """Queues a job and returns its future, waiting for room if the queue is full"""
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self.rejected += 1
+            logging.error("Email queue is full, %d jobs waiting and %d running",
+                          self.queued, self.running)
+            raise MailQueueFull("Too many emails are waiting to be sent, try again later")
+
+        with self._lock:
+            self.queued += 1
+        try:
+            return self._executor.submit(self._run, time.monotonic(), fn, args, kwargs)
+        except BaseException:
+            with self._lock:
+                self.queued -= 1
+            self._slots.release()
+            raise
+
+    def run(self, fn: Callable[..., Any], *args, timeout: Optional[float] = None,
+            **kwargs) -> Any:
+        """Runs a job on a worker thread and returns its result, see submit"""
+        return self.submit(fn, *args, **kwargs).result(timeout)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the number of jobs waiting, running, done and turned away, and the
+        average, 95th percentile and longest wait of recent jobs in seconds
+        """
+        with self._lock:
+            waits = sorted(self._waits)
+            stats = {"queued": self.queued, "running": self.running,
+                     "completed": self.completed, "rejected": self.rejected}
+
+        stats["wait_avg"] = sum(waits) / len(waits) if waits else 0.0
+        stats["wait_p95"] = waits[int(len(waits) * 0.95)] if waits else 0.0
+        stats["wait_max"] = waits[-1] if waits else 0.0
+        return stats
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stops the worker threads, once the queued jobs are done if wait is set"""
+        self._executor.shutdown(wait)
+
+    def _run(self, queued_at: float, fn: Callable[..., Any], args, kwargs) -> Any:
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self._waits.append(time.monotonic() - queued_at)
+
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+            self._slots.release()
@@ -0,0 +1,224 @@
+"""Module for retrying failed emails.
+
+A mail relay that is busy or restarting rejects emails with temporary errors that go
+away if the email is sent again later, while an unknown mailbox or a rejected login
+will fail however often the email is sent. This module tells the two apart, schedules
+further attempts with exponential backoff and jitter up to a maximum number of
+attempts, and keeps emails that cannot be sent in a dead-letter spool on disk, where
+they can be inspected and sent again once the problem is fixed.
+
+Classes:
+- RetryPolicy: Decides when a failed email is sent again and when to give up.
+- DeadLetter: An email that could not be sent, as stored in the spool.
+- DeadLetterSpool: Folder of emails that could not be sent.
+
+Functions:
+- is_permanent: Returns whether sending an email again cannot fix an error.
+- main: Lists, shows and replays dead letters from the command line.
+
+Constants:
+- MAX_ATTEMPTS: The default number of attempts at sending an email.
+- BASE_DELAY: The default number of seconds before the second attempt.
+- MAX_DELAY: The default longest number of seconds between two attempts.
+- DIRECT_ATTEMPTS: The default number of attempts at sending an email in process.
+- DIRECT_BASE_DELAY, DIRECT_MAX_DELAY: The delays between attempts in process, short
+  as the submission waits for them.
+
+Exception Handling:
+- KeyError is raised when a dead letter does not exist.
+- OSError is logged and raised when a dead letter cannot be written.
+
+Usage: python -m src.mail_retry OUTBOX_PATH [list | show ID | replay ID... | replay --all]
+                                [--spool FOLDER]
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import smtplib
+import tempfile
+import time
+from typing import Any, Dict, List, NamedTuple, Optional
+from .http_transport import MailAPIError
+from .send_email import DeliveryResult, OutgoingEmail, SendEmail
+
+MAX_ATTEMPTS = 8
+BASE_DELAY = 30.0
+MAX_DELAY = 3600.0
+DIRECT_ATTEMPTS = 3
+DIRECT_BASE_DELAY = 0.5
+DIRECT_MAX_DELAY = 2.0
+
+def is_permanent(error: BaseException) -> bool:
+    """Returns whether sending an email again cannot fix an error"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        # 4xx replies, such as 421 and 450 while the relay is throttling, are temporary
+        return error.smtp_code >= 500
+    if isinstance(error, smtplib.SMTPNotSupportedError):
+        return True
+    if isinstance(error, MailAPIError):
+        # Rate limits and server errors of the mail API are temporary
+        return not error.transient
+    if isinstance(error, (smtplib.SMTPException, OSError)):
+        # Dropped connections, refused connections and timeouts, including those of
+        # requests, whose errors are OSErrors
+        return False
+    # Anything else is a problem with the email itself
+    return True
+
+class RetryPolicy:
+    """
+    Decides when a failed email is sent again and when to give up.
+
+    The delay doubles after every attempt up to max_delay, and is jittered to between
+    half and all of that so emails that failed together are not all sent again at once.
+    """
+    def __init__(self, max_attempts: int = MAX_ATTEMPTS, base_delay: float = BASE_DELAY,
+                 max_delay: float = MAX_DELAY):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempts: int) -> float:
+        """Returns the number of seconds to wait after the given number of failed attempts"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    def should_retry(self, error: BaseException, attempts: int) -> bool:
+        """Returns whether an email that failed the given number of times is sent again"""
+        return attempts < self.max_attempts and not is_permanent(error)
+
+    def send_emails(self, sender: SendEmail, emails: List[OutgoingEmail]) -> List[DeliveryResult]:
+        """
+        Sends emails, sending those that fail with a temporary error again in process
+        until they are sent or out of attempts. Emails that were sent are not sent again.
+        The caller waits for the delays, so the policy should have short ones.
+        """
+        results = sender.send_emails(emails)
+        attempts = 1
+        pending = [index for index, result in enumerate(results)
+                   if result.error is not None and self.should_retry(result.error, attempts)]
+        while pending:
+            delay = self.delay(attempts)
+            logging.warning("Unable to send %d email(s), attempt %d, retrying in %.1f sec: %s",
+                            len(pending), attempts, delay, results[pending[0]].error)
+            time.sleep(delay)
+            attempts += 1
+            for index, result in zip(pending,
+                                     sender.send_emails([emails[index] for index in pending])):
+                results[index] = result
+            pending = [index for index in pending if results[index].error is not None
+                       and self.should_retry(results[index].error, attempts)]
+        return results
+
+class DeadLetter(NamedTuple):
+    """An email that could not be sent, as stored in the spool."""
+    id: str
+    submission: str
+    kind: str
+    payload: Dict[str, Any]
+    attachment: Optional[bytes]
+    attempts: int
+    error: str
+    failed: float
+
+class DeadLetterSpool:
+    """
+    Folder of emails that could not be sent, one JSON file per email.
+
+    Files are written to a temporary name first so a crash never leaves half an email.
+    """
+    def __init__(self, folder: str):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def add(self, letter: DeadLetter) -> None:
+        """Stores an email that could not be sent"""
+        record = letter._asdict()
+        if letter.attachment is not None:
+            record["attachment"] = base64.b64encode(letter.attachment).decode("ascii")
+
+        try:
+            handle, temporary = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+            with os.fdopen(handle, "w", encoding="utf-8") as file:
+                json.dump(record, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self._path(letter.id))
+        except OSError as e:
+            logging.error("Unable to write dead letter %s: %s", letter.id, e)
+            raise e
+
+    def get(self, letter_id: str) -> DeadLetter:
+        """Returns a stored email"""
+        try:
+            with open(self._path(letter_id), encoding="utf-8") as file:
+                record = json.load(file)
+        except FileNotFoundError as e:
+            raise KeyError(f"No dead letter {letter_id}") from e
+
+        if record["attachment"] is not None:
+            record["attachment"] = base64.b64decode(record["attachment"])
+        return DeadLetter(**record)
+
+    def list(self) -> List[DeadLetter]:
+        """Returns every stored email, oldest first"""
+        letters = [self.get(name[:-len(".json")]) for name in os.listdir(self.folder)
+                   if name.endswith(".json")]
+        return sorted(letters, key=lambda letter: letter.failed)
+
+    def remove(self, letter_id: str) -> None:
+        """Deletes a stored email"""
+        try:
+            os.remove(self._path(letter_id))
+        except FileNotFoundError as e:
+            raise KeyError(f"No dead letter {letter_id}") from e
+
+    def replay(self, letter_id: str, outbox) -> None:
+        """Moves a stored email back into an outbox to be sent again"""
+        letter = self.get(letter_id)
+        outbox.enqueue(letter.submission, letter.kind, letter.payload, letter.attachment)
+        self.remove(letter_id)
+        logging.info("Dead letter %s moved back to the outbox", letter_id)
+
+    def _path(self, letter_id: str) -> str:
+        return os.path.join(self.folder, f"{os.path.basename(letter_id)}.json")
+
+def main() -> None:
+    """Lists, shows and replays dead letters from the command line"""
+    # Imported here as the outbox imports this module
+    from .outbox import Outbox  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(description="Inspect and replay emails that could not be sent")
+    parser.add_argument("outbox_path")
+    parser.add_argument("command", choices=["list", "show", "replay"])
+    parser.add_argument("ids", nargs="*")
+    parser.add_argument("--all", action="store_true", help="replay every dead letter")
+    parser.add_argument("--spool", help="dead-letter folder, if not next to the outbox")
+    args = parser.parse_args()
+
+    outbox = Outbox(args.outbox_path,
+                    dead_letters=DeadLetterSpool(args.spool) if args.spool else None)
+    spool = outbox.dead_letters
+    if args.command == "list":
+        for letter in spool.list():
+            failed = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(letter.failed))
+            print(f"{letter.id}  {failed}  {letter.kind:<8} {letter.payload['email_to']:<32} "
+                  f"{letter.attempts} attempts  {letter.error}")
+    elif args.command == "show":
+        for letter_id in args.ids:
+            letter = spool.get(letter_id)
+            print(json.dumps({**letter._asdict(), "attachment": len(letter.attachment or b"")},
+                             indent=2))
+    else:
+        letter_ids = [letter.id for letter in spool.list()] if args.all else args.ids
+        for letter_id in letter_ids:
+            spool.replay(letter_id, outbox)
+        print(f"Replayed {len(letter_ids)} dead letters")
+
+if __name__ == "__main__":
+    main()
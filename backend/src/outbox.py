@@ -0,0 +1,337 @@
+"""Module for delivering emails from a durable outbox.
+
+Sending the emails of a submission while the request waits makes every submission as
+slow as the mail relay. This module stores the clinic and patient emails of a
+submission in a local SQLite database, in WAL mode so the request threads and the
+delivery workers do not block each other, and returns straight away. Background
+workers deliver the stored emails, the emails of a submission over a single SMTP
+session, and delete them once they are sent. Emails survive
+a restart of the process, and any email a stopped process was sending is picked up
+again once its lease has run out. Emails that fail are sent again with backoff, and
+moved to a dead-letter spool once they fail permanently or run out of attempts.
+
+Classes:
+- Outbox: Durable queue of emails with a pool of delivery worker threads.
+
+Constants:
+- OUTBOX_WORKERS: The default number of delivery worker threads.
+- OUTBOX_POLL_INTERVAL: The default number of seconds an idle worker waits before
+  checking the outbox again.
+- OUTBOX_LEASE: The number of seconds after which an email still marked as being
+  sent is assumed lost and sent again.
+
+Exception Handling:
+- Errors while sending an email are logged, and the email is kept for another attempt
+  or moved to the dead-letter spool.
+- sqlite3.Error is logged and raised when an email cannot be stored.
+"""
+import json
+import logging
+import secrets
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+from .mail_retry import DeadLetter, DeadLetterSpool, RetryPolicy
+from .send_email import OutgoingEmail, SendEmail
+
+OUTBOX_WORKERS = 2
+OUTBOX_POLL_INTERVAL = 5.0
+OUTBOX_LEASE = 300.0
+
+KIND_CLINIC = "clinic"
+KIND_PATIENT = "patient"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    submission TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attachment BLOB,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    last_error TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt);
+"""
+
+class Outbox:
+    """
+    Durable queue of emails with a pool of delivery worker threads.
+
+    Several processes may share one outbox file, each email is claimed by one
+    worker at a time. The sender is only needed to start the workers, and the
+    dead-letter spool defaults to a folder next to the outbox file.
+    """
+    def __init__(self, path: str, sender: Optional[SendEmail] = None,
+                 workers: int = OUTBOX_WORKERS, poll_interval: float = OUTBOX_POLL_INTERVAL,
+                 lease: float = OUTBOX_LEASE, retry_policy: Optional[RetryPolicy] = None,
+                 dead_letters: Optional[DeadLetterSpool] = None):
+        self.path = path
+        self.sender = sender
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.dead_letters = dead_letters or DeadLetterSpool(f"{path}.dead-letters")
+        self.sent = 0
+        self.failed = 0
+        self.dead_lettered = 0
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(_SCHEMA)
+
+    def start(self) -> None:
+        """Starts the delivery workers"""
+        if self.sender is None:
+            raise ValueError("The outbox needs a sender to deliver emails")
+
+        with self._lock:
+            if self._threads:
+                return
+
+            self._stopping.clear()
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"outbox-{number}",
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+        logging.info("Outbox started with %d workers, %d emails waiting",
+                     self.workers, self.pending())
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stops the delivery workers once they have finished the email they are sending"""
+        with self._lock:
+            threads, self._threads = self._threads, []
+
+        self._stopping.set()
+        self._wake.set()
+        for thread in threads:
+            thread.join(timeout)
+
+    def enqueue_submission(self, email_to: str, attach_name: str, pdf_content: bytes,
+                           patient_name: str, patient_email: str,
+                           submit_datetime: datetime) -> str:
+        """
+        Stores the clinic and patient emails of a submission, see SendEmail.send_pdf_to_clinic
+        and SendEmail.send_email_to_patient, and returns the id of the submission.
+        """
+        submission = secrets.token_hex(8)
+        clinic = {
+            "email_to": email_to,
+            "attach_name": attach_name,
+            "patient_name": patient_name,
+            "patient_email": patient_email,
+            "submit_datetime": submit_datetime.isoformat(),
+        }
+        patient = {"email_to": patient_email, "patient_name": patient_name}
+
+        self._insert([(submission, KIND_CLINIC, clinic, pdf_content),
+                      (submission, KIND_PATIENT, patient, None)])
+        return submission
+
+    def enqueue(self, submission: str, kind: str, payload: Dict[str, Any],
+                attachment: Optional[bytes] = None) -> None:
+        """Stores a single email, e.g. one replayed from the dead-letter spool"""
+        self._insert([(submission, kind, payload, attachment)])
+
+    def _insert(self, emails: List[Tuple[str, str, Dict[str, Any], Optional[bytes]]]) -> None:
+        now = time.time()
+        try:
+            with self._transaction() as connection:
+                connection.executemany(
+                    "INSERT INTO outbox (submission, kind, payload, attachment, next_attempt,"
+                    " created) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(submission, kind, json.dumps(payload), attachment, now, now)
+                     for submission, kind, payload, attachment in emails])
+        except sqlite3.Error as e:
+            logging.error("Unable to store emails in the outbox: %s", e)
+            raise e
+
+        self._wake.set()
+
+    def pending(self) -> int:
+        """Returns the number of emails that have not been sent yet"""
+        return self._connection().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def drain(self, timeout: float) -> bool:
+        """Waits until every email has been sent, returns whether the outbox is empty"""
+        deadline = time.monotonic() + timeout
+        while self.pending():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the number of emails sent, failed, dead-lettered and waiting"""
+        return {"sent": self.sent, "failed": self.failed, "dead_lettered": self.dead_lettered,
+                "pending": self.pending()}
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns the database connection of the current thread"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit, transactions are opened explicitly
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA synchronous=FULL")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self, mode: str = "") -> Iterator[sqlite3.Connection]:
+        connection = self._connection()
+        connection.execute(f"BEGIN {mode}")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _work(self) -> None:
+        while not self._stopping.is_set():
+            self._wake.clear()
+            try:
+                rows = self._claim()
+            except sqlite3.Error as e:
+                logging.error("Unable to read the outbox: %s", e)
+                rows = []
+
+            if not rows:
+                self._wake.wait(self.poll_interval)
+                continue
+
+            settled: Set[int] = set()
+            try:
+                self._deliver(rows, settled)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                # Keeps the worker running, the emails not yet sent are tried again
+                logging.error("Unable to deliver emails from the outbox: %s", e)
+                for row in rows:
+                    if row[0] not in settled:
+                        self._fail_claimed(row, e)
+
+    def _claim(self) -> List[Tuple[Any, ...]]:
+        """
+        Marks the next due email, and the other due emails of its submission, as being
+        sent and returns them
+        """
+        now = time.time()
+        columns = "id, submission, kind, payload, attachment, attempts"
+        # Take the write lock before reading so two workers cannot claim the same email
+        with self._transaction("IMMEDIATE") as connection:
+            row = connection.execute(
+                f"SELECT {columns} FROM outbox"
+                " WHERE (status = 'pending' AND next_attempt <= ?)"
+                " OR (status = 'sending' AND next_attempt <= ?)"
+                " ORDER BY next_attempt, id LIMIT 1", (now, now - self.lease)).fetchone()
+            if row is None:
+                return []
+
+            rows = [row] + connection.execute(
+                f"SELECT {columns} FROM outbox WHERE submission = ? AND id != ?"
+                " AND status = 'pending' AND next_attempt <= ? ORDER BY id",
+                (row[1], row[0], now)).fetchall()
+            connection.executemany(
+                "UPDATE outbox SET status = 'sending', next_attempt = ? WHERE id = ?",
+                [(now, claimed[0]) for claimed in rows])
+        return rows
+
+    def _deliver(self, rows: List[Tuple[Any, ...]], settled: Set[int]) -> None:
+        """
+        Sends claimed emails over a single SMTP session, adding the ids of the emails
+        that were sent or failed to settled
+        """
+        emails, sendable = [], []
+        for row in rows:
+            try:
+                emails.append(self._email(row[2], json.loads(row[3]), row[4]))
+                sendable.append(row)
+            except (ValueError, KeyError) as e:
+                settled.add(row[0])
+                self._failed(row, e)
+
+        results = self.sender.send_emails(emails) if emails else []
+        for row, result in zip(sendable, results):
+            settled.add(row[0])
+            if result.error is not None:
+                self._failed(row, result.error)
+                continue
+
+            with self._lock:
+                self.sent += 1
+            # An email whose row cannot be deleted stays marked as being sent, and is
+            # sent again once its lease runs out
+            self._connection().execute("DELETE FROM outbox WHERE id = ?", (row[0],))
+
+    def _fail_claimed(self, row: Tuple[Any, ...], error: BaseException) -> None:
+        """
+        Fails a claimed email after delivery broke off, see _failed. The email may not
+        be at fault, so it is tried again.
+        """
+        try:
+            self._failed(row, error, transient=True)
+        except sqlite3.Error as e:
+            # Left marked as being sent, and tried again once its lease runs out
+            logging.error("Unable to update email %d in the outbox: %s", row[0], e)
+
+    def _failed(self, row: Tuple[Any, ...], error: BaseException,
+                transient: bool = False) -> None:
+        """
+        Schedules another attempt at a failed email, or moves it to the dead-letter spool.
+        A transient error is retried whatever its type, until the attempts run out.
+        """
+        message_id, submission, kind, payload, attachment, attempts = row
+        attempts += 1
+        with self._lock:
+            self.failed += 1
+
+        if (self.retry_policy.should_retry(error, attempts)
+                or (transient and attempts < self.retry_policy.max_attempts)):
+            delay = self.retry_policy.delay(attempts)
+            logging.error("Unable to send %s email %d from the outbox, attempt %d, "
+                          "retrying in %.0f sec: %s", kind, message_id, attempts, delay, error)
+            self._connection().execute(
+                "UPDATE outbox SET status = 'pending', attempts = ?, next_attempt = ?,"
+                " last_error = ? WHERE id = ?",
+                (attempts, time.time() + delay, str(error), message_id))
+            return
+
+        logging.error("Unable to send %s email %d from the outbox after %d attempts, "
+                      "moving it to the dead-letter spool: %s", kind, message_id, attempts, error)
+        # Written before the email is deleted, so a crash in between sends it twice
+        # rather than losing it
+        try:
+            self.dead_letters.add(DeadLetter(f"{submission}-{kind}", submission, kind,
+                                             json.loads(payload), attachment, attempts,
+                                             str(error), time.time()))
+        except OSError:
+            # Left marked as being sent, and tried again once its lease runs out
+            return
+        with self._lock:
+            self.dead_lettered += 1
+        self._connection().execute("DELETE FROM outbox WHERE id = ?", (message_id,))
+
+    def _email(self, kind: str, payload: Dict[str, Any],
+               attachment: Optional[bytes]) -> OutgoingEmail:
+        if kind == KIND_CLINIC:
+            return self.sender.clinic_email(payload["email_to"], payload["attach_name"],
+                                            attachment, payload["patient_name"],
+                                            payload["patient_email"],
+                                            datetime.fromisoformat(payload["submit_datetime"]))
+        if kind == KIND_PATIENT:
+            return self.sender.patient_email(payload["email_to"], payload["patient_name"])
+        raise ValueError(f"Unknown kind of email: {kind}")
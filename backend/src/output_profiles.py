@@ -0,0 +1,108 @@
+"""Module for the PDF output profiles.
+
+The consent forms are sent as email attachments and may be archived, so the size of
+the PDF matters as much as the time it takes to render. This module defines output
+profiles that trade CPU time against size, and outputs documents with them.
+
+Classes:
+- OutputProfile: Compression settings used when a document is output.
+
+Functions:
+- get_output_profile: Returns an output profile by name.
+- output_pdf: Outputs a document with the settings of an output profile.
+
+Constants:
+- OUTPUT_PROFILES: The available output profiles by name.
+- DEFAULT_OUTPUT_PROFILE: The name of fpdf2's default settings.
+
+Exception Handling:
+- ValueError is raised for an unknown output profile.
+- RuntimeError is raised on import if fpdf2 no longer reads the compression level
+  from where this module sets it.
+"""
+import threading
+from typing import Dict, NamedTuple, Optional
+from fpdf import FPDF
+from fpdf.syntax import PDFContentStream
+from .image_registry import IMAGE_REGISTRY
+
+class OutputProfile(NamedTuple):
+    """Compression settings used when a document is output."""
+    name: str
+    # Whether page content streams are compressed
+    compress: bool
+    # zlib level of compressed streams such as fonts, -1 is zlib's default
+    compression_level: int
+    # Filter of static images like the logo, e.g. DCTDecode to recompress them as JPEG,
+    # AUTO keeps fpdf2's choice (lossless FlateDecode for PNG)
+    image_filter: str
+
+OUTPUT_PROFILES: Dict[str, OutputProfile] = {
+    "default": OutputProfile("default", True, -1, "AUTO"),
+    "fast": OutputProfile("fast", False, 1, "AUTO"),
+    "small": OutputProfile("small", True, 9, "DCTDecode"),
+}
+DEFAULT_OUTPUT_PROFILE = "default"
+
+# fpdf2 has no compression level per document, it reads the level of its streams from
+# a private class attribute. Fail on import rather than silently compress every
+# document alike if a new version of fpdf2 reads it from elsewhere
+_LIBRARY_COMPRESSION_LEVEL = getattr(PDFContentStream, "_COMPRESSION_LEVEL", None)
+if not isinstance(_LIBRARY_COMPRESSION_LEVEL, int):
+    raise RuntimeError("fpdf2 no longer reads the compression level from "
+                       "PDFContentStream._COMPRESSION_LEVEL, update output_profiles.py")
+
+class _CompressionLevelGate:
+    """
+    Sets the class attribute only while documents are output by output_pdf. Documents
+    with the same level are output at the same time, one with another level waits
+    until they are done, and the attribute is put back once none are being output.
+    """
+    def __init__(self):
+        self._level: Optional[int] = None
+        self._outputs = 0
+        self._changed = threading.Condition()
+
+    def enter(self, level: int) -> None:
+        """Waits until documents can be output with level, and sets it"""
+        with self._changed:
+            self._changed.wait_for(lambda: self._outputs == 0 or self._level == level)
+            if self._outputs == 0 and level != _LIBRARY_COMPRESSION_LEVEL:
+                PDFContentStream._COMPRESSION_LEVEL = level
+            self._level = level
+            self._outputs += 1
+
+    def exit(self) -> None:
+        """Puts fpdf2's level back once no document is being output"""
+        with self._changed:
+            self._outputs -= 1
+            if self._outputs == 0:
+                PDFContentStream._COMPRESSION_LEVEL = _LIBRARY_COMPRESSION_LEVEL
+                self._level = None
+                self._changed.notify_all()
+
+_compression_gate = _CompressionLevelGate()
+
+def get_output_profile(name: str) -> OutputProfile:
+    """Returns an output profile by name"""
+    profile = OUTPUT_PROFILES.get(name)
+    if profile is None:
+        raise ValueError(f"Unknown output profile: {name}")
+    return profile
+
+def output_pdf(pdf: FPDF, profile: OutputProfile) -> bytes:
+    """
+    Outputs a document with the settings of an output profile.
+
+    fpdf2's compression level is only changed while documents are output here, and
+    documents with the same level, such as those of the default profile, are output
+    at the same time.
+    """
+    pdf.set_compression(profile.compress)
+    IMAGE_REGISTRY.use_filter(pdf, profile.image_filter)
+
+    _compression_gate.enter(profile.compression_level)
+    try:
+        return bytes(pdf.output())
+    finally:
+        _compression_gate.exit()
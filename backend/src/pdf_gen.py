@@ -6,27 +6,45 @@ the PDF documents, including adding logo, signatures, and text content.
 
 Classes:
 - GeneratePDF: Handles the generation of a PDF document with consent information, 
-  client signatures, and other details.
+  client signatures, and other details. Each form type and set of consent flags is 
+  compiled once into a display list, and the static part of each document (logo, 
+  title and sections) is rendered once from it, cached, and copied for each 
+  submission before the signature, name and date are stamped, so the form text is
+  only measured and wrapped when a static document is rendered. The size and hit
+  rate of that cache are reported for tuning. The signature is 
+  either a base64 data URI or a Signature already decoded during validation, and 
+  is normalized before it is embedded. The lightweight core render profile prints 
+  in the PDF core fonts and falls back to the embedded fonts for text they cannot 
+  encode. Names in other scripts are printed in lazily loaded fallback fonts. The 
+  document is output with the compression settings of an output profile, chosen 
+  per generator or per document.
 
 Constants:
-- TEXT_FOLDER: Directory containing form text configuration files.
 - LOGO_FOLDER: Directory containing the logo image.
 - LOGO_FILE: Path to the logo image file.
+- SIGNATURE_HEIGHT: Printed height in millimetres of the whole signature canvas.
 """
 
+import copy
+import itertools
 import json
 import base64
 import logging
-from datetime import datetime
-from typing import Any, Dict, List
-from io import BytesIO
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
 from fpdf import FPDF
-from .doc_printing import Document
-from .fonts.fonts import Fonts
+from .doc_printing import DisplayList, compile_document
+from .fonts.fonts import Fonts, FONT_REGISTRY, LATIN_CHARACTERS, PROFILE_EMBEDDED
+from .form_templates import FormTemplate, TEMPLATE_REGISTRY
+from .image_registry import IMAGE_REGISTRY
+from .output_profiles import DEFAULT_OUTPUT_PROFILE, OutputProfile, get_output_profile, output_pdf
+from .signature import NormalizedSignature, Signature
 
-TEXT_FOLDER = "src/form_text"
 LOGO_FOLDER = "src/logo"
 LOGO_FILE = f"{LOGO_FOLDER}/logo.png"
+SIGNATURE_HEIGHT = 20
 
 logging.getLogger("fontTools.subset").level = logging.WARN
 logging.getLogger("fontTools.ttLib.ttFont").level = logging.WARN
@@ -38,79 +56,220 @@ class GeneratePDF:
     client signatures, and other details.
     """
 
-    def __init__(self):
+    # Compiled display lists keyed by form type, template version and consent flags,
+    # and rendered static documents keyed by those and the render profile
+    _display_lists: Dict[Tuple[str, int, Tuple[bool, ...]], DisplayList] = {}
+    _base_documents: Dict[Tuple[str, int, Tuple[bool, ...], str], FPDF] = {}
+    _base_lock = threading.Lock()
+    # Lookups of the static documents, for render_cache_stats
+    _base_lookups: Dict[str, int] = {"hits": 0, "misses": 0}
+    _lookups_lock = threading.Lock()
+
+    # Signatures are printed in black and white, or in grayscale if disabled
+    bilevel_signatures: bool = True
+
+    def __init__(self, profile: str = PROFILE_EMBEDDED,
+                 output_profile: str = DEFAULT_OUTPUT_PROFILE):
         self.pdf = FPDF()
+        self.profile = profile
+        self.output_profile: OutputProfile = get_output_profile(output_profile)
         try:
-            self.fonts = Fonts()
+            self.fonts = Fonts(profile=profile)
         except (RuntimeError, FileNotFoundError, json.JSONDecodeError) as e:
             logging.error("PDF generator cannot be made: %s", e)
             raise e
 
-    def _add_base64_image(self, base64_data: str, h=None) -> None:
+    def _add_base64_image(self, base64_data: str, h: float = SIGNATURE_HEIGHT) -> None:
         try:
             if "base64," in base64_data:
                 base64_data: str = base64_data.split("base64,")[1]
 
             image_data: bytes = base64.b64decode(base64_data)
-            image_file: BytesIO = BytesIO(image_data)
-            self.pdf.image(image_file, h=h)
         except (ValueError, TypeError) as e:
             logging.error("Error addding base64 image: %s", e)
             raise e
 
+        self._add_signature(Signature.from_png(image_data), h=h)
+
+    def _add_signature(self, signature: Signature, h: float = SIGNATURE_HEIGHT) -> None:
+        try:
+            # Trimmed, scaled down and reduced to black and white before it is embedded
+            normalized: NormalizedSignature = signature.normalize(
+                h, bilevel=self.bilevel_signatures)
+            self.pdf.image(normalized.image, w=normalized.width, h=normalized.height)
+        except (ValueError, TypeError) as e:
+            logging.error("Error adding signature image: %s", e)
+            raise e
+
     def generate_pdf(self, client_name: str, form_name: str, consent_flags: List[bool],
-                     siganture_base64: str, submit_datetime: datetime) -> str:
-        """Generates a PDF document with client information, form content, and a signature."""
-        self.pdf.add_page()
+                     signature: Union[Signature, str], submit_datetime: datetime,
+                     output_profile: Optional[str] = None) -> str:
+        """Generates a PDF document and returns it encoded to base64, see generate_pdf_bytes."""
+        pdf_content: bytes = self.generate_pdf_bytes(client_name, form_name, consent_flags,
+                                                     signature, submit_datetime, output_profile)
+        return base64.b64encode(pdf_content).decode("utf-8")
 
+    def generate_pdf_bytes(self, client_name: str, form_name: str, consent_flags: List[bool],
+                           signature: Union[Signature, str], submit_datetime: datetime,
+                           output_profile: Optional[str] = None) -> bytes:
+        """
+        Generates a PDF document with client information, form content, and a signature.
 
-        # Add logo
-        self.pdf.image(LOGO_FILE, w=25, x=15, y=11)
+        The output profile of the generator is used unless another one is given.
+        """
+        template: FormTemplate = TEMPLATE_REGISTRY.get(form_name)
+        output_settings: OutputProfile = self.output_profile if output_profile is None \
+            else get_output_profile(output_profile)
+        date: str = submit_datetime.strftime("%d %B %Y")
 
-        # Print document text
-        form_dict: Dict[str, Any] = self._get_json_dict(form_name)
-        document: Document = Document(self.pdf, self.fonts,
-                                        consent_flags, form_dict["document"])
-        try:
-            document.print()
-        except RuntimeError as e:
-            logging.error("Unable to print to pdf document: %s", e)
+        profile: str = self.profile
+        if not self.fonts.can_encode(template.characters + client_name + date):
+            logging.info("Falling back to embedded fonts for text the %s profile cannot print",
+                         profile)
+            profile = PROFILE_EMBEDDED
+
+        self.pdf = self._get_base_document(template, consent_flags, profile)
+        self.pdf.set_creation_date(datetime.now(timezone.utc))
 
         # Space
         self.pdf.cell(0, 5, text = "", ln=True)
 
         # Add signature
-        self._add_base64_image(siganture_base64, h=20)
+        if isinstance(signature, Signature):
+            self._add_signature(signature, h=SIGNATURE_HEIGHT)
+        else:
+            self._add_base64_image(signature, h=SIGNATURE_HEIGHT)
 
         # Space
         self.pdf.cell(0, 5, text="", ln = True)
 
-        # Add client's name
+        # Add client's name, in a fallback font for any script the form fonts do not cover
+        self.fonts.set_fallback_fonts(self.pdf, client_name)
         self.pdf.cell(0, 5, text=client_name, ln=True, align="L")
 
         # Add date
-        date: str = submit_datetime.strftime("%d %B %Y")
         self.pdf.cell(0, 5, text=date, ln=True, align="L")
 
-        pdf_buffer: BytesIO = BytesIO()
+        # Output from the fonts subset ahead of time when they cover the text
+        FONT_REGISTRY.use_subsets(self.pdf)
 
         try:
-            self.pdf.output(pdf_buffer)
+            pdf_content: bytes = output_pdf(self.pdf, output_settings)
         except RuntimeError as e:
             logging.error("Unable to output pdf document: %s", e)
             raise e
 
-        pdf_content: bytes = pdf_buffer.getvalue()
-        pdf_base64 = base64.b64encode(pdf_content).decode("utf-8")
+        logging.info("PDF successfully generated")
+
+        return pdf_content
 
-        logging.info("PDF successfully generated and encoded to base64")
+    def warm_up(self) -> None:
+        """
+        Loads the static images, subsets the fonts to the form text and renders the static
+        documents of every form for every combination of consent flags
+        """
+        IMAGE_REGISTRY.warm_up([LOGO_FILE])
+        FONT_REGISTRY.build_subsets(TEMPLATE_REGISTRY.characters() + LATIN_CHARACTERS)
+        # The embedded fonts are also the fallback of the other profiles
+        profiles = {PROFILE_EMBEDDED, self.profile}
+        for form_type in TEMPLATE_REGISTRY.form_types():
+            template: FormTemplate = TEMPLATE_REGISTRY.get(form_type)
+            for flags in itertools.product([True, False], repeat=len(template.consent_keys)):
+                for profile in profiles:
+                    self._get_base_document(template, list(flags), profile)
 
-        return pdf_base64
+    @classmethod
+    def clear_render_cache(cls) -> None:
+        """Drops every cached display list and static document, e.g. after the form text has changed"""
+        with cls._base_lock:
+            cls._display_lists.clear()
+            cls._base_documents.clear()
+        with cls._lookups_lock:
+            cls._base_lookups.update(hits=0, misses=0)
 
-    def _get_json_dict(self, form_name: str) -> Dict[str, Any]:
+    @classmethod
+    def render_cache_stats(cls) -> Dict[str, float]:
+        """
+        Returns the number of cached static documents, and how many submissions found
+        theirs in the cache rather than rendering and wrapping the form text again
+        """
+        with cls._lookups_lock:
+            hits, misses = cls._base_lookups["hits"], cls._base_lookups["misses"]
+        lookups = hits + misses
+        return {
+            "size": len(cls._base_documents),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+    def _get_base_document(self, template: FormTemplate, consent_flags: List[bool],
+                           profile: str = PROFILE_EMBEDDED) -> FPDF:
+        """Returns a private copy of the static document for the form and consent flags"""
+        key = (template.form_type, template.version, tuple(consent_flags), profile)
+        base = self._base_documents.get(key)
+        rendered = False
+        if base is None:
+            with self._base_lock:
+                base = self._base_documents.get(key)
+                if base is None:
+                    self._drop_old_versions(template)
+                    base = self._render_base_document(template, consent_flags, profile)
+                    self._base_documents[key] = base
+                    rendered = True
+        with self._lookups_lock:
+            self._base_lookups["misses" if rendered else "hits"] += 1
+
+        # Parsed font tables are read only and shared, but every copy needs its own
+        # font file as fpdf2 subsets it in place when the document is output
+        memo = {}
+        for font in base.fonts.values():
+            if font.type != "TTF":
+                continue
+            memo[id(font.ttfont)] = FONT_REGISTRY.open_font_file(Path(font.ttffile).stem)
+            memo[id(font.cmap)] = font.cmap
+            memo[id(font.glyph_ids)] = font.glyph_ids
+            memo[id(font.cw)] = font.cw
+
+        return copy.deepcopy(base, memo)
+
+    def _render_base_document(self, template: FormTemplate, consent_flags: List[bool],
+                              profile: str = PROFILE_EMBEDDED) -> FPDF:
+        """Renders everything in the document that does not depend on the patient"""
+        pdf = FPDF()
+        # Fonts tracks the fonts attached to one pdf, so each base document needs its own
+        fonts = Fonts(profile=profile)
+        pdf.add_page()
+
+        # Add logo, encoded once per process
+        IMAGE_REGISTRY.image(pdf, LOGO_FILE, w=25, x=15, y=11)
+
+        # Print document text
+        display_list: DisplayList = self._get_display_list(template, consent_flags)
         try:
-            with open(f"{TEXT_FOLDER}/{form_name}.json", "r", encoding="utf-8") as file:
-                return json.load(file)
-        except (FileNotFoundError, json.JSONDecodeError) as e:
-            logging.error("Cannot read {form_name} config file: %s", e)
-            raise e
+            display_list.replay(pdf, fonts)
+        except RuntimeError as e:
+            logging.error("Unable to print to pdf document: %s", e)
+
+        logging.info("Rendered base document for %s form with consent flags %s in %s fonts",
+                     template.form_type, consent_flags, profile)
+
+        return pdf
+
+    def _get_display_list(self, template: FormTemplate,
+                          consent_flags: List[bool]) -> DisplayList:
+        """Returns the compiled drawing operations for the form and consent flags"""
+        key = (template.form_type, template.version, tuple(consent_flags))
+        display_list = self._display_lists.get(key)
+        if display_list is None:
+            display_list = compile_document(consent_flags, template.document)
+            self._display_lists[key] = display_list
+
+        return display_list
+
+    def _drop_old_versions(self, template: FormTemplate) -> None:
+        """Drops cached documents built from earlier versions of a reloaded template"""
+        for cache in (self._display_lists, self._base_documents):
+            for key in list(cache):
+                if key[0] == template.form_type and key[1] != template.version:
+                    del cache[key]
@@ -0,0 +1,224 @@
+"""Module for limiting the rate emails are sent at.
+
+Mail relays and providers only accept so many emails a second from a relay client or
+a sender account, and answer emails beyond that with temporary errors such as 421
+and 450, or 429 from an HTTP API. When a whole class submits their forms at once the
+burst of emails is over that rate, and the emails fail. This module keeps a token
+bucket for every relay and every sender account, which the mail transports take a
+token from before every email they send. A burst up to the size of the bucket is
+sent at once and the rest of it waits for tokens, so it goes out at the allowed
+rate instead of failing. Tokens can also be taken ahead, before a send holds a worker
+thread or a connection, and are then used by the next sends to the relay, or given
+back if the sends are not made. A relay
+that throttles nonetheless has its bucket and the bucket of the sender emptied,
+slowing the following emails down to the steady rate, and the throttled email is
+sent once more. The time sends waited for a token is recorded.
+
+Classes:
+- TokenBucket: Hands out tokens at a steady rate, with bursts up to its size.
+- MailRateLimiter: Token buckets for every relay and sender account.
+
+Functions:
+- is_throttled: Returns whether an error means the relay is throttling the sender.
+
+Constants:
+- RELAY_BURST: The default number of emails sent at once to a relay.
+- SENDER_BURST: The default number of emails sent at once from a sender account.
+- THROTTLE_CODES: SMTP replies with which a relay throttles the sender.
+
+Exception Handling:
+- ValueError is raised for a rate that is not positive.
+"""
+import smtplib
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+RELAY_BURST = 10
+SENDER_BURST = 10
+THROTTLE_CODES = (421, 450)
+
+def is_throttled(error: BaseException) -> bool:
+    """Returns whether an error means the relay is throttling the sender"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code in THROTTLE_CODES for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code in THROTTLE_CODES
+    # Too many requests from the HTTP mail API, see MailAPIError
+    return getattr(error, "status_code", None) == 429
+
+class TokenBucket:
+    """
+    Hands out tokens at a steady rate, with bursts up to its size.
+
+    The bucket holds up to burst tokens and refills with rate tokens a second. Tokens
+    can be taken before they are refilled, which leaves the bucket in debt, so callers
+    are served in the order they asked and each one waits for its own tokens.
+    """
+    def __init__(self, rate: float, burst: int):
+        if rate <= 0:
+            raise ValueError(f"Rate must be positive, got {rate}")
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """Takes tokens and returns the number of seconds until they are refilled"""
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+            return max(0.0, -self._tokens / self.rate)
+
+    def refund(self, tokens: float = 1.0) -> None:
+        """Gives back tokens that were taken but not used, up to the size of the bucket"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.burst, self._tokens + tokens)
+
+    def drain(self) -> None:
+        """Empties the bucket, so the next tokens are handed out at the steady rate"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0.0)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+class MailRateLimiter:
+    """
+    Token buckets for every relay and sender account.
+
+    Every email takes a token from the bucket of the relay it is sent to and from the
+    bucket of the account it is sent from, and waits for whichever is refilled last.
+    A rate of None leaves the relays or the sender accounts unlimited. The limiter is
+    thread-safe, and is shared by the transports sending to the same relays.
+    """
+    def __init__(self, relay_rate: Optional[float] = None, relay_burst: int = RELAY_BURST,
+                 sender_rate: Optional[float] = None, sender_burst: int = SENDER_BURST):
+        self.relay_rate = relay_rate
+        self.relay_burst = relay_burst
+        self.sender_rate = sender_rate
+        self.sender_burst = sender_burst
+        self.sends = 0
+        self.throttled = 0
+        self.backoffs = 0
+        self._relays: Dict[str, TokenBucket] = {}
+        self._senders: Dict[str, TokenBucket] = {}
+        # Tokens taken ahead by prepay for each relay and sender, not yet used
+        self._credits: Dict[Tuple[str, str], float] = {}
+        self._waits: Deque[float] = deque(maxlen=1000)
+        self._wait_total = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, relay: str, sender: str, tokens: float = 1.0) -> float:
+        """
+        Takes tokens for sending to relay from sender, and returns the number of seconds
+        to wait before sending. Used by callers that cannot block, see acquire. Tokens
+        taken ahead by prepay are used first, without waiting.
+        """
+        with self._lock:
+            credit = self._credits.get((relay, sender), 0.0)
+            if credit >= tokens:
+                self._credits[(relay, sender)] = credit - tokens
+                return 0.0
+        return self._take(relay, sender, tokens)
+
+    def acquire(self, relay: str, sender: str, tokens: float = 1.0) -> float:
+        """Waits until sending to relay from sender is allowed, and returns the seconds waited"""
+        delay = self.reserve(relay, sender, tokens)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def prepay(self, relay: str, sender: str, tokens: float = 1.0) -> float:
+        """
+        Waits until tokens for sending to relay from sender are refilled, and returns
+        the seconds waited. The tokens are left for the next sends to relay from sender,
+        so a caller can wait for its turn before taking a worker thread or connection.
+        """
+        delay = self._take(relay, sender, tokens)
+        if delay > 0:
+            time.sleep(delay)
+        with self._lock:
+            self._credits[(relay, sender)] = self._credits.get((relay, sender), 0.0) + tokens
+        return delay
+
+    def refund(self, relay: str, sender: str, tokens: float = 1.0) -> None:
+        """
+        Gives back tokens taken ahead by prepay for sends that were not made, such as
+        a submission turned away. Tokens the next sends have used already are kept.
+        """
+        with self._lock:
+            credit = self._credits.get((relay, sender), 0.0)
+            tokens = min(tokens, credit)
+            self._credits[(relay, sender)] = credit - tokens
+        if tokens <= 0:
+            return
+        if self.relay_rate:
+            self._bucket(self._relays, relay, self.relay_rate, self.relay_burst).refund(tokens)
+        if self.sender_rate:
+            self._bucket(self._senders, sender, self.sender_rate,
+                         self.sender_burst).refund(tokens)
+
+    def backoff(self, relay: str, sender: str, error: BaseException) -> bool:
+        """
+        Slows sending to relay and from sender down to their steady rates if error
+        means the relay is throttling, and returns whether the email is worth sending
+        again.
+        """
+        if not (self.relay_rate or self.sender_rate) or not is_throttled(error):
+            return False
+        if self.relay_rate:
+            self._bucket(self._relays, relay, self.relay_rate, self.relay_burst).drain()
+        if self.sender_rate:
+            self._bucket(self._senders, sender, self.sender_rate, self.sender_burst).drain()
+        with self._lock:
+            self.backoffs += 1
+        return True
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the number of sends, how many of them waited for a token and how long,
+        and the number of times a relay throttled the sender.
+        """
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                "sends": self.sends,
+                "throttled": self.throttled,
+                "backoffs": self.backoffs,
+                "wait_total": self._wait_total,
+                "wait_avg": self._wait_total / self.throttled if self.throttled else 0.0,
+                "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+                "wait_max": waits[-1] if waits else 0.0,
+            }
+
+    def _take(self, relay: str, sender: str, tokens: float) -> float:
+        """Takes tokens from the buckets of relay and sender, and returns the seconds to wait"""
+        delay = 0.0
+        if self.relay_rate:
+            delay = self._bucket(self._relays, relay, self.relay_rate,
+                                 self.relay_burst).reserve(tokens)
+        if self.sender_rate:
+            delay = max(delay, self._bucket(self._senders, sender, self.sender_rate,
+                                            self.sender_burst).reserve(tokens))
+        with self._lock:
+            self.sends += 1
+            if delay > 0:
+                self.throttled += 1
+                self._wait_total += delay
+                self._waits.append(delay)
+        return delay
+
+    def _bucket(self, buckets: Dict[str, TokenBucket], key: str, rate: float,
+                burst: int) -> TokenBucket:
+        with self._lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = TokenBucket(rate, burst)
+            return bucket
@@ -0,0 +1,224 @@
+"""Module for spreading emails over several mail relays.
+
+A single mail relay that is slow or down stalls or fails every submission. This
+module describes the relays emails can be sent through, each with a weight for its
+share of the emails, and keeps track of how each relay is doing: the average time
+it takes to send an email and the share of its recent emails that failed. A relay
+that fails several emails in a row, fails too many of its recent emails or becomes
+too slow is taken out of rotation for a while. It is then given one email to show
+it has recovered, and taken out again if that fails too. The relays in rotation
+take their shares by smooth weighted round robin, evenly rather than in runs.
+
+Classes:
+- Relay: A mail relay and its weight.
+- RelayHealth: How a relay is doing, and whether it is in rotation.
+- RelaySelector: Picks the relays emails are sent through.
+
+Functions:
+- parse_relays: Reads a list of relays such as "smtp1.example.com:587*3,smtp2.example.com".
+- is_relay_failure: Returns whether an error is the fault of the relay rather than the email.
+
+Constants:
+- FAILURE_THRESHOLD: The default number of failures in a row that take a relay out.
+- MAX_ERROR_RATE: The default share of recent emails a relay may fail.
+- MAX_LATENCY: The default longest average number of seconds to send an email.
+- EJECT_TIME: The default number of seconds a relay is out of rotation.
+- HEALTH_WINDOW: The number of recent emails the error rate is taken over.
+
+Exception Handling:
+- ValueError is raised for a relay list that cannot be read.
+"""
+import logging
+import smtplib
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Union
+
+FAILURE_THRESHOLD = 3
+MAX_ERROR_RATE = 0.5
+MAX_LATENCY = 10.0
+EJECT_TIME = 30.0
+HEALTH_WINDOW = 20
+# Emails a relay sends before its error rate is trusted
+_MIN_SAMPLES = 10
+# Weight of the latest email in the average latency
+_LATENCY_ALPHA = 0.2
+
+class Relay(NamedTuple):
+    """A mail relay and its weight, with its own account if it does not share one."""
+    server: str
+    port: Union[int, str] = 587
+    weight: int = 1
+    user: Optional[str] = None
+    pswd: Optional[str] = None
+
+    @property
+    def name(self) -> str:
+        """The address of the relay"""
+        return f"{self.server}:{self.port}"
+
+def parse_relays(spec: str, default_port: Union[int, str] = 587) -> List[Relay]:
+    """
+    Reads a comma separated list of relays, each written as host[:port][*weight],
+    for example "smtp1.example.com:587*3,smtp2.example.com".
+    """
+    relays = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        address, _, weight = item.partition("*")
+        server, _, port = address.partition(":")
+        try:
+            relay = Relay(server.strip(), int(port or default_port), int(weight or 1))
+        except ValueError as e:
+            raise ValueError(f"Invalid relay: {item}") from e
+        if not relay.server or relay.weight < 1:
+            raise ValueError(f"Invalid relay: {item}")
+        relays.append(relay)
+    if not relays:
+        raise ValueError("No relays given")
+    return relays
+
+def is_relay_failure(error: BaseException) -> bool:
+    """
+    Returns whether an error is the fault of the relay rather than the email, so the
+    email may be sent through another relay.
+    """
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        # The account may only be known to some of the relays
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return any(code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPNotSupportedError):
+        return False
+    # Dropped and refused connections and timeouts
+    return isinstance(error, (smtplib.SMTPException, OSError))
+
+class RelayHealth:
+    """How a relay is doing, and whether it is in rotation."""
+    def __init__(self, relay: Relay):
+        self.relay = relay
+        self.sends = 0
+        self.failures = 0
+        self.ejections = 0
+        self.consecutive_failures = 0
+        self.latency: Optional[float] = None
+        self.ejected_until = 0.0
+        self.outcomes: Deque[bool] = deque(maxlen=HEALTH_WINDOW)
+
+    @property
+    def error_rate(self) -> float:
+        """The share of recent emails that failed"""
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def in_rotation(self, now: float) -> bool:
+        """Whether emails are sent through the relay"""
+        return now >= self.ejected_until
+
+    def stats(self, now: float) -> Dict[str, Any]:
+        """Returns the weight, health, latency and counters of the relay"""
+        return {"relay": self.relay.name, "weight": self.relay.weight,
+                "healthy": self.in_rotation(now), "latency": self.latency or 0.0,
+                "error_rate": self.error_rate, "sends": self.sends,
+                "failures": self.failures, "ejections": self.ejections}
+
+class RelaySelector:
+    """
+    Picks the relays emails are sent through.
+
+    Thread-safe, the health of the relays is shared by every sender using the selector.
+    """
+    def __init__(self, relays: List[Relay], failure_threshold: int = FAILURE_THRESHOLD,
+                 max_error_rate: float = MAX_ERROR_RATE, max_latency: float = MAX_LATENCY,
+                 eject_time: float = EJECT_TIME):
+        if not relays:
+            raise ValueError("No relays given")
+        self.relays = [RelayHealth(relay) for relay in relays]
+        self.failure_threshold = failure_threshold
+        self.max_error_rate = max_error_rate
+        self.max_latency = max_latency
+        self.eject_time = eject_time
+        self._current = {health.relay.name: 0 for health in self.relays}
+        self._lock = threading.Lock()
+
+    def order(self) -> List[Relay]:
+        """
+        Returns the relays to try in turn for the next emails. The first is picked by
+        weighted round robin among the relays in rotation, the others follow by weight.
+        When every relay is out of rotation they are all tried, those that come back
+        soonest first.
+        """
+        with self._lock:
+            now = time.monotonic()
+            healthy = [health for health in self.relays if health.in_rotation(now)]
+            if not healthy:
+                return [health.relay for health in
+                        sorted(self.relays, key=lambda health: health.ejected_until)]
+
+            # Smooth weighted round robin, as nginx balances upstream servers
+            total = 0
+            for health in healthy:
+                self._current[health.relay.name] += health.relay.weight
+                total += health.relay.weight
+            first = max(healthy, key=lambda health: self._current[health.relay.name])
+            self._current[first.relay.name] -= total
+
+            others = sorted((health for health in healthy if health is not first),
+                            key=lambda health: -health.relay.weight)
+            return [first.relay] + [health.relay for health in others]
+
+    def record(self, relay: Relay, elapsed: float, error: Optional[BaseException]) -> None:
+        """
+        Records how sending an email through a relay went, and takes the relay out of
+        rotation if it is failing or slow
+        """
+        failed = error is not None and is_relay_failure(error)
+        with self._lock:
+            health = self._health(relay)
+            health.sends += 1
+            health.outcomes.append(not failed)
+            if failed:
+                health.failures += 1
+                health.consecutive_failures += 1
+            else:
+                health.consecutive_failures = 0
+                health.latency = elapsed if health.latency is None else (
+                    _LATENCY_ALPHA * elapsed + (1 - _LATENCY_ALPHA) * health.latency)
+
+            if not health.in_rotation(time.monotonic()):
+                # Emails sent through the relay before it was taken out
+                return
+            if health.consecutive_failures >= self.failure_threshold:
+                reason = f"{health.consecutive_failures} failures in a row"
+            elif (len(health.outcomes) >= _MIN_SAMPLES
+                  and health.error_rate > self.max_error_rate):
+                reason = f"error rate {health.error_rate:.0%}"
+            elif health.latency is not None and health.latency > self.max_latency:
+                reason = f"average latency {health.latency:.1f} sec"
+            else:
+                return
+
+            # Judged afresh once back in rotation, but a further failure in a row takes
+            # it out again straight away
+            health.ejected_until = time.monotonic() + self.eject_time
+            health.ejections += 1
+            health.outcomes.clear()
+            health.latency = None
+        logging.warning("Taking mail relay %s out of rotation for %.0f sec: %s",
+                        relay.name, self.eject_time, reason)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """Returns the weight, health, latency and counters of every relay"""
+        with self._lock:
+            now = time.monotonic()
+            return [health.stats(now) for health in self.relays]
+
+    def _health(self, relay: Relay) -> RelayHealth:
+        for health in self.relays:
+            if health.relay.name == relay.name:
+                return health
+        raise KeyError(relay.name)
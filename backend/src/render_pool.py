@@ -0,0 +1,122 @@
+"""Module for rendering PDFs in a pool of worker processes.
+
+fpdf2 and fontTools are pure Python, so PDFs rendered on the request threads of the
+Flask server serialize on the GIL. This module provides an optional pool of worker
+processes that render PDFs in parallel. Each worker warms its font and form template
+registries and renders the static documents of every form when it starts, including
+the workers that replace others after a configurable number of jobs.
+Signatures are sent to the workers as their compressed PNG bytes.
+
+Classes:
+- RenderPool: A bounded, pre-warmed pool of processes that run GeneratePDF.generate_pdf_bytes.
+
+Constants:
+- RENDER_TIMEOUT: The default number of seconds to wait for a PDF to render.
+"""
+import base64
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import List, Optional, Union
+from .fonts.fonts import FONT_REGISTRY, PROFILE_EMBEDDED
+from .form_templates import TEMPLATE_REGISTRY
+from .output_profiles import DEFAULT_OUTPUT_PROFILE
+from .pdf_gen import GeneratePDF
+from .signature import Signature
+
+RENDER_TIMEOUT = 30.0
+
+def _init_worker(profile: str) -> None:
+    """
+    Parses the fonts and form templates and renders the static documents of every form
+    when a worker process starts, so its first job is fast
+    """
+    FONT_REGISTRY.warm_up()
+    TEMPLATE_REGISTRY.load_all()
+    GeneratePDF(profile).warm_up()
+
+def _ready() -> None:
+    """Does nothing, run to wait for a worker to start"""
+
+def _render(profile: str, output_profile: str, client_name: str, form_name: str,
+            consent_flags: List[bool], signature: Union[Signature, str],
+            submit_datetime: datetime) -> bytes:
+    return GeneratePDF(profile, output_profile).generate_pdf_bytes(
+        client_name, form_name, consent_flags, signature, submit_datetime)
+
+class RenderPool:
+    """
+    A bounded, pre-warmed pool of processes that run GeneratePDF.generate_pdf_bytes.
+
+    At most workers * 2 jobs are queued or running at once, further callers wait for
+    a free slot. Workers are recycled after max_jobs_per_worker jobs, if given, and
+    render with the given render profile and, unless a job asks for another one, the
+    given output profile.
+    """
+    def __init__(self, workers: int, max_jobs_per_worker: Optional[int] = None,
+                 timeout: float = RENDER_TIMEOUT, profile: str = PROFILE_EMBEDDED,
+                 output_profile: str = DEFAULT_OUTPUT_PROFILE):
+        self.workers = workers
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.timeout = timeout
+        self.profile = profile
+        self.output_profile = output_profile
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots = threading.BoundedSemaphore(workers * 2)
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """
+        Starts the worker processes and waits for them to warm up. The executor starts a
+        worker for every job submitted while none is idle, so one job per worker starts
+        them all.
+        """
+        with self._lock:
+            if self._executor is not None:
+                return
+
+            # Recycling workers is only supported for processes that are not forked
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.profile,),
+                max_tasks_per_child=self.max_jobs_per_worker,
+            )
+            started = [self._executor.submit(_ready) for _ in range(self.workers)]
+
+        for future in started:
+            future.result()
+
+        logging.info("Render pool started with %d workers", self.workers)
+
+    def generate_pdf(self, client_name: str, form_name: str, consent_flags: List[bool],
+                     signature: Union[Signature, str], submit_datetime: datetime,
+                     output_profile: Optional[str] = None) -> str:
+        """Renders a PDF in a worker process, see GeneratePDF.generate_pdf"""
+        pdf_content: bytes = self.generate_pdf_bytes(client_name, form_name, consent_flags,
+                                                     signature, submit_datetime, output_profile)
+        return base64.b64encode(pdf_content).decode("utf-8")
+
+    def generate_pdf_bytes(self, client_name: str, form_name: str, consent_flags: List[bool],
+                           signature: Union[Signature, str], submit_datetime: datetime,
+                           output_profile: Optional[str] = None) -> bytes:
+        """Renders a PDF in a worker process, see GeneratePDF.generate_pdf_bytes"""
+        if self._executor is None:
+            self.start()
+
+        with self._slots:
+            future = self._executor.submit(_render, self.profile,
+                                           output_profile or self.output_profile,
+                                           client_name, form_name, consent_flags,
+                                           signature, submit_datetime)
+            return future.result(timeout=self.timeout)
+
+    def shutdown(self) -> None:
+        """Stops the worker processes"""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
@@ -2,199 +2,503 @@
 
 This module provides functionality to send emails with consent forms as a PDF to the
 clinic emailand also allows sending of a confirmation email to the patient's email.
+Messages are handed to a mail transport. By default they are sent over a pool of
+authenticated SMTP connections that are kept open between messages, and the messages
+of a submission are sent over a single session, pipelining the commands of each
+message when the server supports it. Messages are serialized while they are sent, so
+the encoded PDF and the whole message are never held in memory. A rate limiter can
+hold the emails back to the rate the relay allows, see MailRateLimiter.
+
+Classes:
+- EmailBuilder: Builds and serializes the emails, shared with AsyncSendEmail.
+- SendEmail: Sends the emails to the clinic or patient.
+- MailTransport: Delivers emails for SendEmail, see also HTTPTransport.
+- SMTPTransport: Sends emails over a pool of SMTP connections.
+- FailoverTransport: Spreads emails over several SMTP relays and fails over between them.
+- OutgoingEmail: An email ready to be sent.
+- DeliveryResult: How long sending an email took, and the error it failed with, if any.
 
 Functions:
 - send_email_to_clinic: 
-    Sends an email to the clinic with the consent form attached as a PDF.
+    Sends an email to the clinic with the base64-encoded consent form attached as a PDF.
+- send_pdf_to_clinic: 
+    Sends an email to the clinic with the raw bytes of the consent form attached as a PDF.
 - send_email_to_patient: 
     Sends a confirmation email to the patient after they submit the consent form.
+- send_submission:
+    Sends the clinic and patient emails of a submission over a single SMTP session.
+- send_emails:
+    Sends emails over the transport and reports how long each one took.
+- pace, refund:
+    Wait until emails may be sent, before they are handed to a mail worker, and give
+    the turn back if they are not.
+- message_chunks:
+    Serializes an email in chunks as it is sent.
+- clinic_email, patient_email:
+    Build the emails to the clinic and the patient.
+- pipelined_refusal:
+    Returns the error a transaction failed with, given its MAIL, RCPT and DATA replies.
+- log_error:
+    Logs why an email could not be sent.
 
 Private Functions:
 - _send_email: 
     Handles the actual sending of an email using the SMTP protocol with proper error handling.
+- _send_transaction:
+    Sends one email as a mail transaction, pipelined if the server supports it.
+- _Delivery:
+    The delivery loop state shared by SMTPTransport and AsyncSendEmail: which email is
+    next, when a lost session is replaced and when a throttled email is sent again.
 
 Constants:
 - CLINIC_SUBJECT: str
     Subject line for the submission email sent to the clinic.
 - PATIENT_SUBJECT: str
     Subject line for the confirmation email sent to the patient.
+- SMTP_ERRORS: list
+    Descriptions of the smtplib errors, used when an error is logged.
+- DATA_CHUNK_SIZE: int
+    Number of bytes of the PDF encoded and sent at a time.
 
 Exception Handling:
 - Various smtplib.SMTP exceptions are caught to provide detailed error logging.
 """
 
 import smtplib
+from abc import ABC, abstractmethod
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
-from email import encoders
+from email.charset import Charset, QP
+from email.policy import compat32
 import base64
 from datetime import datetime
 import logging
+import secrets
 import time
+from typing import (TYPE_CHECKING, Any, Callable, Dict, Iterator, List, NamedTuple, Optional,
+                    Tuple)
+from .email_templates import EMAIL_TEMPLATES, RenderedEmail, format_date, format_time
+from .rate_limit import MailRateLimiter
+from .relays import Relay, RelaySelector, is_relay_failure
+from .smtp_pool import SMTPConnectionPool, SMTP_IDLE_TIMEOUT, SMTP_POOL_SIZE, SMTP_TIMEOUT
+
+if TYPE_CHECKING:
+    # mail_retry sends through SendEmail, so it is only imported for type checking
+    from .mail_retry import RetryPolicy
 
 CLINIC_SUBJECT: str = "Patient Consent Form Submission - UNSW Optometry Clinic"
 PATIENT_SUBJECT: str = "Confirmation of Consent Form Submission - UNSW Optometry Clinic"
 
-class SendEmail:
-    """Handles the sending of emails to the clinic or patient"""
-    def __init__(self, server: str, port: int, user: str, pswd: str):
-        self.server = server
-        self.port = port
+# Descriptions of the smtplib errors, most specific first
+SMTP_ERRORS = [
+    (smtplib.SMTPAuthenticationError, "Failed to authenticate with the mail server"),
+    (smtplib.SMTPConnectError, "Failed to connect to the mail server"),
+    (smtplib.SMTPHeloError, "Server didn't reply properly to the HELO greeting"),
+    (smtplib.SMTPSenderRefused, "Sender address was refused by the server"),
+    (smtplib.SMTPRecipientsRefused, "Recipient address was refused by the server"),
+    (smtplib.SMTPDataError, "The server replied with an unexpected error code"),
+    (smtplib.SMTPNotSupportedError, "The command or option is not supported by the server"),
+    (smtplib.SMTPServerDisconnected, "Server unexpectedly disconnected"),
+]
+
+# Bytes of the PDF base64 encoded and sent at a time, a whole number of 57 byte lines
+DATA_CHUNK_SIZE = 57 * 1024
+# Serializes messages as they are sent over SMTP
+WIRE_POLICY = compat32.clone(linesep="\r\n")
+
+# Mostly ASCII text is smaller quoted-printable than base64
+_UTF8_QP = Charset("utf-8")
+_UTF8_QP.body_encoding = QP
+
+class OutgoingEmail(NamedTuple):
+    """An email ready to be sent, with its PDF attachment if it has one."""
+    email_to: str
+    subject: str
+    body: str
+    attach_name: str = "Consent Form.pdf"
+    pdf_content: Optional[bytes] = None
+    # Plain text alternative of the HTML body
+    text: Optional[str] = None
+
+class DeliveryResult(NamedTuple):
+    """How long sending an email took, and the error it failed with, if any."""
+    email_to: str
+    elapsed: float
+    error: Optional[BaseException] = None
+    # Seconds the email waited for the rate limiter before it was sent
+    waited: float = 0.0
+
+class EmailBuilder:
+    """Builds and serializes the emails to the clinic and patient, sent from user"""
+    def __init__(self, user: str):
         self.user = user
-        self.pswd = pswd
 
-    def send_email_to_clinic(self, email_to: str, attach_name:str , pdf_base64: str,
-                    patient_name: str, patient_email: str, submit_datetime: datetime) -> None:
+    def clinic_email(self, email_to: str, attach_name: str, pdf_content: bytes,
+                     patient_name: str, patient_email: str,
+                     submit_datetime: datetime) -> OutgoingEmail:
         """
-        Sends an email to the clinic with the consent form attached as a PDF.
+        Builds the email to the clinic with the consent form attached as a PDF.
 
         Args:
         - email_to (str): The recipient's email address.
         - attach_name (str): The name for the attached PDF file.
-        - pdf_base64 (str): The base64-encoded content of the PDF.
+        - pdf_content (bytes): The content of the PDF.
         - patient_name (str): The name of the patient.
         - patient_email (str): The email address of the patient.
         - submit_datetime (datetime): The date and time the form was submitted.
         """
 
-        start = time.time()
-        subject = CLINIC_SUBJECT
-        current_time = submit_datetime.strftime("%l:%M %p")
-        current_date = submit_datetime.strftime("%B %d, %Y")
-
-        body = f"""\
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta charset="UTF-8" />
-            <meta name="viewport" content="width=device-width, initial-scale=1.0" />
-            <title>Patient Consent Form Submission</title>
-        </head>
-        <body style="font-family: Arial, sans-serif; background-color: #f4f4f4; margin: 0; padding: 0;">
-            <div style="max-width: 600px; margin: 0 auto; padding: 20px; border: 1px solid #dddddd; border-radius: 5px; background-color: #ffffff;">
-                <div style="text-align: center; border-bottom: 1px solid #dddddd; padding-bottom: 20px;">
-                    <h1 style="margin: 0; color: black !important;">Patient Consent Form Submission</h1>
-                </div>
-
-                <div style="padding: 20px color: black !important;">
-                    <h2 style="margin-top: 0 color: black !important;">New Consent Form Received</h2>
-                    <p style="color: black !important;">A new patient consent form has been submitted with the following details:</p>
-                    <ul>
-                        <li style="color: black !important;">
-                            <strong>Patient Name:</strong> {patient_name}
-                        </li>
-                        <li style="color: black !important;">
-                            <strong>Patient Email:</strong> {patient_email}
-                        </li>
-                        <li style="color: black !important;">
-                            <strong>Submission Date:</strong> {current_date}
-                        </li>
-                        <li style="color: black !important;">
-                            <strong>Submission Time:</strong> {current_time}
-                        </li>
-                    </ul>
-                    <p style="color: black !important;">The completed consent form is attached to this email as a PDF file.</p>
-                    <p style="color: black !important;">Please process this form according to our standard procedures and add it to the patient's records.</p>
-                    <p style="color: black !important;">If you notice any issues with the form or require additional information, please contact the patient directly.</p>
-                </div>
-
-                <div style="text-align: center; border-top: 1px solid #dddddd; padding-top: 20px; font-size: 12px; color: #888888;">
-                    <p>This is an automated message from our patient consent form system.</p>
-                    <p>If you have any questions, please contact the IT department.</p>
-                    <p>&copy; 2024 Your Clinic Name. All rights reserved.</p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-
-        self._send_email(email_to, subject, body, attach_name=attach_name, pdf_base64=pdf_base64)
-        end = time.time()
-        logging.info("Email successfully sent to the clinic. Elapsed time: %.2f sec", end-start)
+        rendered: RenderedEmail = EMAIL_TEMPLATES.render(
+            "clinic",
+            patient_name=patient_name,
+            patient_email=patient_email,
+            current_date=format_date(submit_datetime),
+            current_time=format_time(submit_datetime),
+        )
+        return OutgoingEmail(email_to, CLINIC_SUBJECT, rendered.html, attach_name, pdf_content,
+                             rendered.text)
 
-    def send_email_to_patient(self, email_to: str, patient_name: str) -> None:
+    def patient_email(self, email_to: str, patient_name: str) -> OutgoingEmail:
         """
-        Sends a confirmation email to the patient after they submit the consent form.
+        Builds the confirmation email to the patient after they submit the consent form.
 
         Args:
         - email_to (str): The recipient's email address.
         - patient_name (str): The name of the patient.
         """
+        rendered: RenderedEmail = EMAIL_TEMPLATES.render("patient", patient_name=patient_name)
+        return OutgoingEmail(email_to, PATIENT_SUBJECT, rendered.html, text=rendered.text)
+
+    def _message_chunks(self, email: OutgoingEmail) -> Iterator[bytes]:
+        """Serializes an email sent from user, see message_chunks"""
+        return message_chunks(self.user, email)
+
+class MailTransport(ABC):
+    """Delivers serialized emails to a mail service for SendEmail."""
+    @abstractmethod
+    def send_emails(self, sender: str,
+                    emails: List[OutgoingEmail]) -> List[DeliveryResult]:
+        """
+        Sends emails from sender, and returns how long each took and the error it
+        failed with, if any. An email that fails does not stop the emails after it.
+        """
+
+    def pace(self, sender: str, count: int) -> float:
+        """
+        Waits until count emails from sender may be sent, and returns the seconds
+        waited. The emails then go out without waiting, so a caller can wait for its
+        turn before taking a mail worker. Transports that are not rate limited, or that
+        only pick the relay when sending, do not wait here, and ignore the arguments.
+        """
+        del sender, count
+        return 0.0
+
+    def refund(self, sender: str, count: int) -> None:
+        """
+        Gives back the turn paced for count emails from sender that are not sent.
+        Transports that do not pace have nothing to give back.
+        """
+        del sender, count
+
+    @abstractmethod
+    def stats(self) -> Dict[str, float]:
+        """Returns statistics about the connections of the transport"""
+
+    @abstractmethod
+    def close(self) -> None:
+        """Closes the connections of the transport"""
+
+class SMTPTransport(MailTransport):
+    """
+    Sends emails over a pool of authenticated SMTP connections, at the rate the
+    rate_limiter allows if one is given.
+    """
+    def __init__(self, server: str, port: int, user: str, pswd: str,
+                 pool_size: int = SMTP_POOL_SIZE, idle_timeout: float = SMTP_IDLE_TIMEOUT,
+                 starttls: bool = True, rate_limiter: Optional[MailRateLimiter] = None,
+                 timeout: float = SMTP_TIMEOUT):
+        self.pool = SMTPConnectionPool(server, port, user, pswd, pool_size, idle_timeout,
+                                       starttls, timeout)
+        self.relay = f"{server}:{port}"
+        self.rate_limiter = rate_limiter
+
+    def send_emails(self, sender: str,
+                    emails: List[OutgoingEmail]) -> List[DeliveryResult]:
+        """
+        Sends emails one after the other over a single pooled SMTP session, see
+        MailTransport.send_emails.
+
+        An email the server refuses does not stop the emails after it. If the session
+        is lost on a reused connection, which the server may have closed after its NOOP
+        check, the rest of the emails are sent on a new connection. An email the relay
+        throttles is sent once more, after the rate limiter has slowed down. The emails
+        wait for the rate limiter before a connection is taken, never while holding one.
+        """
+        delivery = _Delivery(emails, self.relay, sender, self.rate_limiter)
+        while delivery.pending:
+            delay = delivery.reserve()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                pooled = self.pool.acquire()
+            except (smtplib.SMTPException, OSError) as e:
+                delivery.unreachable(e)
+                break
+
+            lost: Optional[BaseException] = None
+            try:
+                while delivery.ready:
+                    start = time.perf_counter()
+                    try:
+                        self._send_transaction(pooled.smtp, sender, delivery.email)
+                        error = None
+                    except (smtplib.SMTPException, OSError) as e:
+                        if _Delivery.is_session_lost(e):
+                            lost = e
+                            break
+                        error = e
+                    delivery.done(time.perf_counter() - start, error)
+            except BaseException:
+                self.pool.release(pooled, discard=True)
+                raise
+
+            self.pool.release(pooled, discard=lost is not None)
+            if lost is not None and not delivery.lost(lost, pooled.reused):
+                break
+
+        return delivery.results
+
+    def _send_transaction(self, connection: smtplib.SMTP, sender: str,
+                          email: OutgoingEmail) -> None:
+        """Sends one email as a mail transaction of an open session"""
+        if "pipelining" in connection.esmtp_features:
+            self._open_pipelined(connection, sender, email.email_to)
+        else:
+            self._open_transaction(connection, sender, email.email_to)
+
+        writer = _DataWriter(connection.send)
+        for chunk in message_chunks(sender, email):
+            writer.write(chunk)
+        writer.close()
+
+        code, reply = connection.getreply()
+        if code != 250:
+            connection.rset()
+            raise smtplib.SMTPDataError(code, reply)
+
+    @staticmethod
+    def _open_transaction(connection: smtplib.SMTP, sender: str, email_to: str) -> None:
+        """Sends the MAIL, RCPT and DATA commands of a transaction one after the other"""
+        connection.ehlo_or_helo_if_needed()
+        code, reply = connection.mail(sender)
+        if code != 250:
+            connection.rset()
+            raise smtplib.SMTPSenderRefused(code, reply, sender)
+        code, reply = connection.rcpt(email_to)
+        if code not in (250, 251):
+            connection.rset()
+            raise smtplib.SMTPRecipientsRefused({email_to: (code, reply)})
+        code, reply = connection.docmd("DATA")
+        if code != 354:
+            connection.rset()
+            raise smtplib.SMTPDataError(code, reply)
+
+    @staticmethod
+    def _open_pipelined(connection: smtplib.SMTP, sender: str, email_to: str) -> None:
+        """
+        Sends the MAIL, RCPT and DATA commands of a transaction together and then reads
+        their replies, saving two round trips to the server (RFC 2920).
+        """
+        connection.send(f"MAIL FROM:{smtplib.quoteaddr(sender)}\r\n"
+                        f"RCPT TO:{smtplib.quoteaddr(email_to)}\r\n"
+                        "DATA\r\n")
+        replies = [connection.getreply() for _ in range(3)]
+        error = pipelined_refusal(sender, email_to, *replies)
+        if error is not None:
+            if replies[2][0] == 354:
+                # The server took the DATA command although the transaction failed, end it empty
+                connection.send(b".\r\n")
+                connection.getreply()
+            connection.rset()
+            raise error
+
+    def pace(self, sender: str, count: int) -> float:
+        """Waits until count emails from sender may be sent, see MailTransport.pace"""
+        if self.rate_limiter is None:
+            return 0.0
+        return self.rate_limiter.prepay(self.relay, sender, count)
+
+    def refund(self, sender: str, count: int) -> None:
+        """Gives back the turn paced for count emails, see MailTransport.refund"""
+        if self.rate_limiter is not None:
+            self.rate_limiter.refund(self.relay, sender, count)
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the number of connections opened and reused, see SMTPConnectionPool.stats"""
+        return self.pool.stats()
+
+    def close(self) -> None:
+        """Closes the idle SMTP connections"""
+        self.pool.close()
+
+class FailoverTransport(MailTransport):
+    """
+    Spreads emails over several SMTP relays, each with its own connection pool, and
+    fails over between them, see RelaySelector.
+
+    The emails of a call are sent through one relay. Those that fail through the fault
+    of the relay, because it is down, too slow to answer or refusing emails for now,
+    are sent through the next relay, so a relay that fails in the middle of a
+    submission only delays the rest of it.
+    """
+    def __init__(self, selector: RelaySelector, user: str, pswd: str,
+                 pool_size: int = SMTP_POOL_SIZE, idle_timeout: float = SMTP_IDLE_TIMEOUT,
+                 starttls: bool = True, rate_limiter: Optional[MailRateLimiter] = None,
+                 timeout: float = SMTP_TIMEOUT):
+        self.selector = selector
+        self.transports = {
+            health.relay.name: SMTPTransport(health.relay.server, health.relay.port,
+                                             health.relay.user or user,
+                                             health.relay.pswd or pswd, pool_size,
+                                             idle_timeout, starttls, rate_limiter, timeout)
+            for health in selector.relays
+        }
+
+    def send_emails(self, sender: str,
+                    emails: List[OutgoingEmail]) -> List[DeliveryResult]:
+        """
+        Sends emails through the relays, failing over until every email is sent or
+        every relay has been tried, see MailTransport.send_emails.
+        """
+        results: List[Optional[DeliveryResult]] = [None] * len(emails)
+        pending = list(range(len(emails)))
+        for relay in self.selector.order():
+            sent = self.transports[relay.name].send_emails(
+                sender, [emails[index] for index in pending])
+            failed = []
+            for index, result in zip(pending, sent):
+                self.selector.record(relay, result.elapsed, result.error)
+                results[index] = result
+                if result.error is not None and is_relay_failure(result.error):
+                    failed.append(index)
+            if not failed:
+                break
+            logging.warning("Mail relay %s failed %d email(s), trying the next relay",
+                            relay.name, len(failed))
+            pending = failed
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the connections opened and reused over every relay, and the health and
+        connection statistics of each relay
+        """
+        relays = self.selector.stats()
+        for relay in relays:
+            relay.update(self.transports[relay["relay"]].stats())
+        created = sum(relay["created"] for relay in relays)
+        reused = sum(relay["reused"] for relay in relays)
+        return {"created": created, "reused": reused,
+                "reuse_ratio": reused / (created + reused) if created + reused else 0.0,
+                "relays": relays}
+
+    def close(self) -> None:
+        """Closes the idle SMTP connections of every relay"""
+        for transport in self.transports.values():
+            transport.close()
+
+class SendEmail(EmailBuilder):
+    """
+    Handles the sending of emails to the clinic or patient.
+
+    Emails are sent through the server, or spread over the weighted relays if a list of
+    them is given, failing over between them, see FailoverTransport.
+    """
+    def __init__(self, server: str, port: int, user: str, pswd: str,
+                 pool_size: int = SMTP_POOL_SIZE, idle_timeout: float = SMTP_IDLE_TIMEOUT,
+                 starttls: bool = True, transport: Optional[MailTransport] = None,
+                 rate_limiter: Optional[MailRateLimiter] = None,
+                 relays: Optional[List[Relay]] = None):
+        super().__init__(user)
+        self.server = server
+        self.port = port
+        self.pswd = pswd
+        # Emails are sent over SMTP unless another transport is given
+        if transport is None and relays:
+            transport = FailoverTransport(RelaySelector(relays), user, pswd, pool_size,
+                                          idle_timeout, starttls, rate_limiter)
+        self.transport = transport or SMTPTransport(server, port, user, pswd, pool_size,
+                                                    idle_timeout, starttls, rate_limiter)
+
+    @property
+    def pool(self) -> Optional[SMTPConnectionPool]:
+        """The SMTP connection pool, if emails are sent over SMTP"""
+        return getattr(self.transport, "pool", None)
+
+    def send_email_to_clinic(self, email_to: str, attach_name:str , pdf_base64: str,
+                    patient_name: str, patient_email: str, submit_datetime: datetime) -> None:
+        """
+        Sends an email to the clinic with the base64-encoded consent form attached as a PDF.
+        See send_pdf_to_clinic, which takes the PDF as bytes and avoids the extra decoding.
+        """
+        self.send_pdf_to_clinic(email_to, attach_name, base64.b64decode(pdf_base64),
+                                patient_name, patient_email, submit_datetime)
+
+    def send_pdf_to_clinic(self, email_to: str, attach_name: str, pdf_content: bytes,
+                           patient_name: str, patient_email: str,
+                           submit_datetime: datetime) -> None:
+        """
+        Sends an email to the clinic with the consent form attached as a PDF,
+        see clinic_email.
+        """
+        start = time.time()
+        email = self.clinic_email(email_to, attach_name, pdf_content, patient_name,
+                                  patient_email, submit_datetime)
+        self._send_email(*email)
+        end = time.time()
+        logging.info("Email successfully sent to the clinic. Elapsed time: %.2f sec", end-start)
+
+    def send_email_to_patient(self, email_to: str, patient_name: str) -> None:
+        """
+        Sends a confirmation email to the patient after they submit the consent form,
+        see patient_email.
+        """
         start = time.time()
-        subject = PATIENT_SUBJECT
-
-        body = f"""\
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta charset="UTF-8" />
-            <meta name="viewport" content="width=device-width, initial-scale=1.0" />
-            <title>Confirmation Email</title>
-        </head>
-        <body
-            style="
-            font-family: Arial, sans-serif;
-            background-color: #f4f4f4;
-            margin: 0;
-            padding: 0;
-            "
-        >
-            <div
-            style="
-                max-width: 600px;
-                margin: 0 auto;
-                padding: 20px;
-                border: 1px solid #dddddd;
-                border-radius: 5px;
-                background-color: #ffffff;
-            "
-            >
-            <div
-                style="
-                text-align: center;
-                border-bottom: 1px solid #dddddd;
-                padding-bottom: 20px;
-                "
-            >
-                <h1 style="margin: 0; color: black">Confirmation Email</h1>
-            </div>
-
-            <div style="padding: 20px; color: black">
-                <h2 style="margin-top: 0">Dear {patient_name},</h2>
-                <p>
-                Thanks for filling out the consent form for the UNSW Optometry Clinic.
-                We appreciate your time and effort in providing us with your information and consent.
-                </p>
-
-                <p>
-                Thank you for choosing UNSW Optometry Clinic.
-                </p>
-            </div>
-
-            <div
-                style="
-                text-align: center;
-                border-top: 1px solid #dddddd;
-                padding-top: 20px;
-                font-size: 12px;
-                color: #888888;
-                "
-            >
-                <p>This is an automated message, please do not reply.</p>
-                <p>&copy; 2024 UNSW. All rights reserved.</p>
-            </div>
-            </div>
-        </body>
-        </html>
-        """
-
-        self._send_email(email_to, subject, body)
+        self._send_email(*self.patient_email(email_to, patient_name))
         end = time.time()
         logging.info("Email successfully sent to the patient. Elapsed time: %.2f sec", end-start)
 
+    def send_submission(self, email_to: str, attach_name: str, pdf_content: bytes,
+                        patient_name: str, patient_email: str, submit_datetime: datetime,
+                        retry_policy: Optional["RetryPolicy"] = None) -> List[DeliveryResult]:
+        """
+        Sends the clinic and patient emails of a submission over a single SMTP session,
+        see clinic_email and patient_email, and raises the first error once both have
+        been tried. With a retry_policy, emails that fail with a temporary error are
+        sent again before giving up, see RetryPolicy.send_emails.
+        """
+        start = time.time()
+        emails = [
+            self.clinic_email(email_to, attach_name, pdf_content, patient_name,
+                              patient_email, submit_datetime),
+            self.patient_email(patient_email, patient_name),
+        ]
+        results = (retry_policy.send_emails(self, emails) if retry_policy is not None
+                   else self.send_emails(emails))
+        for name, result in zip(("clinic", "patient"), results):
+            logging.info("Email to the %s %s in %.3f sec, throttled for %.3f sec", name,
+                         "failed" if result.error is not None else "sent", result.elapsed,
+                         result.waited)
+        logging.info("Emails of the submission sent. Elapsed time: %.2f sec", time.time() - start)
+
+        for result in results:
+            if result.error is not None:
+                raise result.error
+        return results
+
     def _send_email(self, email_to: str, subject: str, body: str,
-                    attach_name="Consent Form.pdf", pdf_base64=None) -> None:
+                    attach_name="Consent Form.pdf", pdf_content=None, text=None) -> None:
         """
         Handles the actual sending of an email using the SMTP protocol with error handling.
         
@@ -203,60 +507,232 @@ class SendEmail:
         - subject (int): The subject of the email.
         - body (str): The body content of the email.
         - attach_name (str): The name for the attached PDF file.
-        - pdf_base64 (str): The base64-encoded content of the PDF.
-        """
-        connection: smtplib.SMTP = None
-
-        try:
-            connection = smtplib.SMTP(self.server, self.port)
-            connection.starttls()
-            connection.login(self.user, self.pswd)
-
-            msg = MIMEMultipart()
-            msg["From"] = self.user
-            msg["To"] = email_to
-            msg["Subject"] = subject
-
-            msg.attach(MIMEText(body, "html"))
-
-            if pdf_base64 is not None:
-                attachment_decoded = base64.b64decode(pdf_base64)
-                attach_package = MIMEBase("application", "pdf")
-                attach_package.set_payload(attachment_decoded)
-                encoders.encode_base64(attach_package)
-                attach_package.add_header("Content-Disposition",
-                                          f"attachment; filename= {attach_name}")
-                msg.attach(attach_package)
-
-            text = msg.as_string()
-            connection.sendmail(self.user, email_to, text)
-        except smtplib.SMTPAuthenticationError as e:
-            logging.error("Failed to authenticate with the mail server: %s", e)
-            raise e
-        except smtplib.SMTPConnectError as e:
-            logging.error("Failed to connect to the mail server: %s", e)
-            raise e
-        except smtplib.SMTPHeloError as e:
-            logging.error("Server didn't reply properly to the HELO greeting: %s", e)
-            raise e
-        except smtplib.SMTPSenderRefused as e:
-            logging.error("Sender address was refused by the server: %s", e)
-            raise e
-        except smtplib.SMTPRecipientsRefused as e:
-            logging.error("Recipient address was refused by the server: %s", e)
-            raise e
-        except smtplib.SMTPDataError as e:
-            logging.error("The server replied with an unexpected error code: %s", e)
-            raise e
-        except smtplib.SMTPNotSupportedError as e:
-            logging.error("The command or option is not supported by the server: %s", e)
-            raise e
-        except smtplib.SMTPServerDisconnected as e:
-            logging.error("Server unexpectedly disconnected: %s", e)
-            raise e
-        except smtplib.SMTPException as e:
-            logging.error("An error occurred while sending the email: %s", e)
-            raise e
-        finally:
-            if connection:
-                connection.close()
+        - pdf_content (bytes): The content of the PDF, base64-encoded only when the
+          message is serialized.
+        - text (str): The plain text alternative of the body.
+        """
+        result = self.send_emails([OutgoingEmail(email_to, subject, body, attach_name,
+                                                 pdf_content, text)])[0]
+        if result.error is not None:
+            raise result.error
+
+    def pace(self, count: int) -> float:
+        """
+        Waits until count emails may be sent, and returns the seconds waited,
+        see MailTransport.pace
+        """
+        return self.transport.pace(self.user, count)
+
+    def refund(self, count: int) -> None:
+        """Gives back the turn paced for count emails that are not sent, see pace"""
+        self.transport.refund(self.user, count)
+
+    def send_emails(self, emails: List[OutgoingEmail]) -> List[DeliveryResult]:
+        """
+        Sends emails over the transport, and returns how long each took and the error
+        it failed with, if any, see MailTransport.send_emails.
+        """
+        return self.transport.send_emails(self.user, emails)
+
+    def close(self) -> None:
+        """Closes the connections of the transport"""
+        self.transport.close()
+
+def log_error(error: BaseException) -> None:
+    """Logs why an email could not be sent"""
+    for error_type, description in SMTP_ERRORS:
+        if isinstance(error, error_type):
+            logging.error("%s: %s", description, error)
+            return
+    logging.error("An error occurred while sending the email: %s", error)
+
+def _mime_text(text: str, subtype: str) -> MIMEText:
+    """Returns a text part, quoted-printable rather than base64 if it is not ASCII"""
+    if text.isascii():
+        return MIMEText(text, subtype)
+    return MIMEText(text, subtype, _UTF8_QP)
+
+def pipelined_refusal(sender: str, email_to: str, mail: Tuple[int, bytes],
+                      rcpt: Tuple[int, bytes], data: Tuple[int, bytes]) -> Optional[Exception]:
+    """
+    Returns the error a pipelined transaction failed with, given the replies to its
+    MAIL, RCPT and DATA commands, or None if the server is ready for the message
+    """
+    if mail[0] != 250:
+        return smtplib.SMTPSenderRefused(mail[0], mail[1], sender)
+    if rcpt[0] not in (250, 251):
+        return smtplib.SMTPRecipientsRefused({email_to: rcpt})
+    if data[0] != 354:
+        return smtplib.SMTPDataError(*data)
+    return None
+
+def message_chunks(sender: str, email: OutgoingEmail) -> Iterator[bytes]:
+    """
+    Serializes an email with its plain text part and PDF attachment, if it has them,
+    in chunks with CRLF line endings.
+
+    The text parts are small and serialized by the email package. The PDF is base64
+    encoded a chunk at a time while it is sent, as the email package would hold the
+    whole encoded attachment, and then the whole message, in memory.
+    """
+    body: MIMEBase = _mime_text(email.body, "html")
+    if email.text is not None:
+        body = MIMEMultipart("alternative")
+        body.attach(_mime_text(email.text, "plain"))
+        body.attach(_mime_text(email.body, "html"))
+
+    if email.pdf_content is None:
+        _add_headers(body, sender, email)
+        yield body.as_bytes(policy=WIRE_POLICY)
+        return
+
+    boundary = f"{'=' * 15}{secrets.token_hex(16)}=="
+    msg = MIMEMultipart(boundary=boundary)
+    _add_headers(msg, sender, email)
+    attachment = MIMEBase("application", "pdf")
+    attachment["Content-Transfer-Encoding"] = "base64"
+    attachment.add_header("Content-Disposition", f"attachment; filename= {email.attach_name}")
+
+    delimiter = f"--{boundary}\r\n".encode("ascii")
+    yield _header_bytes(msg) + delimiter + body.as_bytes(policy=WIRE_POLICY)
+    yield b"\r\n" + delimiter + _header_bytes(attachment)
+    view = memoryview(email.pdf_content)
+    for start in range(0, len(view), DATA_CHUNK_SIZE):
+        yield base64.encodebytes(view[start:start + DATA_CHUNK_SIZE]).replace(b"\n", b"\r\n")
+    yield f"--{boundary}--\r\n".encode("ascii")
+
+def _add_headers(msg: MIMEBase, sender: str, email: OutgoingEmail) -> None:
+    msg["From"] = sender
+    msg["To"] = email.email_to
+    msg["Subject"] = email.subject
+
+def _header_bytes(msg: MIMEBase) -> bytes:
+    """Returns the header block of a message part, with the blank line that ends it"""
+    return b"".join(WIRE_POLICY.fold_binary(name, value) for name, value in msg.items()) + b"\r\n"
+
+class _DataWriter:
+    """
+    Sends the data of a mail transaction in chunks, escaping dots at the start of a line
+    and ending it with the end-of-data marker.
+    """
+    def __init__(self, send: Callable[[bytes], Any], chunk_size: int = DATA_CHUNK_SIZE):
+        self._send = send
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._line_start = True
+
+    def write(self, data: bytes) -> None:
+        """Queues data with CRLF line endings, sending it once a chunk is full"""
+        if not data:
+            return
+        if self._line_start and data.startswith(b"."):
+            self._buffer += b"."
+        self._buffer += data.replace(b"\n.", b"\n..")
+        self._line_start = data.endswith(b"\n")
+        if len(self._buffer) >= self._chunk_size:
+            self._flush()
+
+    def close(self) -> None:
+        """Sends the rest of the data and the end-of-data marker"""
+        if not self._line_start:
+            self._buffer += b"\r\n"
+        self._buffer += b".\r\n"
+        self._flush()
+
+    def _flush(self) -> None:
+        self._send(bytes(self._buffer))
+        self._buffer.clear()
+
+class _Delivery:
+    """
+    The emails of a send_emails call over SMTP sessions, shared by SMTPTransport and
+    AsyncSendEmail, which drive it over blocking and asyncio sessions.
+
+    It keeps the emails left to send and the results of the others, and decides when a
+    lost session is replaced and when a throttled email is sent again. The rate limiter
+    tokens of the emails are reserved before a session is taken, so the wait for them
+    does not hold a connection.
+    """
+    def __init__(self, emails: List[OutgoingEmail], relay: str, sender: str,
+                 rate_limiter: Optional[MailRateLimiter] = None):
+        self.pending = list(emails)
+        self.results: List[DeliveryResult] = []
+        self.relay = relay
+        self.sender = sender
+        self.rate_limiter = rate_limiter
+        # Seconds each pending email waited for the rate limiter, and whether it has a token
+        self._waited = [0.0] * len(emails)
+        self._reserved = [rate_limiter is None] * len(emails)
+        self._retried = False
+        self._reconnected = False
+
+    @property
+    def email(self) -> OutgoingEmail:
+        """The next email to send"""
+        return self.pending[0]
+
+    @property
+    def ready(self) -> bool:
+        """Whether the next email can be sent, having its rate limiter token"""
+        return bool(self.pending) and self._reserved[0]
+
+    @staticmethod
+    def is_session_lost(error: BaseException) -> bool:
+        """Returns whether an error sending an email ended the session, not just the email"""
+        return (isinstance(error, smtplib.SMTPServerDisconnected)
+                or not isinstance(error, smtplib.SMTPException))
+
+    def reserve(self) -> float:
+        """
+        Takes a rate limiter token for every pending email without one, and returns the
+        seconds to wait before taking a session to send them
+        """
+        delay = 0.0
+        for index, reserved in enumerate(self._reserved):
+            if not reserved:
+                wait = self.rate_limiter.reserve(self.relay, self.sender)
+                self._waited[index] += wait
+                self._reserved[index] = True
+                delay = max(delay, wait)
+        return delay
+
+    def done(self, elapsed: float, error: Optional[BaseException] = None) -> None:
+        """
+        Records the result of the next email. An email the relay throttles is kept to be
+        sent once more, with a new token once the rate limiter has slowed down.
+        """
+        if (error is not None and not self._retried and self.rate_limiter is not None
+                and self.rate_limiter.backoff(self.relay, self.sender, error)):
+            logging.info("The mail server is throttling, slowing down: %s", error)
+            self._retried = True
+            self._reserved[0] = False
+            return
+        if error is not None:
+            log_error(error)
+        self.results.append(DeliveryResult(self.email.email_to, elapsed, error,
+                                           self._waited[0]))
+        self.pending.pop(0)
+        self._waited.pop(0)
+        self._reserved.pop(0)
+        self._retried = False
+
+    def lost(self, error: BaseException, reused: bool) -> bool:
+        """
+        Records a lost session, and returns whether the rest of the emails are sent on
+        a new one, which they are once if the lost session was a reused one
+        """
+        if reused and not self._reconnected:
+            logging.info("SMTP connection was closed while sending, retrying on a new one")
+            self._reconnected = True
+            return True
+        self.unreachable(error)
+        return False
+
+    def unreachable(self, error: BaseException) -> None:
+        """Fails the emails left to send, as no session could be had"""
+        log_error(error)
+        self.results.extend(DeliveryResult(email.email_to, 0.0, error, waited)
+                            for email, waited in zip(self.pending, self._waited))
+        self.pending.clear()
+        self._waited.clear()
+        self._reserved.clear()
@@ -0,0 +1,130 @@
+"""Module for decoding signature images.
+
+The signature drawn on the form arrives as a base64 encoded PNG data URI. This module
+decodes and parses it once, while the submission is validated, so the PDF renderer can
+embed the parsed image without decoding the data URI or the PNG again.
+
+Signatures are drawn on a full size, mostly transparent canvas. Before a signature is
+embedded it is normalized: the empty margins are trimmed, it is scaled down to the
+resolution it is printed at, and it is reduced to black and white (or grayscale), so
+the image is small and fpdf2 does not have to split out an alpha mask.
+
+Classes:
+- Signature: A validated signature image decoded from a data URI.
+- NormalizedSignature: A signature image prepared for printing, with its printed size.
+
+Constants:
+- DATA_URI_PATTERN: Pattern of a base64 encoded PNG data URI.
+- PRINT_DPI: Resolution in dots per inch that signatures are scaled down to.
+- BILEVEL_THRESHOLD: Gray level below which a pixel is printed as ink in black and white.
+
+Exception Handling:
+- ValueError is raised when a data URI is not a valid base64 encoded PNG image.
+"""
+import base64
+import binascii
+import io
+import re
+from typing import NamedTuple, Tuple
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+DATA_URI_PATTERN = r"^data:image/png(?:;charset=utf-8)?;base64,[A-Za-z0-9+/=]+$"
+PRINT_DPI = 300
+BILEVEL_THRESHOLD = 160
+
+MM_PER_INCH = 25.4
+
+class NormalizedSignature(NamedTuple):
+    """A signature image prepared for printing, with its printed size in millimetres."""
+    image: Image.Image
+    width: float
+    height: float
+
+class Signature:
+    """
+    A validated signature image, decoded and parsed once from its data URI.
+
+    The PNG bytes are kept alongside the parsed image so a signature sent to a worker
+    process is pickled compressed rather than as raw pixels.
+    """
+    def __init__(self, png_data: bytes, image: Image.Image):
+        self.png_data = png_data
+        self.image = image
+
+    @classmethod
+    def from_data_uri(cls, data_uri: str) -> "Signature":
+        """Decodes and parses a base64 encoded PNG data URI"""
+        if not isinstance(data_uri, str) or not re.match(DATA_URI_PATTERN, data_uri):
+            raise ValueError("Not a valid Base64 PNG data URI.")
+
+        try:
+            png_data: bytes = base64.b64decode(data_uri.split("base64,", 1)[1], validate=True)
+        except binascii.Error as e:
+            raise ValueError(f"Invalid signature image: {e}") from e
+
+        return cls.from_png(png_data)
+
+    @classmethod
+    def from_png(cls, png_data: bytes) -> "Signature":
+        """Parses the bytes of a PNG image"""
+        try:
+            image = Image.open(io.BytesIO(png_data))
+            if image.format != "PNG":
+                raise ValueError("Signature image must be in PNG format")
+            # Decode the pixels now so a truncated or corrupt image fails validation
+            image.load()
+        except (OSError, SyntaxError, UnidentifiedImageError) as e:
+            raise ValueError(f"Invalid signature image: {e}") from e
+
+        return cls(png_data, image)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """The width and height of the image in pixels"""
+        return self.image.size
+
+    def normalize(self, height: float, dpi: int = PRINT_DPI,
+                  bilevel: bool = True) -> NormalizedSignature:
+        """
+        Prepares the image to be printed with the whole canvas the given height in millimetres.
+
+        The ink keeps the size it would have had on the full canvas, only the empty
+        margins around it are dropped.
+        """
+        gray = self._flatten()
+
+        # The bounding box of the ink, a blank canvas is kept whole
+        bbox = ImageOps.invert(gray).getbbox() or (0, 0, gray.width, gray.height)
+        gray = gray.crop(bbox)
+
+        mm_per_pixel = height / self.image.height
+        width_mm = gray.width * mm_per_pixel
+        height_mm = gray.height * mm_per_pixel
+
+        # Never scale up, a small canvas is printed at a lower resolution
+        target_height = max(1, round(height_mm / MM_PER_INCH * dpi))
+        if gray.height > target_height:
+            target_width = max(1, round(gray.width * target_height / gray.height))
+            gray = gray.resize((target_width, target_height), Image.Resampling.LANCZOS)
+
+        if bilevel:
+            gray = gray.point(lambda level: 255 if level >= BILEVEL_THRESHOLD else 0, mode="1")
+
+        return NormalizedSignature(gray, width_mm, height_mm)
+
+    def _flatten(self) -> Image.Image:
+        """Returns the image in grayscale on a white background"""
+        image = self.image
+        if image.mode in ("P", "PA"):
+            image = image.convert("RGBA")
+
+        if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+            image = image.convert("RGBA")
+            background = Image.new("L", image.size, 255)
+            background.paste(image.convert("L"), mask=image.getchannel("A"))
+            return background
+
+        return image.convert("L")
+
+    def __reduce__(self):
+        return (Signature.from_png, (self.png_data,))
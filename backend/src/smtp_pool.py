@@ -0,0 +1,182 @@
+"""Module for pooling SMTP connections.
+
+Opening an SMTP connection takes a TCP handshake, a STARTTLS handshake and a login,
+which cost more than sending a consent form. This module keeps authenticated
+connections open between messages and hands them out to one sender at a time.
+Idle connections are checked with NOOP before they are reused, and connections
+that have been idle too long or that the server has dropped are replaced.
+
+Classes:
+- PooledConnection: An authenticated SMTP connection lent out by the pool.
+- SMTPConnectionPool: Thread-safe pool of authenticated SMTP connections.
+
+Constants:
+- SMTP_POOL_SIZE: The default number of connections open at once.
+- SMTP_IDLE_TIMEOUT: The default number of seconds a connection may be idle before
+  it is closed rather than reused.
+- SMTP_TIMEOUT: The default number of seconds to connect or to wait for a reply.
+
+Exception Handling:
+- The smtplib exceptions raised while connecting or logging in are passed to the caller.
+"""
+import logging
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Union
+
+SMTP_POOL_SIZE = 2
+SMTP_IDLE_TIMEOUT = 60.0
+SMTP_TIMEOUT = 30.0
+
+class PooledConnection:
+    """An authenticated SMTP connection lent out by the pool."""
+    def __init__(self, smtp: smtplib.SMTP):
+        self.smtp = smtp
+        self.reused = False
+        self.last_used = time.monotonic()
+
+class SMTPConnectionPool:
+    """
+    Thread-safe pool of authenticated SMTP connections.
+
+    At most size connections are open at once, further senders wait for one to be
+    returned. A connection is returned to the pool after a message is sent, and is
+    closed instead if sending failed, as the session may no longer be usable.
+    STARTTLS can be turned off for relays on a trusted network that do not offer it.
+    A relay that does not answer within timeout seconds fails with socket.timeout.
+    """
+    def __init__(self, server: str, port: Union[int, str], user: str, pswd: str,
+                 size: int = SMTP_POOL_SIZE, idle_timeout: float = SMTP_IDLE_TIMEOUT,
+                 starttls: bool = True, timeout: float = SMTP_TIMEOUT):
+        self.server = server
+        self.port = port
+        self.user = user
+        self.pswd = pswd
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.starttls = starttls
+        self.timeout = timeout
+        self.created = 0
+        self.reused = 0
+        self.replaced = 0
+        self._idle: List[PooledConnection] = []
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self) -> Iterator[PooledConnection]:
+        """Lends out a connection, and takes it back or closes it afterwards"""
+        pooled = self.acquire()
+        try:
+            yield pooled
+        except BaseException:
+            self.release(pooled, discard=True)
+            raise
+        self.release(pooled)
+
+    def acquire(self) -> PooledConnection:
+        """Returns a live connection, reusing an idle one if there is one"""
+        self._slots.acquire()
+        try:
+            pooled = self._take_idle()
+            if pooled is None:
+                pooled = self._connect()
+            return pooled
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, pooled: PooledConnection, discard: bool = False) -> None:
+        """Returns a connection to the pool, or closes it if it is discarded"""
+        try:
+            if discard:
+                self._close(pooled)
+                return
+
+            pooled.last_used = time.monotonic()
+            with self._lock:
+                self._idle.append(pooled)
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        """Closes every idle connection"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for pooled in idle:
+            self._close(pooled)
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """Returns the connection counters and the share of messages sent on a reused connection"""
+        with self._lock:
+            uses = self.created + self.reused
+            return {
+                "created": self.created,
+                "reused": self.reused,
+                "replaced": self.replaced,
+                "idle": len(self._idle),
+                "reuse_ratio": self.reused / uses if uses else 0.0,
+            }
+
+    def _take_idle(self) -> Optional[PooledConnection]:
+        """Returns the most recently used idle connection that is still alive"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                pooled = self._idle.pop()
+
+            if time.monotonic() - pooled.last_used > self.idle_timeout:
+                logging.debug("Closing SMTP connection idle for more than %.0f sec",
+                              self.idle_timeout)
+                self._replace(pooled)
+                continue
+
+            if not self._is_alive(pooled):
+                logging.info("SMTP connection was closed by the server, replacing it")
+                self._replace(pooled)
+                continue
+
+            pooled.reused = True
+            with self._lock:
+                self.reused += 1
+            return pooled
+
+    def _connect(self) -> PooledConnection:
+        connection = smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                connection.starttls()
+            connection.login(self.user, self.pswd)
+        except BaseException:
+            connection.close()
+            raise
+
+        with self._lock:
+            self.created += 1
+        return PooledConnection(connection)
+
+    def _replace(self, pooled: PooledConnection) -> None:
+        self._close(pooled)
+        with self._lock:
+            self.replaced += 1
+
+    @staticmethod
+    def _is_alive(pooled: PooledConnection) -> bool:
+        try:
+            code, _ = pooled.smtp.noop()
+        except (smtplib.SMTPException, OSError):
+            return False
+        return code == 250
+
+    @staticmethod
+    def _close(pooled: PooledConnection) -> None:
+        try:
+            pooled.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        finally:
+            pooled.smtp.close()
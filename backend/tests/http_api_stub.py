@@ -0,0 +1,119 @@
+"""Local HTTP server standing in for the mail API in tests.
+
+The stub answers POST /emails and POST /emails/batch as a Resend-style API does, over
+keep-alive HTTP/1.1 connections. It keeps every request it accepts and counts the
+connections it was sent on, and can be told to answer requests with an error.
+"""
+import json
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+class ReceivedRequest(NamedTuple):
+    """A request accepted by the stub."""
+    connection: int
+    path: str
+    headers: Dict[str, str]
+    body: Any
+
+class _APIHandler(BaseHTTPRequestHandler):
+    """Handles the requests of one connection."""
+    protocol_version = "HTTP/1.1"
+    server: "_APIServer"
+
+    def setup(self):
+        super().setup()
+        self.number = self.server.stub.open_connection()
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Answers a request to send one email or a batch of emails"""
+        stub = self.server.stub
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+        failure = stub.take_failure()
+        if failure is not None:
+            self._reply(failure[0], {"statusCode": failure[0], "message": failure[1]})
+        elif self.path == "/emails":
+            stub.accept(ReceivedRequest(self.number, self.path, dict(self.headers), body))
+            self._reply(200, {"id": secrets.token_hex(8)})
+        elif self.path == "/emails/batch":
+            stub.accept(ReceivedRequest(self.number, self.path, dict(self.headers), body))
+            self._reply(200, {"data": [{"id": secrets.token_hex(8)} for _ in body]})
+        else:
+            self._reply(404, {"statusCode": 404, "message": "Not found"})
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _reply(self, status: int, body: Dict[str, Any]) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class _APIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, stub: "HTTPAPIStub"):
+        self.stub = stub
+        super().__init__(("127.0.0.1", 0), _APIHandler)
+
+class HTTPAPIStub:
+    """
+    Local HTTP server standing in for the mail API.
+
+    Used as a context manager, the stub listens on a free port of the loopback
+    interface until the block exits.
+    """
+    def __init__(self):
+        self.requests: List[ReceivedRequest] = []
+        self.connections = 0
+        self._failures: List[Tuple[int, str]] = []
+        self._lock = threading.Lock()
+        self._server: Optional[_APIServer] = None
+
+    @property
+    def url(self) -> str:
+        """The address of the stub"""
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self) -> "HTTPAPIStub":
+        """Starts listening in a background thread"""
+        self._server = _APIServer(self)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        """Stops listening"""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def fail(self, status: int, message: str, times: int = 1) -> None:
+        """Answers the next times requests with an error"""
+        with self._lock:
+            self._failures.extend([(status, message)] * times)
+
+    def open_connection(self) -> int:
+        """Registers a new connection and returns its number"""
+        with self._lock:
+            self.connections += 1
+            return self.connections
+
+    def take_failure(self) -> Optional[Tuple[int, str]]:
+        """Returns the error to answer a request with, if one is queued"""
+        with self._lock:
+            return self._failures.pop(0) if self._failures else None
+
+    def accept(self, request: ReceivedRequest) -> None:
+        """Keeps a request"""
+        with self._lock:
+            self.requests.append(request)
+
+    def __enter__(self) -> "HTTPAPIStub":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
@@ -0,0 +1,233 @@
+"""Local SMTP server standing in for the mail relay in tests.
+
+The stub speaks enough SMTP for smtplib: EHLO, STARTTLS, AUTH PLAIN and LOGIN, MAIL,
+RCPT, DATA, RSET, NOOP and QUIT. STARTTLS is offered when the stub is given a TLS
+context, such as the one from tls_context with the self-signed certificate in
+smtp_stub_cert.pem. It keeps every message it accepts, and can be told to reply to a
+command with an error, to drop its connections or to go down after a number of
+messages, to test how senders handle a relay that is throttling or going away.
+"""
+import base64
+import os
+import socket
+import socketserver
+import ssl
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+# Self-signed certificate and key for localhost and 127.0.0.1
+CERT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "smtp_stub_cert.pem")
+
+def tls_context() -> ssl.SSLContext:
+    """Returns a server TLS context with the self-signed certificate of the stub"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(CERT_FILE)
+    return context
+
+class ReceivedMessage(NamedTuple):
+    """A message accepted by the stub."""
+    session: int
+    mail_from: str
+    rcpt_tos: List[str]
+    data: bytes
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Handles one SMTP session."""
+    server: "_SMTPServer"
+
+    def handle(self):
+        stub = self.server.stub
+        if stub.is_down():
+            return
+        session = stub.open_session(self.connection)
+        mail_from, rcpt_tos = None, []
+        secure = False
+        self._reply(220, "stub ESMTP")
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                command, _, argument = line.decode("ascii").rstrip("\r\n").partition(" ")
+                command = command.upper()
+                stub.commands.append(command)
+
+                failure = stub.take_failure(command)
+                if failure is not None:
+                    if command == "DATA":
+                        self._reply(354, "End data with <CR><LF>.<CR><LF>")
+                        self._read_data()
+                    self._reply(*failure)
+                    continue
+
+                if command in ("EHLO", "HELO"):
+                    starttls = ("STARTTLS",) if stub.tls_context and not secure else ()
+                    self._reply(250, "stub", *stub.extensions, *starttls)
+                elif command == "STARTTLS" and stub.tls_context and not secure:
+                    self._reply(220, "Ready to start TLS")
+                    self._start_tls(stub)
+                    secure = True
+                elif command == "AUTH":
+                    self._auth(argument)
+                elif command == "MAIL":
+                    mail_from, rcpt_tos = argument.split(":", 1)[1].split()[0].strip("<>"), []
+                    self._reply(250, "OK")
+                elif command == "RCPT":
+                    rcpt_tos.append(argument.split(":", 1)[1].strip().strip("<>"))
+                    self._reply(250, "OK")
+                elif command == "DATA" and not rcpt_tos:
+                    self._reply(554, "No valid recipients")
+                elif command == "DATA":
+                    self._reply(354, "End data with <CR><LF>.<CR><LF>")
+                    stub.accept(ReceivedMessage(session, mail_from, rcpt_tos, self._read_data()))
+                    mail_from, rcpt_tos = None, []
+                    self._reply(250, "OK queued")
+                    if stub.is_down():
+                        return
+                elif command in ("RSET", "NOOP"):
+                    mail_from, rcpt_tos = None, []
+                    self._reply(250, "OK")
+                elif command == "QUIT":
+                    self._reply(221, "Bye")
+                    return
+                else:
+                    self._reply(502, "Command not implemented")
+        except (ConnectionError, OSError, ValueError):
+            return
+
+    def _start_tls(self, stub: "SMTPStub") -> None:
+        plain = self.connection
+        self.connection = stub.tls_context.wrap_socket(plain, server_side=True)
+        stub.secure_session(plain, self.connection)
+        self.rfile = self.connection.makefile("rb")
+        self.wfile = self.connection.makefile("wb", buffering=0)
+
+    def _auth(self, argument: str) -> None:
+        mechanism, _, response = argument.partition(" ")
+        if mechanism.upper() == "LOGIN":
+            prompts = [b"Password:"] if response else [b"Username:", b"Password:"]
+            for prompt in prompts:
+                self._reply(334, base64.b64encode(prompt).decode("ascii"))
+                self.rfile.readline()
+        elif not response:
+            self._reply(334, "")
+            self.rfile.readline()
+        self._reply(235, "Authentication successful")
+
+    def _read_data(self) -> bytes:
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if line in (b".\r\n", b".\n", b""):
+                return b"".join(lines)
+            lines.append(line[1:] if line.startswith(b".") else line)
+
+    def _reply(self, code: int, *lines: str) -> None:
+        lines = lines or ("",)
+        reply = "".join(f"{code}-{line}\r\n" for line in lines[:-1]) + f"{code} {lines[-1]}\r\n"
+        self.wfile.write(reply.encode("ascii"))
+
+class _SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, stub: "SMTPStub"):
+        self.stub = stub
+        super().__init__(("127.0.0.1", 0), _SMTPHandler)
+
+class SMTPStub:
+    """
+    Local SMTP server standing in for the mail relay.
+
+    Used as a context manager, the stub listens on a free port of the loopback
+    interface until the block exits.
+    """
+    def __init__(self, extensions: Tuple[str, ...] = ("AUTH PLAIN LOGIN", "8BITMIME"),
+                 tls_context: Optional[ssl.SSLContext] = None):
+        self.extensions = extensions
+        self.tls_context = tls_context
+        self.tls_sessions = 0
+        self.messages: List[ReceivedMessage] = []
+        self.commands: List[str] = []
+        self.sessions = 0
+        # Number of messages after which the stub closes its sessions and refuses new ones
+        self.down_after: Optional[int] = None
+        self._failures: Dict[str, List[Tuple[int, str]]] = {}
+        self._connections: List[socket.socket] = []
+        self._lock = threading.Lock()
+        self._received = threading.Condition(self._lock)
+        self._server: Optional[_SMTPServer] = None
+
+    @property
+    def port(self) -> int:
+        """The port the stub listens on"""
+        return self._server.server_address[1]
+
+    def start(self) -> "SMTPStub":
+        """Starts listening in a background thread"""
+        self._server = _SMTPServer(self)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        """Stops listening and drops every open connection"""
+        self._server.shutdown()
+        self._server.server_close()
+        self.drop_connections()
+
+    def fail(self, command: str, code: int, message: str, times: int = 1) -> None:
+        """Replies to the next times uses of a command with an error"""
+        with self._lock:
+            self._failures.setdefault(command.upper(), []).extend([(code, message)] * times)
+
+    def is_down(self) -> bool:
+        """Returns whether the stub has gone down after down_after messages"""
+        with self._lock:
+            return self.down_after is not None and len(self.messages) >= self.down_after
+
+    def drop_connections(self) -> None:
+        """Closes every open connection, as a relay does after an idle timeout"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def wait_for(self, count: int, timeout: float = 5.0) -> bool:
+        """Waits until the stub has accepted count messages"""
+        with self._received:
+            return self._received.wait_for(lambda: len(self.messages) >= count, timeout)
+
+    def open_session(self, connection: socket.socket) -> int:
+        """Registers a new connection and returns its session number"""
+        with self._lock:
+            self._connections.append(connection)
+            self.sessions += 1
+            return self.sessions
+
+    def secure_session(self, plain: socket.socket, secure: socket.socket) -> None:
+        """Registers the TLS socket that replaced the plain socket of a connection"""
+        with self._lock:
+            self._connections = [secure if connection is plain else connection
+                                 for connection in self._connections]
+            self.tls_sessions += 1
+
+    def take_failure(self, command: str) -> Optional[Tuple[int, str]]:
+        """Returns the error to reply to a command with, if one is queued"""
+        with self._lock:
+            failures = self._failures.get(command)
+            return failures.pop(0) if failures else None
+
+    def accept(self, message: ReceivedMessage) -> None:
+        """Keeps a message and wakes up anyone waiting for it"""
+        with self._received:
+            self.messages.append(message)
+            self._received.notify_all()
+
+    def __enter__(self) -> "SMTPStub":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
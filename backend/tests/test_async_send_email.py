@@ -0,0 +1,102 @@
+"""Module for testing async_send_email.py against a local SMTP server"""
+import asyncio
+import email
+import logging
+import smtplib
+import socket
+import ssl
+import unittest
+from datetime import datetime
+from smtp_stub import CERT_FILE, SMTPStub, tls_context
+from src.async_send_email import AsyncSendEmail
+
+class TestAsyncSendEmail(unittest.IsolatedAsyncioTestCase):
+    """Class for testing the AsyncSendEmail class"""
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.CRITICAL)
+
+    def setUp(self):
+        self.stub = SMTPStub(tls_context=tls_context()).start()
+        self.senders = []
+
+    async def asyncTearDown(self):
+        for sender in self.senders:
+            await sender.close()
+        self.stub.stop()
+
+    def _sender(self, **kwargs) -> AsyncSendEmail:
+        kwargs.setdefault("tls_context", ssl.create_default_context(cafile=CERT_FILE))
+        sender = AsyncSendEmail("localhost", self.stub.port, "user", "pswd", **kwargs)
+        self.senders.append(sender)
+        return sender
+
+    async def test_send_over_starttls(self):
+        """Test that the clinic and patient emails are sent over a verified TLS session"""
+        sender = self._sender()
+        await sender.send_pdf_to_clinic("clinic@example.com", "Bob_Marley.pdf", b"%PDF-1.3",
+                                        "Bob Marley", "bob@example.com", datetime(2024, 7, 1))
+        await sender.send_email_to_patient("bob@example.com", "Bob Marley")
+
+        self.assertEqual(self.stub.tls_sessions, 1)
+        self.assertEqual(self.stub.commands[:4], ["EHLO", "STARTTLS", "EHLO", "AUTH"])
+        self.assertEqual([message.rcpt_tos for message in self.stub.messages],
+                         [["clinic@example.com"], ["bob@example.com"]])
+        attachment = email.message_from_bytes(self.stub.messages[0].data).get_payload()[1]
+        self.assertEqual(attachment.get_payload(decode=True), b"%PDF-1.3")
+        self.assertEqual(sender.stats()["reused"], 1)
+
+    async def test_untrusted_certificate(self):
+        """Test that a server whose certificate cannot be verified is not sent to"""
+        sender = self._sender(tls_context=ssl.create_default_context())
+        with self.assertRaises(ssl.SSLCertVerificationError):
+            await sender.send_email_to_patient("bob@example.com", "Bob Marley")
+        self.assertEqual(self.stub.messages, [])
+
+    async def test_many_deliveries_in_flight(self):
+        """Test that many concurrent deliveries share a capped number of sessions"""
+        sender = self._sender(max_connections=4)
+        await asyncio.gather(*(sender.send_email_to_patient(f"patient{number}@example.com",
+                                                            "Bob Marley")
+                               for number in range(200)))
+
+        self.assertEqual(len(self.stub.messages), 200)
+        self.assertLessEqual(self.stub.sessions, 4)
+        self.assertEqual(sender.stats()["created"], self.stub.sessions)
+
+    async def test_submission_with_refused_recipient(self):
+        """Test that a refused recipient fails its email only and the error is raised"""
+        self.stub.extensions = ("AUTH LOGIN", "PIPELINING")
+        self.stub.fail("RCPT", 550, "No such user")
+        sender = self._sender()
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            await sender.send_submission("clinic@example.com", "Bob_Marley.pdf", b"%PDF-1.3",
+                                         "Bob Marley", "bob@example.com", datetime(2024, 7, 1))
+
+        self.assertEqual([message.rcpt_tos for message in self.stub.messages],
+                         [["bob@example.com"]])
+        self.assertEqual(self.stub.sessions, 1)
+
+    async def test_dropped_session_is_replaced(self):
+        """Test that an email is sent on a new session if the idle one was dropped"""
+        sender = self._sender()
+        await sender.send_email_to_patient("bob@example.com", "Bob Marley")
+        self.stub.drop_connections()
+        await sender.send_email_to_patient("bob@example.com", "Bob Marley")
+
+        self.assertEqual(len(self.stub.messages), 2)
+        self.assertEqual(sender.stats()["created"], 2)
+
+    async def test_reply_timeout(self):
+        """Test that a server that never replies times out instead of hanging"""
+        silent = socket.create_server(("127.0.0.1", 0))
+        try:
+            sender = AsyncSendEmail("127.0.0.1", silent.getsockname()[1], "user", "pswd",
+                                    command_timeout=0.1)
+            with self.assertRaises(TimeoutError):
+                await sender.send_email_to_patient("bob@example.com", "Bob Marley")
+        finally:
+            silent.close()
+
+if __name__ == "__main__":
+    unittest.main()
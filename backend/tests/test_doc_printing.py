@@ -4,6 +4,12 @@ from unittest.mock import MagicMock
 from fpdf import FPDF
 from src.fonts.fonts import Fonts
 from src.doc_printing import (
+    DisplayList,
+    DisplayListBuilder,
+    SetFont,
+    Cell,
+    MultiCell,
+    compile_document,
     Document,
     Title,
     InfoSection,
@@ -38,11 +44,11 @@ class TestDocument(unittest.TestCase):
     def test_print(self):
         """Test the print method"""
         document = Document(self.pdf, self.fonts, self.consent, self.doc)
-        document.title.print = MagicMock()
-        document.sections.print = MagicMock()
+        document.title.compile = MagicMock()
+        document.sections.compile = MagicMock()
         document.print()
-        document.title.print.assert_called_once()
-        document.sections.print.assert_called_once()
+        document.title.compile.assert_called_once()
+        document.sections.compile.assert_called_once()
 
 class TestTitle(unittest.TestCase):
     """Class for testing the Title class"""
@@ -68,11 +74,11 @@ class TestInfoSection(unittest.TestCase):
     def test_print(self):
         """Test the print method"""
         info_section = InfoSection(self.pdf, self.fonts, self.info)
-        info_section.subtitle.print = MagicMock()
-        info_section.body.print = MagicMock()
+        info_section.subtitle.compile = MagicMock()
+        info_section.body.compile = MagicMock()
         info_section.print()
-        info_section.subtitle.print.assert_called_once()
-        info_section.body.print.assert_called_once()
+        info_section.subtitle.compile.assert_called_once()
+        info_section.body.compile.assert_called_once()
 
 class TestConsentSection(unittest.TestCase):
     """Class for testing the ConsentSection class"""
@@ -95,23 +101,23 @@ class TestConsentSection(unittest.TestCase):
     def test_print_footnote(self):
         """Test the print method with footnote"""
         consent_section = ConsentSection(self.pdf, self.fonts, True, self.info)
-        consent_section.subtitle.print = MagicMock()
-        consent_section.body.print = MagicMock()
-        consent_section.footnote.print = MagicMock()
+        consent_section.subtitle.compile = MagicMock()
+        consent_section.body.compile = MagicMock()
+        consent_section.footnote.compile = MagicMock()
         consent_section.print()
-        consent_section.subtitle.print.assert_called_once()
-        consent_section.body.print.assert_called_once()
-        consent_section.footnote.print.assert_called_once()
+        consent_section.subtitle.compile.assert_called_once()
+        consent_section.body.compile.assert_called_once()
+        consent_section.footnote.compile.assert_called_once()
 
     def test_print_no_footnote(self):
         """Test the print method with no footnote"""
         consent_section = ConsentSection(self.pdf, self.fonts, True, self.info_no_footnote)
-        consent_section.subtitle.print = MagicMock()
-        consent_section.body.print = MagicMock()
+        consent_section.subtitle.compile = MagicMock()
+        consent_section.body.compile = MagicMock()
         self.assertIsNone(consent_section.footnote)
         consent_section.print()
-        consent_section.subtitle.print.assert_called_once()
-        consent_section.body.print.assert_called_once()
+        consent_section.subtitle.compile.assert_called_once()
+        consent_section.body.compile.assert_called_once()
 
 class TestSections(unittest.TestCase):
     """Class for testing the Sections class"""
@@ -140,10 +146,10 @@ class TestSections(unittest.TestCase):
         """Test the print method"""
         sections = Sections(self.pdf, self.fonts, self.consent, self.sections_data)
         for section in sections.sections:
-            section.print = MagicMock()
+            section.compile = MagicMock()
         sections.print()
         for section in sections.sections:
-            section.print.assert_called_once()
+            section.compile.assert_called_once()
 
 class TestConsentBody(unittest.TestCase):
     """Class for testing the ConsentBody class"""
@@ -218,6 +224,61 @@ class TestBody(unittest.TestCase):
             any(call[1]["text"] == self.body for call in self.pdf.multi_cell.call_args_list)
         )
 
+class TestDisplayList(unittest.TestCase):
+    """Class for testing the display list compiler"""
+    def setUp(self):
+        self.pdf = MagicMock(spec=FPDF)
+        self.fonts = MagicMock(spec=Fonts)
+        self.doc = {
+            "title": "Testing Title",
+            "sections": [
+                {"type": "info", "subtitle": "Info subtitle", "body": "Info body"},
+                {"type": "consent", "subtitle": "Subtitle", "body": "Body", "footnote": "Footnote"},
+                {"type": "consent", "subtitle": "Subtitle", "body": "Body", "footnote": None}
+            ]
+        }
+
+    def test_builder_removes_redundant_font_switches(self):
+        """Test that switching to the current font adds no operation"""
+        builder = DisplayListBuilder()
+        builder.set_font("body")
+        builder.multi_cell(0, 5, "One")
+        builder.set_font("body")
+        builder.multi_cell(0, 5, "Two")
+        builder.set_font("title")
+        self.assertEqual(builder.build().ops, (
+            SetFont("body"),
+            MultiCell(0, 5, "One"),
+            MultiCell(0, 5, "Two"),
+            SetFont("title"),
+        ))
+
+    def test_compile_document(self):
+        """Test that a document compiles to a flat, immutable list of operations"""
+        display_list = compile_document([True], self.doc)
+        self.assertIsInstance(display_list, DisplayList)
+        self.assertIsInstance(display_list.ops, tuple)
+        self.assertEqual(display_list.ops[:3], (
+            SetFont("title"),
+            Cell(200, 14, "Testing Title", True, "C"),
+            Cell(0, 5, "", True),
+        ))
+        self.assertIn(Cell(24, 5, "[X] I CONSENT", 0), display_list.ops)
+        self.assertIn(Cell(24, 5, "[   ] I CONSENT", 0), display_list.ops)
+        for prev, op in zip(display_list.ops, display_list.ops[1:]):
+            if isinstance(op, SetFont):
+                self.assertNotEqual(prev, op)
+
+    def test_replay(self):
+        """Test that replaying a display list draws the same calls as printing the document"""
+        display_list = compile_document([True], self.doc)
+        display_list.replay(self.pdf, self.fonts)
+
+        printed_pdf = MagicMock(spec=FPDF)
+        Document(printed_pdf, MagicMock(spec=Fonts), [True], self.doc).print()
+        self.assertEqual(self.pdf.method_calls, printed_pdf.method_calls)
+        self.fonts.set_to_title.assert_called_once_with(self.pdf)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,72 @@
+"""Module for testing email_templates.py"""
+import email
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from src.email_templates import (EMAIL_TEMPLATES, EmailTemplate, EmailTemplateRegistry,
+                                 format_date, format_time)
+from src.send_email import SendEmail
+
+VALUES = {
+    "patient_name": "Bob <Marley>",
+    "patient_email": "bob@example.com",
+    "current_date": "July 01, 2024",
+    "current_time": " 9:30 AM",
+}
+
+class TestEmailTemplates(unittest.TestCase):
+    """Class for testing the EmailTemplate and EmailTemplateRegistry classes"""
+    def test_dates_match_strftime(self):
+        """Test that dates and times are formatted as strftime formats them in English"""
+        for hour in range(24):
+            value = datetime(2024, 7 if hour < 12 else 12, hour + 1, hour, 5)
+            self.assertEqual(format_date(value), value.strftime("%B %d, %Y"))
+            self.assertEqual(format_time(value), value.strftime("%l:%M %p"))
+
+    def test_values_escaped_in_html(self):
+        """Test that values are HTML escaped in the HTML body only"""
+        rendered = EMAIL_TEMPLATES.render("clinic", **VALUES)
+        self.assertIn("Bob &lt;Marley&gt;", rendered.html)
+        self.assertNotIn("Bob <Marley>", rendered.html)
+        self.assertIn("- Patient Name: Bob <Marley>\n", rendered.text)
+        self.assertIn("- Submission Time:  9:30 AM\n", rendered.text)
+        self.assertNotIn("<", rendered.text.replace("<Marley>", ""))
+
+    def test_minified_lines(self):
+        """Test that the minified HTML has no indentation and no overlong lines"""
+        for name in ("clinic", "patient"):
+            rendered = EMAIL_TEMPLATES.render(name, **VALUES)
+            lines = rendered.html.split("\n")
+            self.assertTrue(all(line == line.strip() and line for line in lines))
+            self.assertTrue(all(len(line) < 998 for line in lines))
+            self.assertNotIn("<!--", rendered.html)
+
+    def test_missing_value(self):
+        """Test that rendering without a value for a slot raises a ValueError"""
+        template = EmailTemplate("test", "<p>Dear {{ name }}, {{ date }}</p>")
+        self.assertEqual(template.slots, ("name", "date"))
+        with self.assertRaisesRegex(ValueError, "date"):
+            template.render(name="Bob")
+
+    def test_unknown_template(self):
+        """Test that a missing template raises a FileNotFoundError"""
+        folder = tempfile.mkdtemp()
+        try:
+            with self.assertRaises(FileNotFoundError):
+                EmailTemplateRegistry(folder).get("clinic")
+        finally:
+            shutil.rmtree(folder)
+
+    def test_message_has_plain_text_part(self):
+        """Test that a sent email has a plain text and an HTML alternative"""
+        sender = SendEmail("localhost", 25, "user", "pswd")
+        message = email.message_from_bytes(b"".join(sender._message_chunks(
+            sender.patient_email("bob@example.com", "Zoë"))))
+        self.assertEqual(message.get_content_type(), "multipart/alternative")
+        parts = [part.get_content_type() for part in message.get_payload()]
+        self.assertEqual(parts, ["text/plain", "text/html"])
+        self.assertIn("Dear Zoë,", message.get_payload()[0].get_payload(decode=True).decode())
+
+if __name__ == "__main__":
+    unittest.main()
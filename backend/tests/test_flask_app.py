@@ -1,8 +1,19 @@
 """Module to test the app.py file which acts as a flask server"""
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+import requests
+from smtp_stub import SMTPStub
 import app
+from src.mail_executor import MailQueueFull
 
 VALID_SIGNATURE = (
     "data:image/png;base64,"
@@ -46,6 +57,12 @@ class FlaskAppTests(unittest.TestCase):
         self.mock_send_emails = self.patcher.start()
         self.mock_send_emails.return_value = None
 
+    def tearDown(self) -> None:
+        """
+        Puts back the send_emails function.
+        """
+        self.patcher.stop()
+
     def test_post_method_success(self):
         """
         Tests that a valid payload results in a successful form submission.
@@ -54,6 +71,74 @@ class FlaskAppTests(unittest.TestCase):
         self.assertIn(b"Form submission successful", response.data)
         self.assertEqual(response.status_code, 200)
 
+    def test_post_method_render_pool(self):
+        """
+        Tests that the PDF is rendered by the render pool when one is configured.
+        """
+        render_pool = MagicMock()
+        render_pool.generate_pdf_bytes.return_value = b"pdf"
+        with patch("app.render_pool", render_pool):
+            response = self.client.post("/post", json=self.payload)
+        self.assertEqual(response.status_code, 200)
+        render_pool.generate_pdf_bytes.assert_called_once()
+        self.assertEqual(render_pool.generate_pdf_bytes.call_args[0][2], [True, True, False])
+        self.assertEqual(self.mock_send_emails.call_args[0][1], b"pdf")
+
+    def test_post_method_output_profile(self):
+        """
+        Tests that a submission can ask for an output profile and an unknown one is rejected.
+        """
+        self.payload["outputProfile"] = "small"
+        response = self.client.post("/post", json=self.payload)
+        self.assertEqual(response.status_code, 200)
+
+        self.payload["outputProfile"] = "tiny"
+        response = self.client.post("/post", json=self.payload)
+        self.assertEqual(response.status_code, 500)
+
+    def test_post_method_email_queue_full(self):
+        """
+        Tests that a submission is turned away with a 503 when the email queue is full.
+        """
+        self.mock_send_emails.side_effect = MailQueueFull("Too many emails")
+        response = self.client.post("/post", json=self.payload)
+        self.assertEqual(response.status_code, 503)
+
+    def test_turned_away_submission_gives_back_its_turn(self):
+        """
+        Tests that a submission the email queue turns away gives back the rate limiter
+        tokens it took ahead.
+        """
+        self.patcher.stop()
+        smtp_server = MagicMock()
+        smtp_server.pace.return_value = 0.0
+        with patch("app.outbox", None), patch("app.smtp_server", smtp_server), \
+                patch("app.mail_executor.run", side_effect=MailQueueFull("Too many emails")):
+            response = self.client.post("/post", json=self.payload)
+        self.patcher.start()
+        self.assertEqual(response.status_code, 503)
+        smtp_server.pace.assert_called_once_with(2)
+        smtp_server.refund.assert_called_once_with(2)
+
+    def test_email_stats(self):
+        """
+        Tests that the depth of the email queue and its wait times are reported.
+        """
+        response = self.client.get("/email/stats")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("queued", response.json["queue"])
+        self.assertIn("wait_p95", response.json["queue"])
+        self.assertIn("reuse_ratio", response.json["transport"])
+
+    def test_post_method_child_form(self):
+        """
+        Tests that a child form submission ignores the adult only contact consent.
+        """
+        self.payload["formType"] = "child"
+        response = self.client.post("/post", json=self.payload)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("contactConsent", response.json["received_data"]["consent"])
+
     def test_post_method_empty_consent_flags(self):
         """
         Tests that an empty consent flags field results in an internal server error.
@@ -97,5 +182,71 @@ class FlaskAppTests(unittest.TestCase):
         response = self.client.post("/post", json=self.payload)
         self.assertEqual(response.status_code, 500)
 
+class ServerTests(unittest.TestCase):
+    """
+    Boots app.py the way the Docker image runs it, with render workers and an outbox.
+    """
+    def setUp(self) -> None:
+        """
+        Starts the server against a local SMTP stub, on a free port.
+        """
+        self.stub = SMTPStub().start()
+        self.folder = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+        env = dict(os.environ, BACKEND_PORT=self.url.rsplit(":", 1)[1],
+                   SMTP_HOST="127.0.0.1", SMTP_PORT=str(self.stub.port), SMTP_USER="user",
+                   SMTP_PSWD="pswd", SMTP_STARTTLS="false",
+                   RECIPIENT_EMAIL="clinic@example.com", PDF_RENDER_WORKERS="2",
+                   EMAIL_OUTBOX_PATH=os.path.join(self.folder.name, "outbox.db"))
+        self.log = open(os.path.join(self.folder.name, "app.log"), "w+b")  # pylint: disable=consider-using-with
+        # The reloader serves in a child process, so the whole group is stopped
+        self.server = subprocess.Popen(  # pylint: disable=consider-using-with
+            [sys.executable, "app.py"], cwd=Path(__file__).parent.parent, env=env,
+            stdout=self.log, stderr=subprocess.STDOUT, start_new_session=True)
+
+    def tearDown(self) -> None:
+        os.killpg(self.server.pid, signal.SIGTERM)
+        self.server.wait(10)
+        self.log.close()
+        self.folder.cleanup()
+        self.stub.stop()
+
+    def _wait_until_serving(self, timeout: float = 60.0) -> None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.assertIsNone(self.server.poll(), "app.py exited")
+            try:
+                requests.get(self.url + "/email/stats", timeout=1)
+                return
+            except (requests.ConnectionError, requests.Timeout):
+                # The reloader listens before the server process has started up
+                time.sleep(0.2)
+        self.fail("app.py did not start serving")
+
+    def test_serves_with_render_workers(self):
+        """
+        Tests that the server renders a submission in its workers and sends its emails
+        from a single outbox.
+        """
+        self._wait_until_serving()
+        response = requests.post(self.url + "/post", timeout=30, json={
+            "name": "Bob Marley",
+            "email": "bobmarley@example.com",
+            "drawSignature": VALID_SIGNATURE,
+            "formType": "adult",
+            "consent": {"researchConsent": True, "contactConsent": True,
+                        "studentConsent": False},
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.stub.wait_for(2, timeout=10))
+
+        self.log.seek(0)
+        output = self.log.read()
+        self.assertEqual(output.count(b"Outbox started"), 1)
+        self.assertEqual(output.count(b"Render pool started"), 1)
+        self.assertNotIn(b"Traceback", output)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
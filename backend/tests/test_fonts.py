@@ -2,20 +2,32 @@
 import unittest
 from unittest.mock import mock_open, patch, MagicMock
 import json
+import shutil
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from fontTools.fontBuilder import FontBuilder
+from fontTools.pens.ttGlyphPen import TTGlyphPen
 from fpdf import FPDF
 from src.fonts.fonts import (
     Fonts,
+    FontRegistry,
     TITLE_SIZE,
     SUBTITLE_SIZE,
     BODY_SIZE,
     FONTS_FOLDER,
     FONTS_FILE,
+    FALLBACK_FOLDER,
+    LATIN_CHARACTERS,
+    PROFILE_CORE,
+    detect_scripts,
 )
 
 class TestFonts(unittest.TestCase):
     """Class for testing the Fonts class"""
     def setUp(self):
         self.pdf_mock = MagicMock(spec=FPDF)
+        self.registry_mock = MagicMock(spec=FontRegistry)
 
     @patch("builtins.open", new_callable=mock_open, read_data=json.dumps({
             "title": "TitleFont",
@@ -52,10 +64,9 @@ class TestFonts(unittest.TestCase):
         }))
     def test_set_to_title(self, _):
         """Test the set_to_title method"""
-        fonts = Fonts()
+        fonts = Fonts(self.registry_mock)
         fonts.set_to_title(self.pdf_mock)
-        self.pdf_mock.add_font.assert_called_once_with("TitleFont", "",
-                                                       f"{FONTS_FOLDER}/TitleFont.ttf", uni=True)
+        self.registry_mock.attach.assert_called_once_with(self.pdf_mock, "TitleFont")
         self.pdf_mock.set_font.assert_called_once_with("TitleFont", size=TITLE_SIZE)
 
     @patch("builtins.open", new_callable=mock_open, read_data=json.dumps({
@@ -66,10 +77,9 @@ class TestFonts(unittest.TestCase):
         }))
     def test_set_to_subtitle(self, _):
         """Test the set_to_subtitle method"""
-        fonts = Fonts()
+        fonts = Fonts(self.registry_mock)
         fonts.set_to_subtitle(self.pdf_mock)
-        self.pdf_mock.add_font.assert_called_once_with("SubtitleFont", "",
-                                                       f"{FONTS_FOLDER}/SubtitleFont.ttf", uni=True)
+        self.registry_mock.attach.assert_called_once_with(self.pdf_mock, "SubtitleFont")
         self.pdf_mock.set_font.assert_called_once_with("SubtitleFont", size=SUBTITLE_SIZE)
 
     @patch("builtins.open", new_callable=mock_open, read_data=json.dumps({
@@ -80,10 +90,9 @@ class TestFonts(unittest.TestCase):
         }))
     def test_set_to_body(self, _):
         """Test the set_to_body method"""
-        fonts = Fonts()
+        fonts = Fonts(self.registry_mock)
         fonts.set_to_body(self.pdf_mock)
-        self.pdf_mock.add_font.assert_called_once_with("BodyFont", "",
-                                                       f"{FONTS_FOLDER}/BodyFont.ttf", uni=True)
+        self.registry_mock.attach.assert_called_once_with(self.pdf_mock, "BodyFont")
         self.pdf_mock.set_font.assert_called_once_with("BodyFont", size=BODY_SIZE)
 
     @patch("builtins.open", new_callable=mock_open, read_data=json.dumps({
@@ -94,10 +103,9 @@ class TestFonts(unittest.TestCase):
         }))
     def test_set_to_body_bold(self, _):
         """Test the set_to_bold_body method"""
-        fonts = Fonts()
+        fonts = Fonts(self.registry_mock)
         fonts.set_to_body_bold(self.pdf_mock)
-        self.pdf_mock.add_font.assert_called_once_with("BodyBoldFont", "",
-                                                       f"{FONTS_FOLDER}/BodyBoldFont.ttf", uni=True)
+        self.registry_mock.attach.assert_called_once_with(self.pdf_mock, "BodyBoldFont")
         self.pdf_mock.set_font.assert_called_once_with("BodyBoldFont", size=BODY_SIZE)
 
     @patch("builtins.open", new_callable=mock_open, read_data=json.dumps({
@@ -108,10 +116,207 @@ class TestFonts(unittest.TestCase):
         }))
     def test_set_to_font_runtime_error(self, _):
         """Test if a runtime error is encountered when a font is not found"""
-        self.pdf_mock.add_font.side_effect = RuntimeError("Font not found")
-        fonts = Fonts()
+        self.registry_mock.attach.side_effect = RuntimeError("Font not found")
+        fonts = Fonts(self.registry_mock)
         with self.assertRaises(RuntimeError):
             fonts.set_to_title(self.pdf_mock)
 
+    def test_core_profile(self):
+        """Test that the core profile sets the PDF core fonts without attaching a font file"""
+        fonts = Fonts(self.registry_mock, profile=PROFILE_CORE)
+        pdf = FPDF()
+        pdf.add_page()
+        fonts.set_to_title(pdf)
+        self.assertEqual((pdf.font_family, pdf.font_style, pdf.font_size_pt),
+                         ("helvetica", "B", TITLE_SIZE))
+        fonts.set_to_body(pdf)
+        self.assertEqual((pdf.font_family, pdf.font_style), ("helvetica", ""))
+        self.registry_mock.attach.assert_not_called()
+
+    def test_core_profile_can_encode(self):
+        """Test that only text in the core fonts encoding can be printed with the core profile"""
+        fonts = Fonts(self.registry_mock, profile=PROFILE_CORE)
+        self.assertTrue(fonts.can_encode("Zo\u00eb \u2019"))
+        self.assertFalse(fonts.can_encode("\u0416\u0435\u043d\u044f"))
+        self.assertTrue(Fonts(self.registry_mock).can_encode("\u0416\u0435\u043d\u044f"))
+
+class TestFontRegistry(unittest.TestCase):
+    """Class for testing the FontRegistry class"""
+    def setUp(self):
+        self.registry = FontRegistry()
+
+    def test_warm_up_parses_every_font(self):
+        """Test that warming up parses each TTF in the fonts folder once"""
+        self.registry.warm_up()
+        stats = self.registry.stats()
+        self.assertEqual(set(stats), {"Roboto-Black", "Roboto-Bold", "Roboto-Regular"})
+        for counters in stats.values():
+            self.assertEqual(counters, {"hits": 0, "misses": 1})
+
+    def test_attach_counts_hits_and_misses(self):
+        """Test that only the first attach of a font parses it"""
+        self.registry.attach(FPDF(), "Roboto-Regular")
+        self.registry.attach(FPDF(), "Roboto-Regular")
+        self.assertEqual(self.registry.stats()["Roboto-Regular"], {"hits": 1, "misses": 1})
+
+    def test_attach_gives_each_document_its_own_font(self):
+        """Test that documents sharing a parsed font can each be output"""
+        first, second = FPDF(), FPDF()
+        for pdf in (first, second):
+            self.registry.attach(pdf, "Roboto-Regular")
+            pdf.add_page()
+            pdf.set_font("Roboto-Regular", size=BODY_SIZE)
+
+        first.cell(0, 5, text="Hello")
+        second.cell(0, 5, text="World")
+        self.assertIsNot(first.fonts["roboto-regular"].subset,
+                         second.fonts["roboto-regular"].subset)
+        self.assertTrue(bytes(first.output()).startswith(b"%PDF-"))
+        self.assertTrue(bytes(second.output()).startswith(b"%PDF-"))
+
+    def test_attach_twice_to_same_document(self):
+        """Test that attaching an already attached font does nothing"""
+        pdf = FPDF()
+        self.registry.attach(pdf, "Roboto-Bold")
+        font = pdf.fonts["roboto-bold"]
+        self.registry.attach(pdf, "Roboto-Bold")
+        self.assertIs(pdf.fonts["roboto-bold"], font)
+        self.assertEqual(self.registry.stats()["Roboto-Bold"], {"hits": 0, "misses": 1})
+
+    def test_attach_missing_font(self):
+        """Test that a missing font file raises a FileNotFoundError"""
+        with self.assertRaises(FileNotFoundError):
+            self.registry.attach(FPDF(), "Missing-Font")
+
+    def test_subsets_give_the_same_output(self):
+        """Test that outputting from an ahead of time subset gives the same document"""
+        documents = []
+        for use_subsets in (False, True):
+            registry = FontRegistry()
+            registry.build_subsets("Consent" + LATIN_CHARACTERS, ["Roboto-Regular"])
+            pdf = FPDF()
+            registry.attach(pdf, "Roboto-Regular")
+            pdf.add_page()
+            pdf.set_font("Roboto-Regular", size=BODY_SIZE)
+            pdf.cell(0, 5, text="Consent for Zoë Müller")
+            pdf.set_creation_date(datetime(2024, 1, 1))
+            if use_subsets:
+                registry.use_subsets(pdf)
+                self.assertEqual(registry.subset_hits, 1)
+            documents.append(bytes(pdf.output()))
+
+        self.assertEqual(documents[0], documents[1])
+
+    def test_subsets_fall_back_to_full_font(self):
+        """Test that a document using a glyph outside the subset keeps the full font"""
+        self.registry.build_subsets(LATIN_CHARACTERS, ["Roboto-Regular"])
+        pdf = FPDF()
+        self.registry.attach(pdf, "Roboto-Regular")
+        pdf.add_page()
+        pdf.set_font("Roboto-Regular", size=BODY_SIZE)
+        pdf.cell(0, 5, text="\u0416\u0435\u043d\u044f")
+        font_file = pdf.fonts["roboto-regular"].ttfont
+        self.registry.use_subsets(pdf)
+        self.assertIs(pdf.fonts["roboto-regular"].ttfont, font_file)
+        self.assertEqual((self.registry.subset_hits, self.registry.subset_misses), (0, 1))
+        self.assertTrue(bytes(pdf.output()).startswith(b"%PDF-"))
+
+def _build_font(path, family, chars):
+    """Writes a minimal TrueType font with a square glyph for each character"""
+    pen = TTGlyphPen(None)
+    pen.moveTo((100, 0))
+    pen.lineTo((100, 500))
+    pen.lineTo((400, 500))
+    pen.lineTo((400, 0))
+    pen.closePath()
+    square = pen.glyph()
+
+    glyph_names = [".notdef"] + [f"uni{ord(char):04X}" for char in chars]
+    builder = FontBuilder(1000, isTTF=True)
+    builder.setupGlyphOrder(glyph_names)
+    builder.setupCharacterMap({ord(char): f"uni{ord(char):04X}" for char in chars})
+    builder.setupGlyf({name: square for name in glyph_names})
+    builder.setupHorizontalMetrics({name: (500, 100) for name in glyph_names})
+    builder.setupHorizontalHeader(ascent=800, descent=-200)
+    builder.setupNameTable({"familyName": family, "styleName": "Regular"})
+    builder.setupOS2()
+    builder.setupPost()
+    builder.save(path)
+
+class TestFallbackFonts(unittest.TestCase):
+    """Class for testing the fallback fonts for scripts the form fonts do not cover"""
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        _build_font(f"{self.folder}/TestHebrew.ttf", "TestHebrew", "\u05d0\u05d1")
+        self.fallback_registry = FontRegistry(self.folder)
+        self.fonts = Fonts(FontRegistry(), fallback_registry=self.fallback_registry)
+        self.fonts.fallback = {"HEBREW": "TestHebrew", "CJK": "Missing-Font"}
+        self.pdf = FPDF()
+        self.pdf.add_page()
+        self.fonts.set_to_body(self.pdf)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_detect_scripts(self):
+        """Test that scripts are detected in order of first appearance"""
+        self.assertEqual(detect_scripts("Zo\u00eb \u05d0 \u4e2d\u05d1"),
+                         ["LATIN", "SPACE", "HEBREW", "CJK"])
+
+    def test_covered_text_loads_no_fallback(self):
+        """Test that text the form font covers does not load a fallback font"""
+        self.assertEqual(self.fonts.set_fallback_fonts(self.pdf, "Zo\u00eb \u0416"), [])
+        self.assertEqual(self.fallback_registry.stats(), {})
+        self.assertNotIn("testhebrew", self.pdf.fonts)
+
+    def test_uncovered_text_uses_fallback(self):
+        """Test that a fallback font is loaded once and used for the uncovered characters"""
+        for _ in range(2):
+            self.fonts.added_fonts.clear()
+            pdf = FPDF()
+            pdf.add_page()
+            self.fonts.set_to_body(pdf)
+            self.assertEqual(self.fonts.set_fallback_fonts(pdf, "\u05d0\u05d1 Cohen"),
+                             ["TestHebrew"])
+            pdf.cell(0, 5, text="\u05d0\u05d1 Cohen")
+            self.assertEqual(pdf.fonts["testhebrew"].missing_glyphs, [])
+            self.assertEqual(pdf.fonts["roboto-regular"].missing_glyphs, [])
+            self.assertTrue(bytes(pdf.output()).startswith(b"%PDF-"))
+
+        self.assertEqual(self.fallback_registry.stats()["TestHebrew"], {"hits": 1, "misses": 1})
+
+    def test_missing_fallback_font(self):
+        """Test that a fallback font that is not installed is skipped"""
+        self.assertEqual(self.fonts.set_fallback_fonts(self.pdf, "\u4e2d\u05d0"), ["TestHebrew"])
+
+    def _render_cjk_name(self, fonts: Fonts) -> FPDF:
+        pdf = FPDF()
+        pdf.add_page()
+        fonts.set_to_body(pdf)
+        fonts.set_fallback_fonts(pdf, "\u738b\u5c0f\u660e \u3055\u304f\u3089 \uae40\ubbfc\uc900")
+        pdf.cell(0, 5, text="\u738b\u5c0f\u660e \u3055\u304f\u3089 \uae40\ubbfc\uc900")
+        self.assertTrue(bytes(pdf.output()).startswith(b"%PDF-"))
+        return pdf
+
+    def test_cjk_name_with_configured_fallback(self):
+        """Test that the configured fallback font prints a CJK name with no missing glyphs"""
+        fonts = Fonts(FontRegistry(), fallback_registry=self.fallback_registry)
+        font_name = fonts.fallback["CJK"]
+        self.assertEqual({fonts.fallback[script] for script in ("HANGUL", "HIRAGANA")},
+                         {font_name})
+        _build_font(f"{self.folder}/{font_name}.ttf", font_name,
+                    "\u738b\u5c0f\u660e\u3055\u304f\u3089\uae40\ubbfc\uc900")
+
+        pdf = self._render_cjk_name(fonts)
+        self.assertEqual(pdf.fonts[font_name.lower()].missing_glyphs, [])
+        self.assertEqual(pdf.fonts["roboto-regular"].missing_glyphs, [])
+
+    @unittest.skipUnless(Path(FALLBACK_FOLDER, "DroidSansFallbackFull.ttf").exists(),
+                         "The fallback fonts of the Docker image are not installed")
+    def test_cjk_name_with_installed_fonts(self):
+        """Test that the installed fallback fonts print a CJK name with no missing glyphs"""
+        pdf = self._render_cjk_name(Fonts())
+        self.assertTrue(all(font.missing_glyphs == [] for font in pdf.fonts.values()))
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,123 @@
+"""Module for testing form_templates.py"""
+import unittest
+import json
+import logging
+import os
+import shutil
+import tempfile
+from src.form_templates import TemplateRegistry, TEXT_FOLDER
+
+logging.disable(logging.CRITICAL)
+
+TEMPLATE = {
+    "document": {
+        "title": "Test Title",
+        "sections": [
+            {"type": "info", "subtitle": "Info subtitle", "body": "Info body"},
+            {"type": "consent", "key": "researchConsent", "subtitle": "Subtitle",
+             "body": "Body", "footnote": None}
+        ]
+    }
+}
+
+class TestTemplateRegistry(unittest.TestCase):
+    """Class for testing the TemplateRegistry class"""
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.registry = TemplateRegistry(self.folder, check_interval=0)
+        self._write("test", TEMPLATE)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _write(self, form_type, content, version=None):
+        path = f"{self.folder}/{form_type}.json"
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(content if isinstance(content, str) else json.dumps(content))
+        if version is not None:
+            os.utime(path, ns=(version, version))
+
+    def test_shipped_templates(self):
+        """Test that the shipped adult and child templates load and validate"""
+        registry = TemplateRegistry(TEXT_FOLDER)
+        registry.load_all()
+        self.assertEqual(registry.form_types(), ["adult", "child"])
+        self.assertEqual(registry.get("adult").consent_keys,
+                         ("researchConsent", "contactConsent", "studentConsent"))
+        self.assertEqual(registry.get("child").consent_keys,
+                         ("researchConsent", "studentConsent"))
+
+    def test_get_template(self):
+        """Test that a template is parsed into its document and consent keys"""
+        template = self.registry.get("test")
+        self.assertEqual(template.form_type, "test")
+        self.assertEqual(template.document, TEMPLATE["document"])
+        self.assertEqual(template.consent_keys, ("researchConsent",))
+
+    def test_get_served_from_memory(self):
+        """Test that an unchanged template is not read again"""
+        self.registry.check_interval = 60
+        template = self.registry.get("test")
+        os.remove(f"{self.folder}/test.json")
+        self.assertIs(self.registry.get("test"), template)
+
+    def test_reload_on_mtime_change(self):
+        """Test that a template is reloaded when its file changes"""
+        self._write("test", TEMPLATE, version=1_000_000_000)
+        old = self.registry.get("test")
+
+        changed = json.loads(json.dumps(TEMPLATE))
+        changed["document"]["title"] = "Changed Title"
+        self._write("test", changed, version=2_000_000_000)
+        new = self.registry.get("test")
+        self.assertEqual(new.document["title"], "Changed Title")
+        self.assertNotEqual(new.version, old.version)
+
+    def test_invalid_reload_keeps_old_template(self):
+        """Test that a template which fails to reload keeps being served"""
+        self._write("test", TEMPLATE, version=1_000_000_000)
+        old = self.registry.get("test")
+        self._write("test", "invalid json", version=2_000_000_000)
+        self.assertIs(self.registry.get("test"), old)
+
+    def test_get_file_not_found(self):
+        """Test that a form type without a template raises a FileNotFoundError"""
+        for form_type in ("missing", "../test", None):
+            with self.assertRaises(FileNotFoundError):
+                self.registry.get(form_type)
+
+    def test_get_json_decode_error(self):
+        """Test that a template with invalid JSON raises a JSONDecodeError"""
+        self._write("broken", "invalid json")
+        with self.assertRaises(json.JSONDecodeError):
+            self.registry.get("broken")
+
+    def test_get_invalid_structure(self):
+        """Test that a template with missing fields raises a ValueError"""
+        self._write("no_key", {"document": {"title": "Title", "sections": [
+            {"type": "consent", "subtitle": "", "body": "Body", "footnote": None}
+        ]}})
+        self._write("no_sections", {"document": {"title": "Title"}})
+        for form_type in ("no_key", "no_sections"):
+            with self.assertRaises(ValueError):
+                self.registry.get(form_type)
+
+    def test_load_all_and_consent_keys(self):
+        """Test that every template in the folder is loaded at once"""
+        other = json.loads(json.dumps(TEMPLATE))
+        other["document"]["sections"][1]["key"] = "studentConsent"
+        self._write("other", other)
+        self.registry.load_all()
+        self.assertEqual(self.registry.form_types(), ["other", "test"])
+        self.assertEqual(self.registry.consent_keys(), ["researchConsent", "studentConsent"])
+
+    def test_characters(self):
+        """Test that the characters of every string in the loaded templates are collected"""
+        self.registry.load_all()
+        characters = self.registry.characters()
+        self.assertEqual(characters, "".join(sorted(set(characters))))
+        for text in ("Test Title", "Info body", "Subtitle"):
+            self.assertTrue(set(text) <= set(characters))
+
+if __name__ == "__main__":
+    unittest.main()
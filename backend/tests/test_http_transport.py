@@ -0,0 +1,112 @@
+"""Module for testing http_transport.py against a local HTTP API"""
+import base64
+import logging
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from http_api_stub import HTTPAPIStub
+from src.http_transport import HTTPTransport, MailAPIError
+from src.mail_retry import is_permanent
+from src.outbox import Outbox
+from src.send_email import OutgoingEmail, SendEmail
+
+class TestHTTPTransport(unittest.TestCase):
+    """Class for testing the HTTPTransport class"""
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.CRITICAL)
+
+    def setUp(self):
+        self.stub = HTTPAPIStub().start()
+        self.transport = HTTPTransport("re_test_key", self.stub.url)
+        self.sender = SendEmail(None, None, "clinic@example.com", None, transport=self.transport)
+
+    def tearDown(self):
+        self.transport.close()
+        self.stub.stop()
+
+    def test_email_with_attachment(self):
+        """Test that an email is posted with its text, HTML and base64 attachment"""
+        self.sender.send_pdf_to_clinic("clinic@example.com", "Bob_Marley.pdf", b"%PDF-1.3",
+                                       "Bob Marley", "bob@example.com", datetime(2024, 7, 1))
+
+        request = self.stub.requests[0]
+        self.assertEqual(request.path, "/emails")
+        self.assertEqual(request.headers["Authorization"], "Bearer re_test_key")
+        self.assertEqual(request.body["from"], "clinic@example.com")
+        self.assertEqual(request.body["to"], ["clinic@example.com"])
+        self.assertIn("July 01, 2024", request.body["html"])
+        self.assertIn("- Patient Name: Bob Marley", request.body["text"])
+        attachment = request.body["attachments"][0]
+        self.assertEqual(attachment["filename"], "Bob_Marley.pdf")
+        self.assertEqual(base64.b64decode(attachment["content"]), b"%PDF-1.3")
+
+    def test_batch_send(self):
+        """Test that emails without attachments are sent in one batch request"""
+        emails = [self.sender.patient_email(f"patient{number}@example.com", "Bob Marley")
+                  for number in range(3)]
+        results = self.sender.send_emails(emails)
+
+        self.assertEqual([request.path for request in self.stub.requests], ["/emails/batch"])
+        self.assertEqual([email["to"] for email in self.stub.requests[0].body],
+                         [["patient0@example.com"], ["patient1@example.com"],
+                          ["patient2@example.com"]])
+        self.assertTrue(all(result.error is None for result in results))
+        self.assertEqual(self.transport.stats()["batches"], 1)
+
+    def test_connections_are_kept_alive(self):
+        """Test that consecutive emails reuse one connection"""
+        for _ in range(5):
+            self.sender.send_submission("clinic@example.com", "Bob_Marley.pdf", b"%PDF-1.3",
+                                        "Bob Marley", "bob@example.com", datetime(2024, 7, 1))
+
+        self.assertEqual(len(self.stub.requests), 10)
+        self.assertEqual(self.stub.connections, 1)
+        stats = self.transport.stats()
+        self.assertEqual((stats["requests"], stats["created"]), (10, 1))
+        self.assertEqual(stats["reuse_ratio"], 0.9)
+
+    def test_errors(self):
+        """Test that rate limits are temporary errors and rejected emails permanent ones"""
+        self.stub.fail(429, "Too many requests")
+        with self.assertRaises(MailAPIError) as raised:
+            self.sender.send_email_to_patient("bob@example.com", "Bob Marley")
+        self.assertEqual(raised.exception.status_code, 429)
+        self.assertFalse(is_permanent(raised.exception))
+
+        self.stub.fail(422, "Invalid `to` field")
+        results = self.sender.send_emails([OutgoingEmail("bob", "Subject", "<p>Body</p>"),
+                                           OutgoingEmail("bob", "Subject", "<p>Body</p>")])
+        self.assertEqual([str(result.error) for result in results],
+                         ["422 Invalid `to` field"] * 2)
+        self.assertTrue(is_permanent(results[0].error))
+
+    def test_unreachable_api(self):
+        """Test that an API that cannot be reached fails with a temporary error"""
+        self.stub.stop()
+        transport = HTTPTransport("re_test_key", self.stub.url, timeout=(0.5, 0.5))
+        results = transport.send_emails("clinic@example.com",
+                                        [OutgoingEmail("bob@example.com", "Subject", "Body")])
+        self.assertIsInstance(results[0].error, OSError)
+        self.assertFalse(is_permanent(results[0].error))
+        self.stub.start()
+
+    def test_outbox_over_http(self):
+        """Test that the outbox delivers stored emails through the HTTP transport"""
+        with tempfile.TemporaryDirectory() as folder:
+            outbox = Outbox(os.path.join(folder, "outbox.sqlite3"), self.sender,
+                            poll_interval=0.05)
+            outbox.enqueue_submission("clinic@example.com", "Bob_Marley.pdf", b"%PDF-1.3",
+                                      "Bob Marley", "bob@example.com", datetime(2024, 7, 1))
+            outbox.start()
+            try:
+                self.assertTrue(outbox.drain(5))
+            finally:
+                outbox.stop()
+
+        self.assertEqual(sorted(request.body["to"][0] for request in self.stub.requests),
+                         ["bob@example.com", "clinic@example.com"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+"""Module for testing image_registry.py"""
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+from fpdf import FPDF
+from src.image_registry import ImageRegistry
+from src.pdf_gen import LOGO_FILE
+
+class TestImageRegistry(unittest.TestCase):
+    """Class for testing the ImageRegistry class"""
+    def setUp(self):
+        self.registry = ImageRegistry()
+
+    def test_warm_up_loads_each_image_once(self):
+        """Test that warming up loads each image and later documents reuse it"""
+        self.registry.warm_up([LOGO_FILE])
+        self.registry.attach(FPDF(), LOGO_FILE)
+        self.assertEqual(self.registry.stats()[LOGO_FILE], {"hits": 1, "misses": 1})
+
+    def test_image_does_not_read_the_file_again(self):
+        """Test that placing a loaded image does not decode the file"""
+        self.registry.warm_up([LOGO_FILE])
+        pdf = FPDF()
+        pdf.add_page()
+        with patch("fpdf.image_parsing.get_img_info") as get_img_info:
+            self.registry.image(pdf, LOGO_FILE, w=25, x=15, y=11)
+        get_img_info.assert_not_called()
+
+    def test_output_matches_fpdf(self):
+        """Test that documents placing a cached image are the same as ones reading the file"""
+        expected = FPDF()
+        expected.add_page()
+        expected.image(LOGO_FILE, w=25, x=15, y=11)
+        expected.set_creation_date(datetime(2024, 1, 1))
+
+        for _ in range(2):
+            pdf = FPDF()
+            pdf.add_page()
+            self.registry.image(pdf, LOGO_FILE, w=25, x=15, y=11)
+            pdf.set_creation_date(datetime(2024, 1, 1))
+            self.assertEqual(bytes(pdf.output()), bytes(expected.output()))
+
+    def test_documents_have_their_own_usage_counts(self):
+        """Test that each document gets its own copy of the image information"""
+        first, second = FPDF(), FPDF()
+        self.registry.attach(first, LOGO_FILE)
+        self.registry.attach(second, LOGO_FILE)
+        first_info = first.image_cache.images[LOGO_FILE]
+        second_info = second.image_cache.images[LOGO_FILE]
+        self.assertIsNot(first_info, second_info)
+        self.assertIs(first_info["data"], second_info["data"])
+
+    def test_missing_image(self):
+        """Test that a missing image raises FileNotFoundError"""
+        with self.assertRaises(FileNotFoundError):
+            self.registry.warm_up(["src/logo/missing.png"])
+
+if __name__ == "__main__":
+    unittest.main()
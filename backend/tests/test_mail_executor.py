@@ -0,0 +1,101 @@
+"""Module for testing mail_executor.py"""
+import logging
+import threading
+import time
+import unittest
+from src.mail_executor import MailExecutor, MailQueueFull
+
+class TestMailExecutor(unittest.TestCase):
+    """Class for testing the MailExecutor class"""
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.CRITICAL)
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.executors = []
+
+    def tearDown(self):
+        self.release.set()
+        for executor in self.executors:
+            executor.shutdown()
+
+    def _executor(self, **kwargs) -> MailExecutor:
+        executor = MailExecutor(**kwargs)
+        self.executors.append(executor)
+        return executor
+
+    def _blocked_job(self):
+        self.release.wait(5)
+
+    def test_concurrency_is_bounded(self):
+        """Test that no more jobs run at once than there are workers"""
+        executor = self._executor(workers=2, max_queue=10)
+        lock = threading.Lock()
+        running, peak = [0], [0]
+
+        def job():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+
+        futures = [executor.submit(job) for _ in range(8)]
+        for future in futures:
+            future.result(5)
+        self.assertEqual(peak[0], 2)
+        self.assertEqual(executor.stats()["completed"], 8)
+
+    def test_full_queue_rejects(self):
+        """Test that a job is turned away once the workers are busy and the queue is full"""
+        executor = self._executor(workers=1, max_queue=1, queue_timeout=0.05)
+        executor.submit(self._blocked_job)
+        executor.submit(self._blocked_job)
+
+        with self.assertRaises(MailQueueFull):
+            executor.submit(self._blocked_job)
+        stats = executor.stats()
+        self.assertEqual((stats["running"], stats["queued"], stats["rejected"]), (1, 1, 1))
+
+    def test_full_queue_applies_backpressure(self):
+        """Test that a caller waits for room in a full queue rather than failing at once"""
+        executor = self._executor(workers=1, max_queue=0, queue_timeout=5)
+        executor.submit(self._blocked_job)
+        threading.Timer(0.1, self.release.set).start()
+
+        start = time.monotonic()
+        self.assertEqual(executor.run(lambda: "sent", timeout=5), "sent")
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        self.assertEqual(executor.stats()["rejected"], 0)
+
+    def test_wait_time_is_recorded(self):
+        """Test that the time jobs wait for a worker is reported"""
+        executor = self._executor(workers=1, max_queue=5)
+        executor.submit(self._blocked_job)
+        waiting = executor.submit(lambda: None)
+        self.assertEqual(executor.stats()["queued"], 1)
+
+        time.sleep(0.1)
+        self.release.set()
+        waiting.result(5)
+        stats = executor.stats()
+        self.assertGreaterEqual(stats["wait_max"], 0.05)
+        self.assertEqual(stats["wait_p95"], stats["wait_max"])
+        self.assertEqual(stats["queued"], 0)
+
+    def test_error_frees_slot(self):
+        """Test that a failing job raises to its caller and frees its place in the queue"""
+        executor = self._executor(workers=1, max_queue=0, queue_timeout=1)
+
+        def fail():
+            raise ValueError("Unable to send")
+
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                executor.run(fail, timeout=5)
+        self.assertEqual(executor.stats()["completed"], 3)
+
+if __name__ == "__main__":
+    unittest.main()
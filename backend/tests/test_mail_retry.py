@@ -0,0 +1,172 @@
+"""Module for testing mail_retry.py"""
+import logging
+import os
+import smtplib
+import socket
+import tempfile
+import time
+import unittest
+from datetime import datetime
+from smtp_stub import SMTPStub
+from src.mail_retry import DeadLetter, DeadLetterSpool, is_permanent, RetryPolicy
+from src.outbox import Outbox
+from src.send_email import SendEmail
+
+class TestRetryPolicy(unittest.TestCase):
+    """Class for testing the RetryPolicy class and is_permanent"""
+    def test_permanent_errors(self):
+        """Test that 5xx replies and bad emails are permanent and everything else is not"""
+        self.assertTrue(is_permanent(smtplib.SMTPDataError(554, "Rejected")))
+        self.assertTrue(is_permanent(smtplib.SMTPAuthenticationError(535, "Bad login")))
+        self.assertTrue(is_permanent(smtplib.SMTPRecipientsRefused(
+            {"bob@example.com": (550, b"No such user")})))
+        self.assertTrue(is_permanent(ValueError("Unknown kind of email")))
+
+        self.assertFalse(is_permanent(smtplib.SMTPDataError(451, "Try again later")))
+        self.assertFalse(is_permanent(smtplib.SMTPSenderRefused(421, b"Throttled", "bob")))
+        self.assertFalse(is_permanent(smtplib.SMTPRecipientsRefused(
+            {"bob@example.com": (450, b"Mailbox busy")})))
+        self.assertFalse(is_permanent(smtplib.SMTPServerDisconnected()))
+        self.assertFalse(is_permanent(ConnectionRefusedError()))
+        self.assertFalse(is_permanent(socket.timeout()))
+
+    def test_delay_backs_off_with_jitter(self):
+        """Test that the delay doubles after every attempt, up to the maximum"""
+        policy = RetryPolicy(base_delay=10, max_delay=100)
+        for attempts, delay in [(1, 10), (2, 20), (3, 40), (4, 80), (5, 100), (9, 100)]:
+            delays = [policy.delay(attempts) for _ in range(50)]
+            self.assertTrue(all(delay / 2 <= value <= delay for value in delays))
+            self.assertGreater(len(set(delays)), 1)
+
+    def test_attempt_budget(self):
+        """Test that an email is not sent again once it has used up its attempts"""
+        policy = RetryPolicy(max_attempts=3)
+        error = smtplib.SMTPServerDisconnected()
+        self.assertTrue(policy.should_retry(error, 2))
+        self.assertFalse(policy.should_retry(error, 3))
+        self.assertFalse(policy.should_retry(smtplib.SMTPDataError(554, "Rejected"), 1))
+
+class TestDirectRetry(unittest.TestCase):
+    """Class for testing emails sent again in process, without an outbox"""
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.CRITICAL)
+
+    def setUp(self):
+        self.stub = SMTPStub().start()
+        self.sender = SendEmail("127.0.0.1", self.stub.port, "user", "pswd", starttls=False)
+        self.policy = RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.01)
+
+    def tearDown(self):
+        self.sender.close()
+        self.stub.stop()
+
+    def _submit(self):
+        return self.sender.send_submission("clinic@example.com", "Bob_Marley.pdf", b"%PDF-1.3",
+                                           "Bob Marley", "bob@example.com",
+                                           datetime(2024, 7, 1), retry_policy=self.policy)
+
+    def test_temporary_error_is_retried(self):
+        """Test that only the email that failed with a temporary error is sent again"""
+        self.stub.fail("DATA", 451, "Try again later", times=2)
+        results = self._submit()
+
+        self.assertTrue(all(result.error is None for result in results))
+        self.assertEqual(sorted(message.rcpt_tos[0] for message in self.stub.messages),
+                         ["bob@example.com", "clinic@example.com"])
+
+    def test_attempts_run_out(self):
+        """Test that the error is raised once the email is out of attempts"""
+        self.stub.fail("RCPT", 450, "Mailbox busy", times=6)
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            self._submit()
+        # Three attempts at each of the two emails
+        self.assertEqual(self.stub.commands.count("RCPT"), 6)
+        self.assertEqual(self.stub.messages, [])
+
+    def test_permanent_error_is_not_retried(self):
+        """Test that an email refused for good is not sent again"""
+        self.stub.fail("RCPT", 550, "No such user")
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            self._submit()
+        self.assertEqual(self.stub.commands.count("RCPT"), 2)
+
+class TestDeadLetters(unittest.TestCase):
+    """Class for testing the dead-letter spool of the outbox"""
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.CRITICAL)
+
+    def setUp(self):
+        self.stub = SMTPStub().start()
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "outbox.sqlite3")
+        self.sender = SendEmail("127.0.0.1", self.stub.port, "user", "pswd", starttls=False)
+        self.outbox = Outbox(self.path, self.sender, poll_interval=0.05,
+                             retry_policy=RetryPolicy(max_attempts=2, base_delay=0.01))
+
+    def tearDown(self):
+        self.outbox.stop()
+        self.sender.pool.close()
+        self.stub.stop()
+        self.folder.cleanup()
+
+    def _send_and_wait(self):
+        self.outbox.enqueue_submission("clinic@example.com", "Bob_Marley.pdf", b"%PDF-1.3",
+                                       "Bob Marley", "bob@example.com", datetime(2024, 7, 1))
+        self.outbox.start()
+        self.assertTrue(self.outbox.drain(5))
+        self.outbox.stop()
+
+    def test_spool_round_trip(self):
+        """Test that a dead letter is read back as it was written"""
+        spool = DeadLetterSpool(os.path.join(self.folder.name, "spool"))
+        letter = DeadLetter("abc-clinic", "abc", "clinic", {"email_to": "clinic@example.com"},
+                            b"%PDF-1.3", 3, "554 Rejected", time.time())
+        spool.add(letter)
+        self.assertEqual(spool.list(), [letter])
+        spool.remove(letter.id)
+        with self.assertRaises(KeyError):
+            spool.get(letter.id)
+
+    def test_permanent_error_is_dead_lettered(self):
+        """Test that an email rejected with a permanent error is not sent again"""
+        self.stub.fail("DATA", 554, "Rejected")
+        self._send_and_wait()
+
+        letters = self.outbox.dead_letters.list()
+        self.assertEqual(len(letters), 1)
+        self.assertEqual(letters[0].attempts, 1)
+        self.assertIn("554", letters[0].error)
+        self.assertEqual(len(self.stub.messages), 1)
+
+    def test_transient_error_is_retried(self):
+        """Test that an email that fails with a temporary error is sent again"""
+        self.stub.fail("DATA", 451, "Try again later")
+        self._send_and_wait()
+
+        self.assertEqual(self.outbox.dead_letters.list(), [])
+        self.assertEqual(len(self.stub.messages), 2)
+
+    def test_budget_exhausted_then_replayed(self):
+        """Test that an email is dead-lettered after its last attempt and can be replayed"""
+        self.stub.fail("DATA", 451, "Try again later", times=2)
+        self.stub.fail("MAIL", 421, "Throttled", times=2)
+        self._send_and_wait()
+
+        letters = self.outbox.dead_letters.list()
+        self.assertEqual(len(letters) + len(self.stub.messages), 2)
+        self.assertTrue(all(letter.attempts == 2 for letter in letters))
+
+        for letter in letters:
+            self.outbox.dead_letters.replay(letter.id, self.outbox)
+        self.outbox.start()
+        self.assertTrue(self.outbox.drain(5))
+        self.assertEqual(len(self.stub.messages), 2)
+        self.assertEqual(self.outbox.dead_letters.list(), [])
+        clinic = next(message for message in self.stub.messages
+                      if message.rcpt_tos == ["clinic@example.com"])
+        self.assertIn(b"filename= Bob_Marley.pdf", clinic.data)
+
+if __name__ == "__main__":
+    unittest.main()
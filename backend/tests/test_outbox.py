@@ -0,0 +1,128 @@
+"""Module for testing outbox.py against a local SMTP server"""
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from datetime import datetime
+import pytz
+from smtp_stub import SMTPStub
+from src.mail_retry import RetryPolicy
+from src.outbox import Outbox
+from src.send_email import SendEmail
+
+SUBMIT_DATETIME = datetime(2024, 7, 1, 9, 30, tzinfo=pytz.timezone("Australia/Sydney"))
+
+class TestOutbox(unittest.TestCase):
+    """Class for testing the Outbox class"""
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.CRITICAL)
+
+    def setUp(self):
+        self.stub = SMTPStub().start()
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "outbox.sqlite3")
+        self.sender = SendEmail("127.0.0.1", self.stub.port, "user", "pswd", starttls=False)
+        self.outboxes = []
+
+    def tearDown(self):
+        for outbox in self.outboxes:
+            outbox.stop()
+        self.sender.pool.close()
+        self.stub.stop()
+        self.folder.cleanup()
+
+    def _outbox(self, **kwargs) -> Outbox:
+        outbox = Outbox(self.path, self.sender, poll_interval=0.05, **kwargs)
+        self.outboxes.append(outbox)
+        return outbox
+
+    def _enqueue(self, outbox: Outbox) -> str:
+        return outbox.enqueue_submission("clinic@example.com", "Bob_Marley.pdf", b"%PDF-1.3",
+                                         "Bob Marley", "bob@example.com", SUBMIT_DATETIME)
+
+    def test_enqueue_does_not_send(self):
+        """Test that storing a submission returns before anything is sent"""
+        outbox = self._outbox()
+        self._enqueue(outbox)
+        self.assertEqual(outbox.pending(), 2)
+        self.assertEqual(self.stub.messages, [])
+
+    def test_workers_send_stored_emails(self):
+        """Test that the workers send the clinic and patient emails and empty the outbox"""
+        outbox = self._outbox()
+        self._enqueue(outbox)
+        outbox.start()
+
+        self.assertTrue(outbox.drain(5))
+        recipients = sorted(message.rcpt_tos[0] for message in self.stub.messages)
+        self.assertEqual(recipients, ["bob@example.com", "clinic@example.com"])
+        clinic = next(message for message in self.stub.messages
+                      if message.rcpt_tos == ["clinic@example.com"])
+        self.assertIn(b"filename= Bob_Marley.pdf", clinic.data)
+        self.assertIn(b"July 01, 2024", clinic.data)
+        self.assertEqual(outbox.stats()["sent"], 2)
+
+    def test_emails_survive_restart(self):
+        """Test that emails stored by a stopped process are sent by the next one"""
+        self._enqueue(self._outbox())
+
+        outbox = self._outbox()
+        outbox.start()
+        self.assertTrue(outbox.drain(5))
+        self.assertEqual(len(self.stub.messages), 2)
+
+    def test_failed_email_is_kept(self):
+        """Test that an email the server rejects stays in the outbox"""
+        self.stub.fail("DATA", 451, "Try again later", times=2)
+        outbox = self._outbox()
+        self._enqueue(outbox)
+        outbox.start()
+
+        deadline = time.monotonic() + 5
+        while outbox.stats()["failed"] < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        outbox.stop()
+
+        self.assertEqual(outbox.pending(), 2)
+        attempts = sqlite3.connect(self.path).execute("SELECT attempts FROM outbox").fetchall()
+        self.assertEqual(attempts, [(1,), (1,)])
+
+    def test_lost_email_is_sent_after_lease(self):
+        """Test that an email a stopped process was sending is sent again after its lease"""
+        outbox = self._outbox(lease=60)
+        self._enqueue(outbox)
+        sqlite3.connect(self.path, isolation_level=None).execute(
+            "UPDATE outbox SET status = 'sending', next_attempt = ?", (time.time() - 61,))
+
+        outbox.start()
+        self.assertTrue(outbox.drain(5))
+        self.assertEqual(len(self.stub.messages), 2)
+
+    def test_worker_survives_unexpected_error(self):
+        """Test that a sender raising an unexpected error does not stop the worker"""
+        send_emails = self.sender.send_emails
+        calls = []
+
+        def failing_send(emails):
+            calls.append(len(emails))
+            if len(calls) == 1:
+                raise RuntimeError("Transport broke")
+            return send_emails(emails)
+
+        self.sender.send_emails = failing_send
+        outbox = self._outbox(workers=1, retry_policy=RetryPolicy(base_delay=0.05,
+                                                                  max_delay=0.05))
+        self._enqueue(outbox)
+        outbox.start()
+
+        self.assertTrue(outbox.drain(5))
+        self.assertEqual(len(self.stub.messages), 2)
+        self.assertEqual(outbox.stats()["failed"], 2)
+        self.assertEqual(outbox.stats()["dead_lettered"], 0)
+        self.assertTrue(all(thread.is_alive() for thread in outbox._threads))
+
+if __name__ == "__main__":
+    unittest.main()
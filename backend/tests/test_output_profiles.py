@@ -0,0 +1,92 @@
+"""Module for testing output_profiles.py"""
+import logging
+import threading
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock
+from fpdf.syntax import PDFContentStream
+from src.output_profiles import get_output_profile, output_pdf, OUTPUT_PROFILES
+from src.pdf_gen import GeneratePDF
+
+VALID_SIGNATURE = (
+    "data:image/png;base64,"
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1Pe"
+    "AAAADElEQVQI12P4//8/AAX+Av7czFnnAAAAAElFTkSuQmCC"
+)
+
+class TestOutputProfiles(unittest.TestCase):
+    """Class for testing the output profiles"""
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.CRITICAL)
+
+    def _generate(self, output_profile: str) -> bytes:
+        return GeneratePDF().generate_pdf_bytes("Bob Marley", "adult", [True, True, False],
+                                                VALID_SIGNATURE, datetime(2024, 1, 1),
+                                                output_profile)
+
+    def test_unknown_profile(self):
+        """Test that an unknown output profile raises ValueError"""
+        with self.assertRaises(ValueError):
+            get_output_profile("tiny")
+        with self.assertRaises(ValueError):
+            GeneratePDF(output_profile="tiny")
+
+    def test_fast_profile_does_not_compress_pages(self):
+        """Test that the fast profile leaves the page content uncompressed"""
+        self.assertIn(b" Tf", self._generate("fast"))
+        self.assertNotIn(b" Tf", self._generate("default"))
+
+    def test_small_profile(self):
+        """Test that the small profile recompresses the logo as a JPEG"""
+        small = self._generate("small")
+        self.assertIn(b"/DCTDecode", small)
+        self.assertNotIn(b"/DCTDecode", self._generate("default"))
+        self.assertLess(len(small), len(self._generate("default")))
+
+    def test_compression_level_restored(self):
+        """Test that the compression level is restored after a document is output"""
+        level = PDFContentStream._COMPRESSION_LEVEL
+        for name in OUTPUT_PROFILES:
+            self._generate(name)
+        self.assertEqual(PDFContentStream._COMPRESSION_LEVEL, level)
+
+    def test_fpdf_compression_level(self):
+        """Test that fpdf2 still reads the compression level the output profiles set"""
+        self.assertIsInstance(PDFContentStream._COMPRESSION_LEVEL, int)
+
+    def test_compression_levels_of_concurrent_outputs(self):
+        """
+        Test that documents with the same level are output at the same time, and one
+        with another level waits until they are done
+        """
+        outputting, release = threading.Event(), threading.Event()
+
+        def output():
+            outputting.set()
+            release.wait(5)
+            return bytearray(str(PDFContentStream._COMPRESSION_LEVEL).encode())
+
+        pdf = MagicMock()
+        pdf.output.side_effect = output
+        results = []
+        first = threading.Thread(target=lambda: results.append(
+            output_pdf(pdf, get_output_profile("fast"))))
+        first.start()
+        self.assertTrue(outputting.wait(5))
+        # Same level, not held up by the blocked output
+        self.assertIn(b" Tf", self._generate("fast"))
+
+        other = threading.Thread(target=lambda: results.append(
+            self._generate("default")[:5]))
+        other.start()
+        other.join(0.2)
+        self.assertTrue(other.is_alive())
+        release.set()
+        first.join()
+        other.join()
+        self.assertEqual(results, [b"1", b"%PDF-"])
+        self.assertEqual(PDFContentStream._COMPRESSION_LEVEL, -1)
+
+if __name__ == "__main__":
+    unittest.main()
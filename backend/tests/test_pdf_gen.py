@@ -3,13 +3,15 @@ import unittest
 import json
 import logging
 import base64
-from unittest.mock import MagicMock, patch, mock_open
+from unittest.mock import MagicMock, patch
 from datetime import datetime
 from fpdf import FPDF
-from src.fonts.fonts import Fonts
+from src.fonts.fonts import Fonts, PROFILE_CORE, PROFILE_EMBEDDED
+from src.form_templates import TEMPLATE_REGISTRY
 from src.pdf_gen import (
     GeneratePDF
 )
+from src.signature import Signature
 
 VALID_SIGNATURE = (
     "data:image/png;base64,"
@@ -123,6 +125,36 @@ class TestPDFGeneration(unittest.TestCase):
         decoded_pdf = base64.b64decode(pdf)
         self.assertTrue(decoded_pdf.startswith(b"%PDF-"))
 
+    def test_generate_pdf_bytes_output(self):
+        """
+        Verifies that the `generate_pdf_bytes` method returns the raw bytes of the PDF.
+        """
+        pdf = self.generator.generate_pdf_bytes("test", "adult", [True, False, True],
+                                                VALID_SIGNATURE, self.timestamp)
+
+        self.assertIsInstance(pdf, bytes)
+        self.assertTrue(pdf.startswith(b"%PDF-"))
+        self.assertTrue(pdf.rstrip().endswith(b"%%EOF"))
+
+    def test_decoded_signature(self):
+        """
+        Tests that a signature decoded during validation is embedded without being
+        decoded again, and gives the same image as the data URI.
+        """
+        self.generator.generate_pdf_bytes("test", "adult", [True, False, True],
+                                          VALID_SIGNATURE, self.timestamp)
+        images = list(self.generator.pdf.image_cache.images.values())
+
+        with patch.object(GeneratePDF, "_add_base64_image") as add_base64_image:
+            pdf = self.generator.generate_pdf_bytes("test", "adult", [True, False, True],
+                                                    Signature.from_data_uri(VALID_SIGNATURE),
+                                                    self.timestamp)
+        add_base64_image.assert_not_called()
+        self.assertTrue(pdf.startswith(b"%PDF-"))
+
+        decoded_images = list(self.generator.pdf.image_cache.images.values())
+        self.assertEqual(images[-1]["data"], decoded_images[-1]["data"])
+
     def test_successful_pdf_generation(self):
         """
         Tests that the `generate_pdf` method completes successfully
@@ -148,45 +180,114 @@ class TestPDFGeneration(unittest.TestCase):
             self.generator.generate_pdf("bob marley", "adult", [False, True, True],
                                         "invalid signature", self.timestamp)
 
-class TestGetJSON(unittest.TestCase):
+class TestBaseDocuments(unittest.TestCase):
     """
-    Test suite for the `_get_json_dict` method of the `GeneratePDF` class.
+    Test suite for the cached static documents used by the `GeneratePDF` class.
     """
 
     def setUp(self):
         """
-        Sets up the test environment by creating an instance of 
-        `GeneratePDF` and setting parameters for testing.
+        Clears the cached static documents so each test starts cold.
         """
-        self.generator = GeneratePDF()
-        self.token = "test_token"
-        self.client_name = "John Doe"
-        self.form_name = "test_form"
-        self.consent_flags = [True, False, True]
+        GeneratePDF.clear_render_cache()
+        self.timestamp = datetime.fromisocalendar(2000,1,1)
+
+    def test_base_document_rendered_once(self):
+        """
+        Tests that the static document is rendered once per form type and consent flags.
+        """
+        with patch.object(GeneratePDF, "_render_base_document",
+                          autospec=True, side_effect=GeneratePDF._render_base_document) as render:
+            for _ in range(3):
+                GeneratePDF().generate_pdf("test", "adult", [True, False, True],
+                                           VALID_SIGNATURE, self.timestamp)
+            GeneratePDF().generate_pdf("test", "adult", [False, False, True],
+                                       VALID_SIGNATURE, self.timestamp)
+        self.assertEqual(render.call_count, 2)
 
-    @patch("builtins.open", new_callable=mock_open, read_data='{"document": "Sample text"}')
-    def test_get_json_dict(self, mock_file):
+    def test_render_cache_stats(self):
         """
-        Tests that `_get_json_dict` correctly reads and parses a JSON file.
+        Tests that the size and hit rate of the static document cache are reported.
         """
-        result = self.generator._get_json_dict(self.form_name)
-        self.assertEqual(result, {"document": "Sample text"})
+        for flags in ([True, False, True], [True, False, True], [False, False, True]):
+            GeneratePDF().generate_pdf("test", "adult", flags, VALID_SIGNATURE, self.timestamp)
+        stats = GeneratePDF.render_cache_stats()
+        self.assertEqual((stats["size"], stats["hits"], stats["misses"]), (2, 1, 2))
+        self.assertAlmostEqual(stats["hit_rate"], 1 / 3)
 
-    @patch("builtins.open", side_effect=FileNotFoundError)
-    def test_get_json_dict_file_not_found(self, mock_file):
+        GeneratePDF.clear_render_cache()
+        self.assertEqual(GeneratePDF.render_cache_stats(),
+                         {"size": 0, "hits": 0, "misses": 0, "hit_rate": 0.0})
+
+    def test_base_document_not_modified(self):
         """
-        Tests that `_get_json_dict` raises a `FileNotFoundError` when the file does not exist.
+        Tests that stamping a submission onto a copy leaves the cached document untouched.
         """
-        with self.assertRaises(FileNotFoundError):
-            self.generator._get_json_dict(self.form_name)
+        generator = GeneratePDF()
+        generator.generate_pdf("test", "child", [True, False], VALID_SIGNATURE, self.timestamp)
+        version = TEMPLATE_REGISTRY.get("child").version
+        base = GeneratePDF._base_documents[("child", version, (True, False), PROFILE_EMBEDDED)]
+        self.assertIsNot(generator.pdf, base)
+        self.assertNotEqual(generator.pdf.y, base.y)
+        self.assertEqual(len(base.image_cache.images), 1)
 
-    @patch("builtins.open", new_callable=mock_open, read_data="invalid json")
-    def test_get_json_dict_json_decode_error(self, mock_file):
+    def test_documents_match_uncached_render(self):
         """
-        Tests that `_get_json_dict` raises a `JSONDecodeError` when the file contains invalid JSON.
+        Tests that a document built from the cache has the same pages as one built cold.
         """
-        with self.assertRaises(json.JSONDecodeError):
-            self.generator._get_json_dict(self.form_name)
+        cold = GeneratePDF().generate_pdf("test", "adult", [True, True, False],
+                                          VALID_SIGNATURE, self.timestamp)
+        warm = GeneratePDF().generate_pdf("test", "adult", [True, True, False],
+                                          VALID_SIGNATURE, self.timestamp)
+        self.assertEqual(len(base64.b64decode(cold)), len(base64.b64decode(warm)))
+
+    def test_non_latin_name_after_warm_up(self):
+        """
+        Tests that a name outside the ahead of time font subsets still renders.
+        """
+        GeneratePDF().warm_up()
+        pdf = GeneratePDF().generate_pdf_bytes("\u0416\u0435\u043d\u044f", "child",
+                                               [True, False], VALID_SIGNATURE, self.timestamp)
+        self.assertTrue(pdf.startswith(b"%PDF-"))
+
+class TestCoreProfile(unittest.TestCase):
+    """
+    Test suite for the lightweight render profile using the PDF core fonts.
+    """
+
+    def setUp(self):
+        """
+        Clears the cached static documents so each test starts cold.
+        """
+        GeneratePDF.clear_render_cache()
+        self.timestamp = datetime.fromisocalendar(2000,1,1)
+
+    def test_core_fonts_not_embedded(self):
+        """
+        Tests that the core profile prints without embedding any TrueType font.
+        """
+        generator = GeneratePDF(PROFILE_CORE)
+        pdf = generator.generate_pdf_bytes("Zo\u00eb", "adult", [True, False, True],
+                                           VALID_SIGNATURE, self.timestamp)
+        self.assertTrue(pdf.startswith(b"%PDF-"))
+        self.assertEqual({font.type for font in generator.pdf.fonts.values()}, {"core"})
+        self.assertNotIn(b"FontFile2", pdf)
+
+    def test_fallback_to_embedded_fonts(self):
+        """
+        Tests that a name the core fonts cannot encode is printed in the embedded fonts.
+        """
+        generator = GeneratePDF(PROFILE_CORE)
+        generator.generate_pdf_bytes("\u0416\u0435\u043d\u044f", "adult", [True, False, True],
+                                     VALID_SIGNATURE, self.timestamp)
+        self.assertEqual({font.type for font in generator.pdf.fonts.values()}, {"TTF"})
+
+    def test_unknown_profile(self):
+        """
+        Tests that an unknown render profile is rejected.
+        """
+        with self.assertRaises(ValueError):
+            GeneratePDF("fancy")
 
 if __name__ == "__main__":
     unittest.main()
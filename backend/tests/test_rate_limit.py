@@ -0,0 +1,237 @@
+"""Module for testing rate_limit.py"""
+import asyncio
+import logging
+import smtplib
+import threading
+import time
+import unittest
+from datetime import datetime
+from http_api_stub import HTTPAPIStub
+from smtp_stub import SMTPStub
+from src.async_send_email import AsyncSendEmail
+from src.http_transport import HTTPTransport, MailAPIError
+from src.rate_limit import MailRateLimiter, TokenBucket, is_throttled
+from src.send_email import SendEmail
+
+class TestTokenBucket(unittest.TestCase):
+    """Class for testing the TokenBucket class"""
+    def test_burst_then_steady_rate(self):
+        """Test that a burst is handed out at once and further tokens at the rate"""
+        bucket = TokenBucket(10, 3)
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0.0] * 3)
+        delays = [bucket.reserve() for _ in range(3)]
+        for delay, expected in zip(delays, (0.1, 0.2, 0.3)):
+            self.assertAlmostEqual(delay, expected, delta=0.01)
+
+    def test_refill(self):
+        """Test that the bucket refills over time, up to its size"""
+        bucket = TokenBucket(100, 2)
+        bucket.reserve(2)
+        time.sleep(0.05)
+        self.assertEqual(bucket.reserve(2), 0.0)
+        self.assertGreater(bucket.reserve(), 0.0)
+
+    def test_drain(self):
+        """Test that a drained bucket has no burst left"""
+        bucket = TokenBucket(10, 5)
+        bucket.drain()
+        self.assertAlmostEqual(bucket.reserve(), 0.1, delta=0.01)
+
+    def test_invalid_rate(self):
+        """Test that a rate that is not positive is refused"""
+        with self.assertRaises(ValueError):
+            TokenBucket(0, 1)
+
+class TestMailRateLimiter(unittest.TestCase):
+    """Class for testing the MailRateLimiter class"""
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.CRITICAL)
+
+    def test_relays_and_senders_are_separate(self):
+        """Test that each relay and sender account has its own bucket"""
+        limiter = MailRateLimiter(relay_rate=10, relay_burst=1, sender_rate=10, sender_burst=1)
+        self.assertEqual(limiter.reserve("relay-a", "clinic@example.com"), 0.0)
+        self.assertEqual(limiter.reserve("relay-b", "other@example.com"), 0.0)
+        self.assertGreater(limiter.reserve("relay-b", "clinic@example.com"), 0.0)
+        self.assertGreater(limiter.reserve("relay-c", "other@example.com"), 0.0)
+
+    def test_unlimited(self):
+        """Test that a limiter without rates never waits"""
+        limiter = MailRateLimiter()
+        self.assertEqual([limiter.acquire("relay", "clinic@example.com") for _ in range(50)],
+                         [0.0] * 50)
+        self.assertEqual(limiter.stats()["throttled"], 0)
+
+    def test_concurrent_burst_is_smoothed(self):
+        """Test that a burst from many threads is spread out at the allowed rate"""
+        limiter = MailRateLimiter(relay_rate=50, relay_burst=5)
+        start = time.monotonic()
+        threads = [threading.Thread(target=limiter.acquire,
+                                    args=("relay", "clinic@example.com"))
+                   for _ in range(15)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+        stats = limiter.stats()
+        self.assertEqual((stats["sends"], stats["throttled"]), (15, 10))
+        self.assertAlmostEqual(stats["wait_max"], 0.2, delta=0.02)
+
+    def test_prepay(self):
+        """Test that tokens taken ahead are waited for at once and used by the next sends"""
+        limiter = MailRateLimiter(relay_rate=10, relay_burst=1)
+        start = time.monotonic()
+        self.assertAlmostEqual(limiter.prepay("relay", "clinic@example.com", 2), 0.1, delta=0.02)
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertEqual([limiter.reserve("relay", "clinic@example.com") for _ in range(2)],
+                         [0.0] * 2)
+        # Only the sender that paid ahead goes without waiting
+        self.assertGreater(limiter.reserve("relay", "other@example.com"), 0.0)
+
+    def test_refund(self):
+        """Test that tokens taken ahead for sends that are not made are given back"""
+        limiter = MailRateLimiter(relay_rate=10, relay_burst=2)
+        self.assertEqual(limiter.prepay("relay", "clinic@example.com", 2), 0.0)
+        limiter.refund("relay", "clinic@example.com", 2)
+        # Neither the credit nor the tokens are left over, the burst is back as it was
+        self.assertEqual([limiter.reserve("relay", "clinic@example.com") for _ in range(2)],
+                         [0.0] * 2)
+        self.assertGreater(limiter.reserve("relay", "clinic@example.com"), 0.0)
+
+    def test_used_credit_is_not_refunded(self):
+        """Test that tokens taken ahead and used by another send are not given back"""
+        limiter = MailRateLimiter(relay_rate=10, relay_burst=1)
+        limiter.prepay("relay", "clinic@example.com")
+        self.assertEqual(limiter.reserve("relay", "clinic@example.com"), 0.0)
+        limiter.refund("relay", "clinic@example.com")
+        self.assertGreater(limiter.reserve("relay", "clinic@example.com"), 0.0)
+
+    def test_backoff_slows_the_sender(self):
+        """Test that throttling slows the sender account down as well as the relay"""
+        limiter = MailRateLimiter(sender_rate=10, sender_burst=5)
+        self.assertTrue(limiter.backoff("relay", "clinic@example.com",
+                                        smtplib.SMTPSenderRefused(421, b"Slow down", "a@b")))
+        self.assertAlmostEqual(limiter.reserve("relay", "clinic@example.com"), 0.1, delta=0.01)
+        self.assertEqual(limiter.reserve("relay", "other@example.com"), 0.0)
+
+    def test_is_throttled(self):
+        """Test that throttling replies are told apart from other errors"""
+        self.assertTrue(is_throttled(smtplib.SMTPSenderRefused(421, b"Slow down", "a@b")))
+        self.assertTrue(is_throttled(smtplib.SMTPRecipientsRefused({"a@b": (450, b"Later")})))
+        self.assertTrue(is_throttled(MailAPIError(429, "Too many requests")))
+        self.assertFalse(is_throttled(smtplib.SMTPRecipientsRefused({"a@b": (550, b"No")})))
+        self.assertFalse(is_throttled(smtplib.SMTPDataError(451, b"Local error")))
+        self.assertFalse(is_throttled(MailAPIError(500, "Internal error")))
+
+class TestRateLimitedTransports(unittest.TestCase):
+    """Class for testing the mail transports with a rate limiter"""
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.CRITICAL)
+
+    def setUp(self):
+        self.stub = SMTPStub().start()
+        self.limiter = MailRateLimiter(relay_rate=20, relay_burst=2)
+        self.sender = SendEmail("localhost", self.stub.port, "user", "pswd", starttls=False,
+                                rate_limiter=self.limiter)
+
+    def tearDown(self):
+        self.sender.close()
+        self.stub.stop()
+
+    def test_burst_is_sent_at_the_rate(self):
+        """Test that emails beyond the burst wait for the rate and report the wait"""
+        emails = [self.sender.patient_email(f"patient{number}@example.com", "Bob Marley")
+                  for number in range(6)]
+        start = time.monotonic()
+        results = self.sender.send_emails(emails)
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+        self.assertTrue(all(result.error is None for result in results))
+        self.assertEqual([result.waited > 0 for result in results], [False] * 2 + [True] * 4)
+        self.assertEqual(len(self.stub.messages), 6)
+
+    def test_throttled_email_is_sent_again(self):
+        """Test that an email the relay throttles is sent again after slowing down"""
+        self.stub.fail("MAIL", 421, "Too many messages, slow down")
+        self.sender.send_email_to_patient("bob@example.com", "Bob Marley")
+
+        self.assertEqual([message.rcpt_tos for message in self.stub.messages],
+                         [["bob@example.com"]])
+        self.assertEqual(self.limiter.stats()["backoffs"], 1)
+        self.assertEqual(self.limiter.stats()["throttled"], 1)
+
+    def test_throttled_twice_fails(self):
+        """Test that an email still throttled after slowing down fails"""
+        self.stub.fail("RCPT", 450, "Rate limited", times=2)
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            self.sender.send_email_to_patient("bob@example.com", "Bob Marley")
+        self.assertEqual(self.stub.messages, [])
+
+    def test_async_sender_shares_the_limiter(self):
+        """Test that the asyncio sender waits on the event loop for the same buckets"""
+        sender = AsyncSendEmail("localhost", self.stub.port, "user", "pswd", starttls=False,
+                                rate_limiter=self.limiter)
+
+        async def send():
+            try:
+                return await asyncio.gather(*(
+                    sender.send_emails([sender.patient_email(f"patient{number}@example.com",
+                                                             "Bob Marley")])
+                    for number in range(4)))
+            finally:
+                await sender.close()
+
+        start = time.monotonic()
+        results = asyncio.run(send())
+        self.assertGreaterEqual(time.monotonic() - start, 0.08)
+        self.assertEqual(sum(result[0].waited > 0 for result in results), 2)
+        self.assertEqual(len(self.stub.messages), 4)
+
+    def test_wait_does_not_hold_a_connection(self):
+        """Test that an email waiting for the rate limiter leaves the connection in the pool"""
+        sender = SendEmail("localhost", self.stub.port, "user", "pswd", pool_size=1,
+                           starttls=False, rate_limiter=MailRateLimiter(relay_rate=5,
+                                                                        relay_burst=1))
+        try:
+            sender.send_email_to_patient("bob@example.com", "Bob Marley")
+            thread = threading.Thread(target=sender.send_email_to_patient,
+                                      args=("alice@example.com", "Alice"))
+            thread.start()
+            time.sleep(0.05)
+            self.assertEqual(sender.pool.stats()["idle"], 1)
+            thread.join()
+        finally:
+            sender.close()
+        self.assertEqual(len(self.stub.messages), 2)
+
+    def test_paced_submission(self):
+        """Test that the emails of a paced submission are sent without waiting again"""
+        self.assertEqual(self.sender.pace(2), 0.0)
+        self.assertGreater(self.sender.pace(2), 0.0)
+        results = self.sender.send_submission("clinic@example.com", "Bob_Marley.pdf",
+                                              b"%PDF-1.3", "Bob Marley", "bob@example.com",
+                                              datetime(2024, 7, 1))
+        self.assertEqual([result.waited for result in results], [0.0] * 2)
+
+    def test_http_api_rate_limit(self):
+        """Test that a request the mail API throttles is posted again after slowing down"""
+        with HTTPAPIStub() as stub:
+            limiter = MailRateLimiter(relay_rate=20, relay_burst=1)
+            transport = HTTPTransport("re_test_key", stub.url, rate_limiter=limiter)
+            sender = SendEmail(None, None, "clinic@example.com", None, transport=transport)
+            try:
+                stub.fail(429, "Too many requests")
+                sender.send_email_to_patient("bob@example.com", "Bob Marley")
+            finally:
+                transport.close()
+
+        self.assertEqual(len(stub.requests), 1)
+        self.assertEqual(limiter.stats()["backoffs"], 1)
+        self.assertGreater(limiter.stats()["wait_total"], 0.0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,187 @@
+"""Module for testing relays.py and the FailoverTransport against local SMTP servers"""
+import logging
+import smtplib
+import socket
+import time
+import unittest
+from datetime import datetime
+from smtp_stub import SMTPStub
+from src.relays import Relay, RelaySelector, is_relay_failure, parse_relays
+from src.send_email import FailoverTransport, SendEmail
+
+class TestRelays(unittest.TestCase):
+    """Class for testing the relay list and error classification"""
+    def test_parse_relays(self):
+        """Test that relays are read with their ports and weights"""
+        self.assertEqual(parse_relays("smtp1.example.com:2525*3, smtp2.example.com", 587),
+                         [Relay("smtp1.example.com", 2525, 3), Relay("smtp2.example.com", 587, 1)])
+        for spec in ("", "smtp.example.com:port", "smtp.example.com*0", ":25"):
+            with self.assertRaises(ValueError):
+                parse_relays(spec)
+
+    def test_is_relay_failure(self):
+        """Test that errors of the relay are told apart from errors of the email"""
+        self.assertTrue(is_relay_failure(ConnectionRefusedError()))
+        self.assertTrue(is_relay_failure(smtplib.SMTPServerDisconnected()))
+        self.assertTrue(is_relay_failure(smtplib.SMTPSenderRefused(421, b"Busy", "a@b")))
+        self.assertTrue(is_relay_failure(smtplib.SMTPAuthenticationError(535, b"Bad login")))
+        self.assertFalse(is_relay_failure(smtplib.SMTPRecipientsRefused({"a@b": (550, b"No")})))
+        self.assertFalse(is_relay_failure(smtplib.SMTPDataError(554, b"Rejected")))
+        self.assertFalse(is_relay_failure(ValueError("Missing slot")))
+
+class TestRelaySelector(unittest.TestCase):
+    """Class for testing the RelaySelector class"""
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.CRITICAL)
+
+    def setUp(self):
+        self.primary = Relay("primary", 25, 3)
+        self.backup = Relay("backup", 25, 1)
+        self.selector = RelaySelector([self.primary, self.backup], eject_time=0.1)
+
+    def test_weighted_round_robin(self):
+        """Test that the relays take their shares evenly"""
+        firsts = [self.selector.order()[0].server for _ in range(8)]
+        self.assertEqual(firsts.count("primary"), 6)
+        self.assertNotIn(["backup", "backup"], [firsts[i:i + 2] for i in range(7)])
+        self.assertEqual(self.selector.order(), [self.primary, self.backup])
+
+    def test_failing_relay_is_taken_out(self):
+        """Test that a relay failing in a row is out of rotation for a while"""
+        for _ in range(3):
+            self.selector.record(self.primary, 0.0, ConnectionRefusedError())
+        self.assertEqual([self.selector.order() for _ in range(4)], [[self.backup]] * 4)
+
+        time.sleep(0.15)
+        self.assertIn(self.primary, self.selector.order())
+        # A failed probe takes it out again straight away
+        self.selector.record(self.primary, 0.0, ConnectionRefusedError())
+        self.assertEqual(self.selector.order(), [self.backup])
+        self.assertEqual(self.selector.stats()[0]["ejections"], 2)
+
+    def test_error_rate_and_latency(self):
+        """Test that a relay failing too often or too slow is taken out"""
+        # Never three failures in a row, but two out of every three emails
+        for number in range(9):
+            self.selector.record(self.primary, 0.1, None if number % 3 == 2 else TimeoutError())
+        self.assertEqual(self.selector.stats()[0]["healthy"], True)
+        self.selector.record(self.primary, 0.0, TimeoutError())
+        self.assertEqual(self.selector.stats()[0]["healthy"], False)
+
+        self.selector.record(self.backup, 12.0, None)
+        self.assertEqual(self.selector.stats()[1]["healthy"], False)
+
+    def test_email_errors_do_not_count(self):
+        """Test that emails the relay rightly refuses do not count against it"""
+        for _ in range(5):
+            self.selector.record(self.primary, 0.1, smtplib.SMTPRecipientsRefused(
+                {"a@b": (550, b"No such user")}))
+        self.assertEqual(self.selector.stats()[0]["error_rate"], 0.0)
+        self.assertEqual(self.selector.stats()[0]["healthy"], True)
+
+    def test_all_relays_out(self):
+        """Test that every relay is tried when they are all out of rotation"""
+        for relay in (self.backup, self.primary):
+            for _ in range(3):
+                self.selector.record(relay, 0.0, ConnectionRefusedError())
+        self.assertEqual(self.selector.order(), [self.backup, self.primary])
+
+class TestFailoverTransport(unittest.TestCase):
+    """Class for testing SendEmail over several local SMTP relays"""
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.CRITICAL)
+
+    def setUp(self):
+        self.stubs = [SMTPStub().start() for _ in range(3)]
+        self.relays = [Relay("127.0.0.1", stub.port, weight)
+                       for stub, weight in zip(self.stubs, (2, 1, 1))]
+        self.senders = []
+
+    def tearDown(self):
+        for sender in self.senders:
+            sender.close()
+        for stub in self.stubs:
+            stub.stop()
+
+    def _sender(self, relays=None, **kwargs) -> SendEmail:
+        selector = RelaySelector(relays or self.relays, **kwargs)
+        transport = FailoverTransport(selector, "user", "pswd", starttls=False, timeout=0.5)
+        sender = SendEmail(None, None, "clinic@example.com", None, transport=transport)
+        self.senders.append(sender)
+        return sender
+
+    def _submit(self, sender: SendEmail) -> None:
+        sender.send_submission("clinic@example.com", "Bob_Marley.pdf", b"%PDF-1.3",
+                               "Bob Marley", "bob@example.com", datetime(2024, 7, 1))
+
+    def test_sends_are_spread_by_weight(self):
+        """Test that submissions are spread over the relays by weight"""
+        sender = SendEmail(None, None, "clinic@example.com", "pswd", starttls=False,
+                           relays=self.relays)
+        self.senders.append(sender)
+        for _ in range(8):
+            self._submit(sender)
+
+        self.assertEqual([len(stub.messages) for stub in self.stubs], [8, 4, 4])
+        stats = sender.transport.stats()
+        self.assertEqual([relay["sends"] for relay in stats["relays"]], [8, 4, 4])
+        self.assertEqual(stats["created"], 3)
+
+    def test_relay_down(self):
+        """Test that submissions fail over from a relay that is down, which is taken out"""
+        self.stubs[0].down_after = 0
+        sender = self._sender()
+        for _ in range(4):
+            self._submit(sender)
+
+        self.assertEqual(self.stubs[0].messages, [])
+        self.assertEqual(len(self.stubs[1].messages) + len(self.stubs[2].messages), 8)
+        primary = sender.transport.stats()["relays"][0]
+        self.assertEqual((primary["healthy"], primary["ejections"]), (False, 1))
+
+    def test_failover_mid_submission(self):
+        """Test that the rest of a submission is sent through another relay"""
+        self.stubs[0].down_after = 1
+        self._submit(self._sender())
+
+        self.assertEqual([message.rcpt_tos for message in self.stubs[0].messages],
+                         [["clinic@example.com"]])
+        self.assertEqual([message.rcpt_tos for message in self.stubs[1].messages],
+                         [["bob@example.com"]])
+
+    def test_slow_relay(self):
+        """Test that a relay that does not answer times out and is failed over"""
+        silent = socket.create_server(("127.0.0.1", 0))
+        try:
+            relays = [Relay("127.0.0.1", silent.getsockname()[1]), self.relays[1]]
+            sender = self._sender(relays, failure_threshold=2)
+            start = time.monotonic()
+            for _ in range(4):
+                self._submit(sender)
+        finally:
+            silent.close()
+
+        self.assertEqual(len(self.stubs[1].messages), 8)
+        # Only the first submission waited for the silent relay, which was then taken out
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(sender.transport.stats()["relays"][0]["healthy"], False)
+
+    def test_email_errors_are_not_failed_over(self):
+        """Test that an email every relay would refuse is not sent to the others"""
+        self.stubs[0].fail("RCPT", 550, "No such user")
+        sender = self._sender()
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            sender.send_email_to_patient("nobody@example.com", "Bob Marley")
+        self.assertEqual(sum(len(stub.commands) for stub in self.stubs[1:]), 0)
+
+    def test_all_relays_fail(self):
+        """Test that the error of the last relay is raised once every relay has failed"""
+        for stub in self.stubs:
+            stub.down_after = 0
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            self._submit(self._sender())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+"""Module for testing render_pool.py"""
+import unittest
+import base64
+import logging
+from datetime import datetime
+from src.pdf_gen import GeneratePDF
+from src.render_pool import RenderPool
+from src.signature import Signature
+
+VALID_SIGNATURE = (
+    "data:image/png;base64,"
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1Pe"
+    "AAAADElEQVQI12P4//8/AAX+Av7czFnnAAAAAElFTkSuQmCC"
+)
+
+logging.disable(logging.CRITICAL)
+
+def _base_documents() -> int:
+    """Returns the number of static documents rendered in a worker process"""
+    return len(GeneratePDF._base_documents)  # pylint: disable=protected-access
+
+class TestRenderPool(unittest.TestCase):
+    """
+    Test suite for the `RenderPool` class, which renders PDFs in worker processes.
+    """
+    @classmethod
+    def setUpClass(cls):
+        """
+        Starts a pool with one worker that is recycled after every two jobs.
+        """
+        cls.pool = RenderPool(1, max_jobs_per_worker=2)
+        cls.pool.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        """
+        Stops the worker processes.
+        """
+        cls.pool.shutdown()
+
+    def test_generate_pdf(self):
+        """
+        Tests that PDFs rendered in the pool are valid, including after a worker is recycled.
+        """
+        for form_type, flags in [("adult", [True, False, True]), ("child", [True, False]),
+                                 ("adult", [False, False, False])]:
+            pdf = self.pool.generate_pdf_bytes("test", form_type, flags,
+                                               VALID_SIGNATURE, datetime.now())
+            self.assertTrue(pdf.startswith(b"%PDF-"))
+
+    def test_recycled_workers_are_warm(self):
+        """
+        Tests that workers, including those replacing recycled ones, render the static
+        documents before their first job.
+        """
+        executor = self.pool._executor  # pylint: disable=protected-access
+        for _ in range(3):
+            self.assertGreater(executor.submit(_base_documents).result(), 0)
+
+    def test_generate_pdf_base64(self):
+        """
+        Tests that the string API returns the PDF encoded to base64.
+        """
+        pdf = self.pool.generate_pdf("test", "child", [True, True], VALID_SIGNATURE, datetime.now())
+        self.assertTrue(base64.b64decode(pdf).startswith(b"%PDF-"))
+
+    def test_decoded_signature(self):
+        """
+        Tests that a decoded signature can be sent to a worker process.
+        """
+        pdf = self.pool.generate_pdf_bytes("test", "child", [True, False],
+                                           Signature.from_data_uri(VALID_SIGNATURE),
+                                           datetime.now())
+        self.assertTrue(pdf.startswith(b"%PDF-"))
+
+    def test_errors_are_raised(self):
+        """
+        Tests that an error in a worker is raised to the caller.
+        """
+        with self.assertRaises(FileNotFoundError):
+            self.pool.generate_pdf("test", "lol", [], VALID_SIGNATURE, datetime.now())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,10 +2,14 @@
 import unittest
 import smtplib
 import base64
+import email
 import os
+import tracemalloc
 from datetime import datetime
-from unittest.mock import patch, MagicMock, ANY
-from src.send_email import SendEmail
+from unittest.mock import patch, MagicMock
+from smtp_stub import SMTPStub
+from src.send_email import _DataWriter, OutgoingEmail, SendEmail
+from src.smtp_pool import SMTP_TIMEOUT
 from dotenv import find_dotenv, load_dotenv
 
 load_dotenv(find_dotenv(".env"))
@@ -16,6 +20,19 @@ PORT: str = os.getenv("SMTP_PORT")
 SMTP_USER: str = os.getenv("SMTP_USER")
 PSWD: str = os.getenv("SMTP_PSWD")
 
+def _mock_server() -> MagicMock:
+    """Returns a mock SMTP connection that accepts every command"""
+    mock_server = MagicMock()
+    mock_server.mail.return_value = (250, b"OK")
+    mock_server.rcpt.return_value = (250, b"OK")
+    mock_server.docmd.return_value = (354, b"End data with <CR><LF>.<CR><LF>")
+    mock_server.getreply.return_value = (250, b"OK")
+    return mock_server
+
+def _sent_data(mock_server: MagicMock) -> str:
+    """Returns the message data streamed to a mock SMTP connection"""
+    return b"".join(call.args[0] for call in mock_server.send.call_args_list).decode("ascii")
+
 class TestSendClinicEmails(unittest.TestCase):
     """
     Unit tests for the `send_email_to_clinic` function.
@@ -39,7 +56,7 @@ class TestSendClinicEmails(unittest.TestCase):
         Tests that the `send_email_to_clinic` function sends an email successfully.
         """
         # Mock the SMTP server
-        mock_server = MagicMock()
+        mock_server = _mock_server()
         mock_smtp.return_value = mock_server
 
         # Call the send_email_to_clinic method
@@ -48,12 +65,31 @@ class TestSendClinicEmails(unittest.TestCase):
                                             self.patient_email, self.datetime)
 
         # Assertions to verify that the email sending process was called correctly
-        mock_smtp.assert_called_with(SERVER, PORT)
+        mock_smtp.assert_called_with(SERVER, PORT, timeout=SMTP_TIMEOUT)
         mock_server.starttls.assert_called_once()
         mock_server.login.assert_called_with(SMTP_USER, PSWD)
-        mock_server.sendmail.assert_called_once()
-        mock_server.sendmail.assert_called_with(SMTP_USER, self.email_to, ANY)
-        self.assertIn(self.email_to, mock_server.sendmail.call_args[0][1])
+        mock_server.mail.assert_called_once_with(SMTP_USER)
+        mock_server.rcpt.assert_called_once_with(self.email_to)
+        mock_server.docmd.assert_called_once_with("DATA")
+        self.assertTrue(_sent_data(mock_server).endswith("\r\n.\r\n"))
+
+    @patch("src.send_email.smtplib.SMTP")
+    def test_send_pdf_to_clinic_attachment(self, mock_smtp):
+        """
+        Tests that `send_pdf_to_clinic` attaches the raw PDF bytes, encoded once as base64.
+        """
+        mock_server = _mock_server()
+        mock_smtp.return_value = mock_server
+
+        self.send_email.send_pdf_to_clinic(self.email_to, self.attachment_name,
+                                           b"pdf content test bobby", self.patient_name,
+                                           self.patient_email, self.datetime)
+
+        email_content = _sent_data(mock_server)
+        self.assertIn("Content-Type: application/pdf", email_content)
+        self.assertIn("Content-Transfer-Encoding: base64", email_content)
+        self.assertIn(self.attachment_content, email_content)
+        self.assertIn(f"filename= {self.attachment_name}", email_content)
 
     @patch("src.send_email.smtplib.SMTP")
     def test_send_clinic_email_authentication_error(self, mock_smtp):
@@ -151,7 +187,7 @@ class TestSendClinicEmails(unittest.TestCase):
         Tests that the `send_email_to_clinic` function sends an email with the correct content.
         """
         # Mock the SMTP server
-        mock_server = MagicMock()
+        mock_server = _mock_server()
         mock_smtp.return_value = mock_server
 
         # Call the send_email_to_clinic function
@@ -160,7 +196,7 @@ class TestSendClinicEmails(unittest.TestCase):
                                              self.patient_email, self.datetime)
 
         # Get the email content
-        email_content = mock_server.sendmail.call_args[0][2]
+        email_content = _sent_data(mock_server)
 
         # Check if the email content is correctly formed
         self.assertIn("Content-Type: text/html", email_content)
@@ -187,19 +223,20 @@ class TestSendPatientEmails(unittest.TestCase):
         Tests that the `send_email_to_patient` function sends an email successfully.
         """
         # Mock the SMTP server
-        mock_server = MagicMock()
+        mock_server = _mock_server()
         mock_smtp.return_value = mock_server
 
         # Call the send_email_to_patient function
         self.send_email.send_email_to_patient(self.email_to, self.patient_name)
 
         # Assertions to verify that the email sending process was called correctly
-        mock_smtp.assert_called_with(SERVER, PORT)
+        mock_smtp.assert_called_with(SERVER, PORT, timeout=SMTP_TIMEOUT)
         mock_server.starttls.assert_called_once()
         mock_server.login.assert_called_with(self.email_from, PSWD)
-        mock_server.sendmail.assert_called_once()
-        mock_server.sendmail.assert_called_with(self.email_from, self.email_to, ANY)
-        self.assertIn(self.email_to, mock_server.sendmail.call_args[0][1])
+        mock_server.mail.assert_called_once_with(self.email_from)
+        mock_server.rcpt.assert_called_once_with(self.email_to)
+        mock_server.docmd.assert_called_once_with("DATA")
+        self.assertTrue(_sent_data(mock_server).endswith("\r\n.\r\n"))
 
     @patch("src.send_email.smtplib.SMTP")
     def test_send_patient_email_authentication_error(self, mock_smtp):
@@ -279,14 +316,14 @@ class TestSendPatientEmails(unittest.TestCase):
         Tests that the `send_email_to_patient` function sends an email with the correct content.
         """
         # Mock the SMTP server
-        mock_server = MagicMock()
+        mock_server = _mock_server()
         mock_smtp.return_value = mock_server
 
         # Call the send_email_to_patient function
         self.send_email.send_email_to_patient(self.email_to, self.patient_name)
 
         # Get the email content
-        email_content = mock_server.sendmail.call_args[0][2]
+        email_content = _sent_data(mock_server)
 
         # Check if the email content is correctly formed
         self.assertIn("Content-Type: text/html", email_content)
@@ -296,5 +333,116 @@ class TestSendPatientEmails(unittest.TestCase):
         )
         self.assertIn("Dear Bob Marley,", email_content)
 
+class TestSendSubmission(unittest.TestCase):
+    """
+    Unit tests for the `send_submission` function against a local SMTP server.
+    """
+
+    def setUp(self) -> None:
+        """
+        Starts a local SMTP server that supports pipelining.
+        """
+        self.stub = SMTPStub(extensions=("AUTH PLAIN LOGIN", "PIPELINING")).start()
+        self.send_email = SendEmail("127.0.0.1", self.stub.port, SMTP_USER or "user",
+                                    "pswd", starttls=False)
+
+    def tearDown(self) -> None:
+        self.send_email.pool.close()
+        self.stub.stop()
+
+    def _send_submission(self):
+        return self.send_email.send_submission("clinic@example.com", "bobs_consent_info.pdf",
+                                               b"pdf content test bobby", "Bob Marley",
+                                               "bob@example.com", datetime.now())
+
+    def test_one_session_per_submission(self):
+        """
+        Tests that both emails of a submission are sent over a single session.
+        """
+        with patch.object(smtplib.SMTP, "sendmail") as sendmail:
+            results = self._send_submission()
+
+        # Pipelined rather than sent with sendmail
+        sendmail.assert_not_called()
+        self.assertEqual(self.stub.sessions, 1)
+        self.assertEqual([message.rcpt_tos for message in self.stub.messages],
+                         [["clinic@example.com"], ["bob@example.com"]])
+        self.assertEqual([message.session for message in self.stub.messages], [1, 1])
+        self.assertEqual([result.email_to for result in results],
+                         ["clinic@example.com", "bob@example.com"])
+        self.assertTrue(all(result.elapsed > 0 and result.error is None for result in results))
+        self.assertIn(b"filename= bobs_consent_info.pdf", self.stub.messages[0].data)
+        self.assertIn(b"Dear Bob Marley,", self.stub.messages[1].data)
+
+    def test_one_session_without_pipelining(self):
+        """
+        Tests that both emails share a session when the server does not pipeline.
+        """
+        self.stub.extensions = ("AUTH PLAIN LOGIN",)
+        self._send_submission()
+        self.assertEqual([message.session for message in self.stub.messages], [1, 1])
+
+    def test_refused_recipient(self):
+        """
+        Tests that a refused recipient fails its email only, and the error is raised.
+        """
+        self.stub.fail("RCPT", 550, "No such user")
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            self._send_submission()
+
+        self.assertEqual([message.rcpt_tos for message in self.stub.messages],
+                         [["bob@example.com"]])
+        self.assertEqual(self.stub.sessions, 1)
+
+class TestStreamedMessages(unittest.TestCase):
+    """
+    Unit tests for serializing messages while they are sent.
+    """
+
+    def setUp(self) -> None:
+        self.stub = SMTPStub().start()
+        self.send_email = SendEmail("127.0.0.1", self.stub.port, "user", "pswd", starttls=False)
+        self.pdf_content = os.urandom(3 * 1024 * 1024 + 5)
+
+    def tearDown(self) -> None:
+        self.send_email.pool.close()
+        self.stub.stop()
+
+    def test_large_attachment_round_trip(self):
+        """
+        Tests that a large attachment and a body with leading dots arrive intact.
+        """
+        results = self.send_email.send_emails([OutgoingEmail(
+            "clinic@example.com", "Subject", ".starts with a dot\n<p>Body</p>\n.",
+            "big.pdf", self.pdf_content)])
+
+        self.assertIsNone(results[0].error)
+        data = self.stub.messages[0].data
+        self.assertTrue(all(len(line) <= 78 for line in data.split(b"\r\n")))
+        message = email.message_from_bytes(data)
+        body, attachment = message.get_payload()
+        self.assertEqual(body.get_payload(), ".starts with a dot\r\n<p>Body</p>\r\n.")
+        self.assertEqual(attachment.get_filename(), "big.pdf")
+        self.assertEqual(attachment.get_payload(decode=True), self.pdf_content)
+
+    def test_peak_memory_is_flat(self):
+        """
+        Tests that the memory used to send a message does not grow with its attachment.
+        """
+        peaks = []
+        for size in (1, 8):
+            outgoing = OutgoingEmail("clinic@example.com", "Subject", "<p>Body</p>",
+                                     "big.pdf", self.pdf_content[:1024 * 1024] * size)
+            tracemalloc.start()
+            writer = _DataWriter(lambda data: None)
+            for chunk in self.send_email._message_chunks(outgoing):
+                writer.write(chunk)
+            writer.close()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        self.assertLess(peaks[1], 1024 * 1024)
+        self.assertLess(peaks[1], peaks[0] * 1.5)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,127 @@
+"""Module for testing signature.py"""
+import unittest
+import base64
+import io
+import pickle
+from PIL import Image
+from src.signature import Signature, PRINT_DPI
+
+VALID_SIGNATURE = (
+    "data:image/png;base64,"
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1Pe"
+    "AAAADElEQVQI12P4//8/AAX+Av7czFnnAAAAAElFTkSuQmCC"
+)
+
+class TestSignature(unittest.TestCase):
+    """
+    Test suite for the `Signature` class, which decodes signature data URIs once.
+    """
+
+    def test_from_data_uri(self):
+        """
+        Tests that a valid data URI is decoded and its pixels are loaded.
+        """
+        signature = Signature.from_data_uri(VALID_SIGNATURE)
+        self.assertEqual(signature.size, (1, 1))
+        self.assertEqual(signature.image.format, "PNG")
+        self.assertEqual(signature.png_data,
+                         base64.b64decode(VALID_SIGNATURE.split("base64,")[1]))
+
+    def test_invalid_data_uri(self):
+        """
+        Tests that anything other than a base64 PNG data URI is rejected.
+        """
+        for data_uri in ["invalid signature", None, "data:image/jpeg;base64,AAAA",
+                         "data:image/png;base64,AAA"]:
+            with self.assertRaises(ValueError):
+                Signature.from_data_uri(data_uri)
+
+    def test_not_png(self):
+        """
+        Tests that an image in another format is rejected.
+        """
+        buffer = io.BytesIO()
+        Image.new("RGB", (1, 1)).save(buffer, "GIF")
+        data_uri = "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+        with self.assertRaises(ValueError):
+            Signature.from_data_uri(data_uri)
+
+    def test_truncated_png(self):
+        """
+        Tests that a PNG with a valid header but missing pixel data is rejected.
+        """
+        png_data = base64.b64decode(VALID_SIGNATURE.split("base64,")[1])
+        with self.assertRaises(ValueError):
+            Signature.from_png(png_data[:40])
+
+    def test_pickle(self):
+        """
+        Tests that a signature survives being sent to a worker process.
+        """
+        signature = pickle.loads(pickle.dumps(Signature.from_data_uri(VALID_SIGNATURE)))
+        self.assertEqual(signature.size, (1, 1))
+        self.assertEqual(signature.image.tobytes(),
+                         Signature.from_data_uri(VALID_SIGNATURE).image.tobytes())
+
+class TestNormalize(unittest.TestCase):
+    """
+    Test suite for `Signature.normalize`, which prepares a signature for printing.
+    """
+
+    def setUp(self):
+        """
+        Draws a signature in the middle of a large transparent canvas.
+        """
+        canvas = Image.new("RGBA", (1500, 500), (0, 0, 0, 0))
+        canvas.paste((0, 0, 0, 255), (500, 200, 1000, 300))
+        buffer = io.BytesIO()
+        canvas.save(buffer, "PNG")
+        self.signature = Signature.from_png(buffer.getvalue())
+
+    def test_crop_and_downscale(self):
+        """
+        Tests that the margins are trimmed, the ink keeps its printed size and the
+        image is scaled down to the print resolution.
+        """
+        normalized = self.signature.normalize(20)
+        self.assertAlmostEqual(normalized.width, 20)
+        self.assertAlmostEqual(normalized.height, 4)
+        self.assertEqual(normalized.image.height, round(4 / 25.4 * PRINT_DPI))
+        self.assertEqual(normalized.image.width, normalized.image.height * 5)
+
+    def test_bilevel(self):
+        """
+        Tests that the signature is reduced to black ink on a white background.
+        """
+        normalized = self.signature.normalize(20)
+        self.assertEqual(normalized.image.mode, "1")
+        self.assertEqual(normalized.image.getextrema(), (0, 0))
+
+    def test_grayscale(self):
+        """
+        Tests that the signature can be kept in grayscale instead.
+        """
+        normalized = self.signature.normalize(20, bilevel=False)
+        self.assertEqual(normalized.image.mode, "L")
+
+    def test_no_upscale(self):
+        """
+        Tests that a signature smaller than the print resolution is not scaled up.
+        """
+        normalized = self.signature.normalize(20, dpi=10)
+        self.assertEqual(normalized.image.height, 2)
+        normalized = self.signature.normalize(20, dpi=10000)
+        self.assertEqual(normalized.image.size, (500, 100))
+
+    def test_blank_canvas(self):
+        """
+        Tests that a blank canvas is kept whole.
+        """
+        buffer = io.BytesIO()
+        Image.new("RGBA", (300, 100), (0, 0, 0, 0)).save(buffer, "PNG")
+        normalized = Signature.from_png(buffer.getvalue()).normalize(20)
+        self.assertAlmostEqual(normalized.width, 60)
+        self.assertEqual(normalized.image.getextrema(), (255, 255))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+"""Module for testing smtp_pool.py"""
+import smtplib
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+from src.send_email import SendEmail
+from src.smtp_pool import SMTPConnectionPool
+
+def _mock_connection():
+    connection = MagicMock()
+    connection.noop.return_value = (250, b"OK")
+    connection.mail.return_value = (250, b"OK")
+    connection.rcpt.return_value = (250, b"OK")
+    connection.docmd.return_value = (354, b"Go ahead")
+    connection.getreply.return_value = (250, b"OK")
+    return connection
+
+class TestSMTPConnectionPool(unittest.TestCase):
+    """Class for testing the SMTPConnectionPool class"""
+    def setUp(self):
+        self.patcher = patch("src.smtp_pool.smtplib.SMTP")
+        self.mock_smtp = self.patcher.start()
+        self.mock_smtp.side_effect = lambda *args, **kwargs: _mock_connection()
+        self.pool = SMTPConnectionPool("smtp.example.com", 587, "user", "pswd", size=2)
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_connection_is_reused(self):
+        """Test that a returned connection is reused without logging in again"""
+        with self.pool.connection() as first:
+            first.smtp.starttls.assert_called_once()
+            first.smtp.login.assert_called_once_with("user", "pswd")
+        with self.pool.connection() as second:
+            pass
+
+        self.assertIs(first, second)
+        self.assertTrue(second.reused)
+        second.smtp.noop.assert_called_once()
+        self.assertEqual(self.mock_smtp.call_count, 1)
+        self.assertEqual(self.pool.stats()["reuse_ratio"], 0.5)
+
+    def test_dead_connection_is_replaced(self):
+        """Test that a connection failing its NOOP check is replaced"""
+        with self.pool.connection() as first:
+            first.smtp.noop.side_effect = smtplib.SMTPServerDisconnected()
+        with self.pool.connection() as second:
+            pass
+
+        self.assertIsNot(first, second)
+        first.smtp.close.assert_called_once()
+        self.assertEqual(self.pool.stats()["replaced"], 1)
+
+    def test_idle_connection_is_replaced(self):
+        """Test that a connection idle for longer than the idle timeout is not reused"""
+        self.pool.idle_timeout = 0
+        with self.pool.connection() as first:
+            pass
+        with self.pool.connection() as second:
+            pass
+
+        self.assertIsNot(first, second)
+        first.smtp.noop.assert_not_called()
+        first.smtp.quit.assert_called_once()
+
+    def test_failed_connection_is_discarded(self):
+        """Test that a connection is closed rather than reused after an error"""
+        with self.assertRaises(smtplib.SMTPDataError):
+            with self.pool.connection() as first:
+                raise smtplib.SMTPDataError(554, "error")
+        with self.pool.connection() as second:
+            pass
+
+        self.assertIsNot(first, second)
+        self.assertEqual(self.pool.stats()["idle"], 1)
+
+    def test_size_limits_open_connections(self):
+        """Test that no more than size connections are lent out at once"""
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            self.pool.release(self.pool.acquire())
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        self.pool.release(first)
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+        self.pool.release(second)
+        self.assertEqual(self.mock_smtp.call_count, 2)
+
+    def test_connect_error_frees_slot(self):
+        """Test that a failed login does not use up a slot of the pool"""
+        self.mock_smtp.side_effect = None
+        self.mock_smtp.return_value.login.side_effect = smtplib.SMTPAuthenticationError(535, "")
+        for _ in range(3):
+            with self.assertRaises(smtplib.SMTPAuthenticationError):
+                self.pool.acquire()
+
+class TestSendEmailPool(unittest.TestCase):
+    """Class for testing that SendEmail sends on pooled connections"""
+    @patch("src.send_email.smtplib.SMTP")
+    def test_one_handshake_per_connection(self, mock_smtp):
+        """Test that consecutive emails share one connection"""
+        mock_smtp.return_value = _mock_connection()
+        send_email = SendEmail("smtp.example.com", 587, "user", "pswd")
+        send_email.send_email_to_patient("no@email.com", "Bob Marley")
+        send_email.send_email_to_patient("no@email.com", "Bob Marley")
+
+        mock_smtp.assert_called_once()
+        mock_smtp.return_value.login.assert_called_once()
+        self.assertEqual(mock_smtp.return_value.mail.call_count, 2)
+
+    @patch("src.send_email.smtplib.SMTP")
+    def test_disconnect_while_sending(self, mock_smtp):
+        """Test that an email is sent again on a new connection if a reused one was dropped"""
+        stale, fresh = _mock_connection(), _mock_connection()
+        mock_smtp.side_effect = [stale, fresh]
+        send_email = SendEmail("smtp.example.com", 587, "user", "pswd")
+        send_email.send_email_to_patient("no@email.com", "Bob Marley")
+
+        stale.mail.side_effect = smtplib.SMTPServerDisconnected()
+        send_email.send_email_to_patient("no@email.com", "Bob Marley")
+
+        fresh.mail.assert_called_once()
+        self.assertEqual(send_email.pool.stats()["created"], 2)
+
+if __name__ == "__main__":
+    unittest.main()